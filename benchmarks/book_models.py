@@ -0,0 +1,297 @@
+""" Measures the performance of the models of the Godley & Lavoie
+    book: the time needed to build (and parse), compile and simulate
+    each model, and the peak memory used.
+
+    The models are taken from the notebooks in godley_&_lavoie (the
+    function that creates the model, and the statements of the
+    baseline cell before its first loop), model SIM is read from
+    pysolve3/tests/ch3_sim.spec.  For each model the results are
+        equations: The number of equations.
+        build_ms: The time to create the model (equations parsed).
+        compile_ms: The time to compile the model.
+        peak_kb: The peak memory (tracemalloc) to build, compile and
+            simulate the model.
+        methods: For each solver method, the time per simulated
+            period (period_us) and the mean number of iterations, or
+            the error if the method fails.
+    The times are the minimum of the repeats (as with timeit).
+
+    Usage:
+        python benchmarks/book_models.py [--models SIM,LP] [--periods N]
+                                         [--repeat N] [--json FILE]
+                                         [--compare FILE]
+
+    With --compare, the results are compared to an earlier result
+    file, and the benchmark fails if a time is slower than allowed by
+    --tolerance.
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+import argparse
+import ast
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+NOTEBOOKS = os.path.join(ROOT, 'godley_&_lavoie')
+
+# name -> notebook (None for the models that are not in a notebook)
+MODELS = [('SIM', None),
+          ('SIMEX', 'Python 3 - Chapter 3 Model SIMEX.ipynb'),
+          ('PC', 'Python 3 - Chapter 4 Model PC.ipynb'),
+          ('LP', 'Python 3 - Chapter 5 Model LP.ipynb'),
+          ('BMW', 'Python 3 - Chapter 7 Model BMW.ipynb'),
+          ('DIS', 'Python 3 - Chapter 9 Model DIS.ipynb'),
+          ('INSOUT', 'Python 3 - Chapter 10 Model INSOUT.ipynb'),
+          ('GROWTH', 'Python 3 - Chapter 11 Model GROWTH.ipynb'),
+          ('OPENFIX', 'Python 3 - Chapter 12 Model OPENFIX.ipynb')]
+
+METHODS = ('gauss-seidel', 'newton-raphson', 'broyden',
+           'block-gauss-seidel', 'block-newton')
+
+# The timed values that are compared by --compare
+_TIMES = ('build_ms', 'compile_ms', 'period_us')
+
+
+def _code_cells(path):
+    """ Returns the sources of the code cells of the notebook, the
+        IPython magics (%...) are left out.
+    """
+    with open(path) as notebook:
+        cells = json.load(notebook)['cells']
+    return [''.join(line for line in cell['source']
+                    if not line.lstrip().startswith('%'))
+            for cell in cells if cell['cell_type'] == 'code']
+
+
+def _notebook_factory(path):
+    """ Returns a function that creates the model of the notebook
+        with the values of its baseline.
+
+        This is the first cell that defines a create_*_model()
+        function, and the statements of the first cell that calls it
+        up to the first loop (or call of solve()).
+    """
+    cells = _code_cells(path)
+    for index, source in enumerate(cells):
+        tree = ast.parse(source)
+        names = [node.name for node in tree.body
+                 if isinstance(node, ast.FunctionDef) and
+                 node.name.startswith('create_')]
+        if names:
+            break
+    else:
+        raise ValueError('no create function in ' + path)
+    create = names[0]
+
+    for source in cells[index + 1:]:
+        if create + '()' in source:
+            break
+    else:
+        raise ValueError('no baseline cell in ' + path)
+    setup = []
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.For, ast.While)) or '.solve(' in \
+                ast.get_source_segment(source, node):
+            break
+        setup.append(node)
+    model_name = setup[0].targets[0].id
+    setup = ast.Module(body=setup, type_ignores=[])
+
+    namespace = dict()
+    exec('from pysolve3.model import Model\n'
+         'from pysolve3.utils import is_close, round_solution\n' +
+         cells[index], namespace)
+    setup = compile(setup, path, 'exec')
+
+    def _factory():
+        """ Creates the model, with the baseline values """
+        local = dict(namespace)
+        exec(setup, local)
+        return local[model_name]
+    return _factory
+
+
+def _spec_factory():
+    """ Returns a function that creates model SIM from its spec """
+    from pysolve3.model import Model
+    path = os.path.join(ROOT, 'pysolve3', 'tests', 'ch3_sim.spec')
+    return lambda: Model.from_spec(path)
+
+
+def _error(err):
+    """ Returns the description of an error of a model """
+    return '{0}: {1}'.format(type(err).__name__, err)
+
+
+def _best(func, repeat):
+    """ Returns the minimum time of the calls of func (seconds), and
+        the result of the last call.
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _simulate(factory, method, periods, repeat, iterations):
+    """ Times the periods simulated with the method
+
+        Returns: a dict with period_us and iterations, or error
+    """
+    from pysolve3.telemetry import SolverTelemetry
+    model = factory()
+    try:
+        # the first period compiles the model
+        model.simulate(1, method=method, iterations=iterations)
+        telemetry = SolverTelemetry(capacity=1)
+        best, _ = _best(lambda: model.simulate(
+            periods, method=method, iterations=iterations,
+            telemetry=telemetry), repeat)
+    except Exception as err:  # pylint: disable=broad-except
+        return {'error': _error(err)}
+    return {'period_us': round(best / periods * 1e6, 2),
+            'iterations': round(telemetry.iterations / telemetry.periods, 2)}
+
+
+def measure(name, factory, periods=100, repeat=3, iterations=100):
+    """ Runs the benchmarks of a model
+
+        Returns: a dict with the results (see the module docstring),
+            compile_error is set if the model cannot be compiled.
+    """
+    # pylint: disable=too-many-arguments
+    build, model = _best(factory, repeat)
+    result = {'model': name,
+              'equations': len(model.equations),
+              'build_ms': round(build * 1e3, 3)}
+
+    def _compile():
+        """ Compiles a new model """
+        model = factory()
+        start = time.perf_counter()
+        model.compile()
+        return time.perf_counter() - start
+    try:
+        result['compile_ms'] = round(
+            min(_compile() for _ in range(repeat)) * 1e3, 3)
+    except Exception as err:  # pylint: disable=broad-except
+        result['compile_error'] = _error(err)
+
+    tracemalloc.start()
+    try:
+        peak_model = factory()
+        peak_model.compile()
+        peak_model.simulate(periods, iterations=iterations)
+    except Exception:  # pylint: disable=broad-except
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result['peak_kb'] = round(peak / 1024., 1)
+    result['methods'] = {method: _simulate(factory, method, periods,
+                                           repeat, iterations)
+                         for method in METHODS}
+    return result
+
+
+def compare(results, previous, tolerance):
+    """ Compares the times of the results with the previous results
+
+        Returns: a list of the (model, measure, previous, current)
+            that are slower than previous * (1 + tolerance)
+    """
+    slower = []
+    old_models = previous.get('models', {})
+    for name, result in results['models'].items():
+        old = old_models.get(name)
+        if old is None:
+            continue
+        pairs = [(key, old.get(key), result[key])
+                 for key in _TIMES if key in result]
+        for method, values in result['methods'].items():
+            old_values = old.get('methods', {}).get(method, {})
+            pairs.extend((method + ':' + key, old_values.get(key),
+                          values[key])
+                         for key in _TIMES if key in values)
+        slower.extend((name, key, before, after)
+                      for key, before, after in pairs
+                      if before and after > before * (1 + tolerance))
+    return slower
+
+
+def main():
+    """ Runs the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--models',
+                        help='comma separated names (all by default)')
+    parser.add_argument('--periods', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='an earlier result file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown with --compare (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    selected = [name for name, _ in MODELS]
+    if args.models:
+        selected = args.models.split(',')
+        unknown = set(selected) - set(name for name, _ in MODELS)
+        if unknown:
+            parser.error('unknown models: ' + ', '.join(sorted(unknown)))
+
+    start = time.perf_counter()
+    import pysolve3.model  # pylint: disable=unused-import
+    import_ms = (time.perf_counter() - start) * 1e3
+
+    results = {'benchmark': 'book_models',
+               'python': sys.version.split()[0],
+               'periods': args.periods,
+               'repeat': args.repeat,
+               'import_ms': round(import_ms, 1),
+               'models': dict()}
+    for name, notebook in MODELS:
+        if name not in selected:
+            continue
+        if notebook is None:
+            factory = _spec_factory()
+        else:
+            factory = _notebook_factory(os.path.join(NOTEBOOKS, notebook))
+        results['models'][name] = measure(name, factory,
+                                          periods=args.periods,
+                                          repeat=args.repeat,
+                                          iterations=args.iterations)
+        print(json.dumps(results['models'][name]), file=sys.stderr)
+
+    print(json.dumps(results, indent=4))
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=4)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            slower = compare(results, json.load(previous), args.tolerance)
+        for name, key, before, after in slower:
+            print('{0} {1}: {2} -> {3}'.format(name, key, before, after),
+                  file=sys.stderr)
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
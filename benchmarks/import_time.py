@@ -0,0 +1,109 @@
+""" Measures the time needed to import pysolve3.model.
+
+    Each measurement is done in a new python process (with
+    python -X importtime), after a first run that writes the
+    bytecode files.  The import of pysolve3 itself (without
+    its dependencies sympy and numpy) must stay within the budget,
+    and the optional modules must not be imported.
+
+    Usage:
+        python benchmarks/import_time.py [--runs N] [--budget MS]
+                                         [--json FILE]
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# Modules that are only imported when they are used
+LAZY_MODULES = ('sympy.stats', 'pandas', 'scipy', 'concurrent.futures')
+
+# The dependencies, these are not part of the budget
+DEPENDENCIES = ('sympy', 'numpy')
+
+_CODE = ('import sys, pysolve3.model; '
+         'print(",".join(m for m in {0!r} if m in sys.modules))'
+         .format(LAZY_MODULES))
+
+
+def _measure():
+    """ Imports pysolve3.model in a new process
+
+        Returns: a (total, dependencies, lazy) tuple, the times
+            are in milliseconds, lazy is the list of the lazy
+            modules that were imported.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [x for x in [env.get('PYTHONPATH')] if x])
+    # measure with the compiled bytecode, as for an installed package
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', _CODE],
+                            env=env, capture_output=True, text=True,
+                            check=True)
+    total = 0
+    dependencies = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        micros = int(cumulative)
+        # the nested imports are indented
+        if not name.startswith('  '):
+            total += micros
+        if name.strip() in DEPENDENCIES:
+            dependencies += micros
+    lazy = [x for x in result.stdout.strip().split(',') if x]
+    return total / 1000., dependencies / 1000., lazy
+
+
+def main():
+    """ Runs the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=50.,
+                        help='budget for pysolve3 itself (ms)')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    # the first run writes the bytecode files
+    _measure()
+    runs = sorted((_measure() for _ in range(args.runs)),
+                  key=lambda x: x[0] - x[1])
+    total, dependencies, lazy = runs[len(runs) // 2]
+    results = {
+        'benchmark': 'import_time',
+        'runs': args.runs,
+        'total_ms': round(total, 1),
+        'dependencies_ms': round(dependencies, 1),
+        'pysolve3_ms': round(total - dependencies, 1),
+        'budget_ms': args.budget,
+        'lazy_modules_imported': lazy,
+    }
+    print(json.dumps(results, indent=4))
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=4)
+
+    failed = False
+    if total - dependencies > args.budget:
+        print('pysolve3 import time is over budget', file=sys.stderr)
+        failed = True
+    if lazy:
+        print('modules imported eagerly: ' + ', '.join(lazy), file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
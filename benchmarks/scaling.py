@@ -0,0 +1,261 @@
+""" Measures how the performance scales with the size of the model,
+    using generated multi-sector models.
+
+    Each sector (or country) i of the generated model is a small
+    stock-flow consistent economy:
+        Y_i = C_i + G_i + X_i - M_i     income
+        T_i = theta*Y_i                 taxes
+        YD_i = Y_i - T_i                disposable income
+        C_i = alpha1*YD_i + alpha2*(V_i(-1) + ... + V_i(-lags))/lags
+        V_i = V_i(-1) + YD_i - C_i      household wealth
+        H_i = H_i(-1) + G_i - T_i       government debt
+    and, if the sectors trade (links > 0),
+        M_i = mu*Y_i                    imports
+        X_i = (M_j + ...)/links         exports, the imports of the
+                                        sectors that buy from i
+        F_i = F_i(-1) + X_i - M_i       foreign assets
+    The imports of a sector are bought from the next links sectors,
+    so the sectors are simultaneous (one block) if links > 0, and
+    independent otherwise.  The nonlinear sectors consume
+    alpha1*YD_i**2/(1 + YD_i) instead of alpha1*YD_i.
+
+    For each size (the number of equations), the results are the
+    times to build and compile the model, the peak memory (with
+    tracemalloc) to build and compile it, and the time per period of
+    each method (see book_models.py).  The dense methods are skipped
+    (or newton-raphson uses its sparse solver, if scipy is available)
+    above --dense-limit variables.
+
+    Usage:
+        python benchmarks/scaling.py [--sizes 10,100,1000,10000]
+                                     [--lags N] [--links N]
+                                     [--nonlinear FRACTION]
+                                     [--periods N] [--json FILE]
+                                     [--plot FILE]
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from book_models import METHODS, _best, _error
+
+
+def _sector_equations(i, sectors, lags, links, nonlinear):
+    """ Returns the equations of sector i """
+    # pylint: disable=too-many-arguments
+    wealth = ' + '.join('V_{0}(-{1})'.format(i, lag)
+                        for lag in range(1, lags + 1))
+    consumption = 'alpha1*YD_{0}'.format(i)
+    if nonlinear:
+        consumption = 'alpha1*YD_{0}**2/(1 + YD_{0})'.format(i)
+    equations = [
+        'T_{0} = theta*Y_{0}'.format(i),
+        'YD_{0} = Y_{0} - T_{0}'.format(i),
+        'C_{0} = {1} + alpha2*({2})/{3}'.format(i, consumption, wealth, lags),
+        'V_{0} = V_{0}(-1) + YD_{0} - C_{0}'.format(i),
+        'H_{0} = H_{0}(-1) + G_{0} - T_{0}'.format(i)]
+    if links == 0:
+        equations.append('Y_{0} = C_{0} + G_{0}'.format(i))
+        return equations
+
+    # sector i sells to the sectors that buy from it (i - 1, i - 2, ...)
+    buyers = ' + '.join('M_{0}'.format((i - k) % sectors)
+                        for k in range(1, links + 1))
+    equations.extend([
+        'Y_{0} = C_{0} + G_{0} + X_{0} - M_{0}'.format(i),
+        'M_{0} = mu*Y_{0}'.format(i),
+        'X_{0} = ({1})/{2}'.format(i, buyers, links),
+        'F_{0} = F_{0}(-1) + X_{0} - M_{0}'.format(i)])
+    return equations
+
+
+def create_model(sectors, lags=1, links=2, nonlinear=0.):
+    """ Creates a model with the given number of sectors
+
+        Arguments:
+            sectors: The number of sectors (or countries).
+            lags: The number of lags of wealth in consumption.
+            links: The number of sectors each sector buys from, 0 for
+                independent sectors.
+            nonlinear: The fraction of the sectors with a nonlinear
+                consumption function.
+
+        Returns: the Model
+    """
+    from pysolve3.model import Model
+    links = min(links, sectors - 1)
+    model = Model()
+    model.set_var_default(0)
+    model.param('alpha1', default=0.6)
+    model.param('alpha2', default=0.4)
+    model.param('theta', default=0.2)
+    model.param('mu', default=0.1)
+    for i in range(sectors):
+        names = ['Y', 'T', 'YD', 'C', 'V', 'H']
+        if links > 0:
+            names.extend(['M', 'X', 'F'])
+        for name in names:
+            model.var('{0}_{1}'.format(name, i))
+        model.param('G_{0}'.format(i), default=15 + 5 * (i % 3))
+    for i in range(sectors):
+        for equation in _sector_equations(i, sectors, lags, links,
+                                          i < nonlinear * sectors):
+            model.add(equation)
+    return model
+
+
+def _methods(model, dense_limit):
+    """ Returns a dict of method -> options (or the reason the method
+        is skipped)
+    """
+    try:
+        import scipy  # pylint: disable=unused-import
+        sparse = True
+    except ImportError:
+        sparse = False
+
+    size = len(model.variables)
+    block = max(len(block.variables) for block in model.compile().blocks)
+    methods = dict()
+    for method in METHODS:
+        methods[method] = dict()
+        if size <= dense_limit:
+            continue
+        if method == 'newton-raphson':
+            methods[method] = (dict(sparse=True) if sparse
+                               else 'dense jacobian (no scipy)')
+        elif method == 'broyden':
+            methods[method] = 'dense jacobian'
+        elif method == 'block-newton' and block > dense_limit:
+            methods[method] = 'dense block jacobian'
+    return methods
+
+
+def measure(equations, periods=10, lags=1, links=2, nonlinear=0.,
+            dense_limit=2000):
+    """ Runs the benchmarks of the model with (about) the given
+        number of equations
+
+        Returns: a dict with the results
+    """
+    # pylint: disable=too-many-arguments
+    per_sector = 9 if links > 0 else 6
+    sectors = max(-(-equations // per_sector), 1)
+
+    def _create():
+        """ Creates the model """
+        return create_model(sectors, lags=lags, links=links,
+                            nonlinear=nonlinear)
+
+    build, model = _best(_create, 1)
+    compile_time, _ = _best(model.compile, 1)
+    result = {'equations': len(model.equations),
+              'sectors': sectors,
+              'build_ms': round(build * 1e3, 3),
+              'compile_ms': round(compile_time * 1e3, 3)}
+
+    tracemalloc.start()
+    _create().compile()
+    result['peak_kb'] = round(tracemalloc.get_traced_memory()[1] / 1024., 1)
+    tracemalloc.stop()
+
+    # the methods start from the same compiled model
+    snapshot = model.snapshot()
+    result['methods'] = dict()
+    for method, options in _methods(model, dense_limit).items():
+        if not isinstance(options, dict):
+            result['methods'][method] = {'skipped': options}
+            continue
+        branch = snapshot.branch()
+        try:
+            branch.simulate(1, method=method, iterations=100, **options)
+            elapsed, _ = _best(lambda: branch.simulate(
+                periods, method=method, iterations=100, **options), 1)
+            result['methods'][method] = {
+                'period_us': round(elapsed / periods * 1e6, 2)}
+        except Exception as err:  # pylint: disable=broad-except
+            result['methods'][method] = {'error': _error(err)}
+    return result
+
+
+def plot(results, path):
+    """ Plots the build time, time per period and peak memory against
+        the number of equations (requires matplotlib)
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    sizes = [x['equations'] for x in results['sizes']]
+    fig, axes = plt.subplots(1, 3, figsize=(15, 4.5))
+    for key, label in (('build_ms', 'build'), ('compile_ms', 'compile')):
+        axes[0].plot(sizes, [x[key] for x in results['sizes']], 'o-',
+                     label=label)
+    axes[0].set_ylabel('ms')
+    for method in METHODS:
+        points = [(x['equations'], x['methods'][method]['period_us'])
+                  for x in results['sizes']
+                  if 'period_us' in x['methods'].get(method, {})]
+        if points:
+            axes[1].plot(*zip(*points), marker='o', label=method)
+    axes[1].set_ylabel('us per period')
+    axes[2].plot(sizes, [x['peak_kb'] for x in results['sizes']], 'o-',
+                 label='build and compile')
+    axes[2].set_ylabel('peak kB')
+    for axis in axes:
+        axis.set_xscale('log')
+        axis.set_yscale('log')
+        axis.set_xlabel('equations')
+        axis.legend()
+    fig.tight_layout()
+    fig.savefig(path)
+
+
+def main():
+    """ Runs the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10,100,1000,10000',
+                        help='comma separated numbers of equations')
+    parser.add_argument('--lags', type=int, default=1)
+    parser.add_argument('--links', type=int, default=2)
+    parser.add_argument('--nonlinear', type=float, default=0.)
+    parser.add_argument('--periods', type=int, default=10)
+    parser.add_argument('--dense-limit', type=int, default=2000)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--plot', help='plot the results to this file')
+    args = parser.parse_args()
+
+    results = {'benchmark': 'scaling',
+               'python': sys.version.split()[0],
+               'periods': args.periods,
+               'lags': args.lags,
+               'links': args.links,
+               'nonlinear': args.nonlinear,
+               'sizes': []}
+    for size in [int(x) for x in args.sizes.split(',')]:
+        start = time.perf_counter()
+        result = measure(size, periods=args.periods, lags=args.lags,
+                         links=args.links, nonlinear=args.nonlinear,
+                         dense_limit=args.dense_limit)
+        result['total_s'] = round(time.perf_counter() - start, 1)
+        results['sizes'].append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+    print(json.dumps(results, indent=4))
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=4)
+    if args.plot:
+        plot(results, args.plot)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+""" Contains the functions used to solve many scenarios of a model
+    at once.
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+import numpy
+
+from pysolve3.history import LagBuffer, SolutionHistory
+from pysolve3.utils import Convergence
+
+
+class BatchHistory(object):
+    """ The solutions of a batch of scenarios.
+
+        Attributes:
+            names: The names of the recorded variables/parameters.
+            array: A (periods x names x scenarios) array with the
+                values of the periods that have been solved.
+            failed: A boolean array, True for the scenarios that did
+                not converge.  The values of a failed scenario are
+                NaN from the period that did not converge.
+    """
+    def __init__(self, names, periods, scenarios):
+        self.names = list(names)
+        self.failed = numpy.zeros(scenarios, dtype=bool)
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self._data = numpy.empty((periods, len(self.names), scenarios))
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def scenarios(self):
+        """ The number of scenarios """
+        return self._data.shape[2]
+
+    @property
+    def array(self):
+        """ A (periods x names x scenarios) view of the values """
+        return self._data[:self._size]
+
+    def append(self, values):
+        """ Adds the (names x scenarios) values of a period """
+        self._data[self._size] = values
+        self._size += 1
+
+    def column(self, name):
+        """ Returns the (periods x scenarios) values of name, this
+            is a view of the array.
+
+            Raises:
+                KeyError: if name was not recorded
+        """
+        return self._data[:self._size, self._index[name], :]
+
+    def scenario(self, scenario):
+        """ Returns the solutions of a single scenario as a
+            SolutionHistory
+        """
+        history = SolutionHistory(names=self.names,
+                                  capacity=max(self._size, 1))
+        columns = history.columns(self.names)
+        for row in self._data[:self._size, :, scenario]:
+            history.append_row(row, columns)
+        return history
+
+    def to_frame(self):
+        """ Returns the values as a pandas DataFrame, indexed by
+            (scenario, period)
+        """
+        import pandas as pd
+        values = self.array.transpose(2, 0, 1).reshape(-1, len(self.names))
+        index = pd.MultiIndex.from_product(
+            [range(self.scenarios), range(self._size)],
+            names=['scenario', 'period'])
+        return pd.DataFrame(values, index=index, columns=self.names)
+
+
+# The memory (bytes) used by the stacked jacobians of the scenarios
+# solved at once with Newton-Raphson
+_NEWTON_MEMORY = 64 * 1024 * 1024
+
+
+def _gauss_seidel(compiled, state, active, iterations, convergence):
+    """ Iterates the scenarios in active until they converge, the
+        scenarios are dropped as soon as they have converged.
+
+        Returns: the scenarios that have not converged
+    """
+    # only the variables change during the iterations
+    variables = numpy.array(compiled.variables, dtype=numpy.intp)
+    values = state if len(active) == state.shape[1] else state[:, active]
+    for _ in range(iterations):
+        prev = values[variables]
+        compiled.step(values)
+        done = convergence.converged_scenarios(prev, values[variables])
+        if done.any():
+            state[:, active[done]] = values[:, done]
+            active = active[~done]
+            values = values[:, ~done]
+            if not len(active):
+                break
+    return active
+
+
+def _solve_linear(matrices, rhs):
+    """ Solves the stacked linear equations, the solution of a
+        scenario with a singular matrix is NaN.
+    """
+    try:
+        return numpy.linalg.solve(matrices, rhs[..., None])[..., 0]
+    except numpy.linalg.LinAlgError:
+        result = numpy.full(rhs.shape, numpy.nan)
+        for i in range(len(matrices)):
+            try:
+                result[i] = numpy.linalg.solve(matrices[i], rhs[i])
+            except numpy.linalg.LinAlgError:
+                pass
+        return result
+
+
+def _newton_raphson(compiled, state, active, iterations, convergence):
+    """ Solves the scenarios in active with Newton-Raphson, the
+        jacobians of the scenarios are solved as stacks.  The
+        scenarios are solved in chunks, so that the stacked (dense)
+        jacobians take at most _NEWTON_MEMORY bytes.
+
+        Returns: the scenarios that have not converged
+    """
+    size = max(compiled.jacobian.size, 1)
+    chunk = max(_NEWTON_MEMORY // (size * size * 8), 1)
+    if len(active) <= chunk:
+        return _newton_chunk(compiled, state, active, iterations,
+                             convergence)
+    return numpy.concatenate([
+        _newton_chunk(compiled, state, active[start:start + chunk],
+                      iterations, convergence)
+        for start in range(0, len(active), chunk)])
+
+
+def _newton_chunk(compiled, state, active, iterations, convergence):
+    """ Solves a chunk of the scenarios with Newton-Raphson (see
+        _newton_raphson()), the jacobians of the chunk are solved as
+        a stack.
+
+        Returns: the scenarios that have not converged
+    """
+    # pylint: disable=invalid-name
+    jacobian = compiled.jacobian
+    variables = numpy.array(compiled.variables, dtype=numpy.intp)
+    values = state if len(active) == state.shape[1] else state[:, active]
+    # the entries that are not part of the sparsity pattern stay 0
+    matrices = numpy.zeros((len(active), jacobian.size, jacobian.size))
+    for _ in range(iterations):
+        F = numpy.array(compiled.residual(values))
+        data = numpy.repeat(jacobian.template[:, None], len(active), axis=1)
+        jacobian.fill(values, data)
+        J = matrices[:len(active)]
+        J[:, jacobian.rows, jacobian.cols] = data.T
+
+        prev = values[variables]
+        values[variables] -= _solve_linear(J, F.T).T
+        done = convergence.converged_scenarios(prev, values[variables])
+        if done.any():
+            state[:, active[done]] = values[:, done]
+            active = active[~done]
+            values = values[:, ~done]
+            if not len(active):
+                break
+    return active
+
+
+_SOLVERS = {'gauss-seidel': _gauss_seidel,
+            'newton-raphson': _newton_raphson}
+
+
+def _scenario_count(values):
+    """ Returns the number of scenarios given by the values
+
+        Raises:
+            ValueError: if the arrays have different lengths
+    """
+    lengths = set(numpy.size(value) for value in values.values()
+                  if numpy.ndim(value) > 0)
+    if len(lengths) > 1:
+        raise ValueError('the values must have the same number of scenarios')
+    return lengths.pop() if lengths else 1
+
+
+def run_batch(model, compiled, context, periods, values,
+              method='gauss-seidel', iterations=10, threshold=0.001,
+              record=None, generator=None, writer=None, atol=1e-4,
+              norm='max'):
+    """ Solves the model for all of the scenarios at once.
+
+        Arguments:
+            model: The model.
+            compiled: The vectorized form of the model (see
+                compile_batch()).
+            context: The values of the model for the next period.
+            periods: The number of periods to solve.
+            values: A dict of name -> value (or array of one value
+                per scenario), for the variables/parameters.
+            method: 'gauss-seidel' or 'newton-raphson'
+            iterations: The maximum number of iterations per period.
+            threshold: The convergence threshold, as with
+                Model.solve() this is a single value or a dict of
+                variable name -> threshold.
+            record: If set, the names of the variables/parameters
+                to record (all of the values by default).
+            generator: The numpy.random.Generator used to draw the
+                stochastic terms, one value per period and scenario.
+            writer: If set, the ResultWriter the values are written
+                to, a row per period and scenario indexed by
+                (scenario, period of the model), rather than being
+                kept in the BatchHistory.
+            atol: The absolute tolerance (see Model.solve())
+            norm: The norm of the convergence test (see Model.solve())
+
+        Returns: a BatchHistory
+
+        Raises:
+            ValueError:
+    """
+    # pylint: disable=too-many-arguments, too-many-locals, protected-access
+    if method not in _SOLVERS:
+        raise ValueError(
+            '{0} is not a valid batch solver method type'.format(method))
+    solve = _SOLVERS[method]
+
+    for name in list(values) + list(record or []):
+        if name not in model.variables and name not in model.parameters:
+            raise ValueError("{0} is not a parameter/variable".format(name))
+    scenarios = _scenario_count(values)
+    convergence = Convergence(compiled.variables,
+                              atol=model._tolerances(atol, 1e-4),
+                              rtol=model._tolerances(threshold, 0.001),
+                              norm=norm)
+
+    state = numpy.empty((len(compiled.names), scenarios))
+    state[:] = numpy.array([float(x) for x in context.values()])[:, None]
+    for name, value in values.items():
+        state[compiled.index[name]] = value
+
+    record = record or compiled.names
+    positions = numpy.array([compiled.index[name] for name in record],
+                            dtype=numpy.intp)
+    keys = None
+    if writer is None:
+        history = BatchHistory(record, periods, scenarios)
+    else:
+        writer.open(record, ('scenario', 'period'))
+        history = BatchHistory(record, 0, scenarios)
+        keys = numpy.empty((scenarios, 2), dtype=numpy.int64)
+        keys[:, 0] = numpy.arange(scenarios)
+        start = model.periods
+    lags = LagBuffer(model._lags, model.solutions, len(compiled.names),
+                     scenarios)
+    randoms = [(compiled.index[param.name], param)
+               for param in model._random_parameters.values()]
+    if randoms and generator is None:
+        generator = numpy.random.default_rng()
+
+    # errors within the equations give NaN (or inf), the scenario
+    # then does not converge
+    with numpy.errstate(all='ignore'):
+        for period in range(periods):
+            state = lags.fill(state)
+            for index, param in randoms:
+                state[index] = param.draw(generator, scenarios)
+            failed = solve(compiled, state,
+                           numpy.flatnonzero(~history.failed),
+                           iterations, convergence)
+            history.failed[failed] = True
+            state[:, history.failed] = numpy.nan
+            lags.push(state)
+            if writer is None:
+                history.append(state[positions])
+            else:
+                keys[:, 1] = start + period
+                writer.write(state[positions].T, keys)
+    return history
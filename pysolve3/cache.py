@@ -0,0 +1,72 @@
+""" Contains the functions used to store compiled models on disk.
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+import os
+import pickle
+
+
+# Changed whenever the generated code (or the entries) change,
+# so that older entries are not used
+_CACHE_VERSION = 2
+
+
+def model_key(model):
+    """ Returns the key of the model within the cache.
+
+        This is a hash of the names of the variables and parameters
+        and of the equations (in order), the values are not part of
+        the key.
+    """
+    import hashlib
+    digest = hashlib.sha256()
+    parts = ([str(_CACHE_VERSION)] +
+             ['var:' + name for name in model.variables] +
+             ['param:' + name for name in model.parameters] +
+             ['eqn:' + eqn.equation for eqn in model.equations])
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _path(directory, key):
+    """ Returns the file used for the key """
+    return os.path.join(directory, key + '.pkl')
+
+
+def load(directory, key):
+    """ Returns the cache entry for the key, or None if there is
+        no (usable) entry.
+    """
+    try:
+        with open(_path(directory, key), 'rb') as cache_file:
+            entry = pickle.load(cache_file)
+    except (OSError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get('version') != _CACHE_VERSION:
+        return None
+    return entry
+
+
+def store(directory, key, entry):
+    """ Writes the cache entry for the key.
+
+        The entry is written to a temporary file first, so that a
+        partially written entry is never read.
+    """
+    import tempfile
+    os.makedirs(directory, exist_ok=True)
+    entry = dict(entry, version=_CACHE_VERSION)
+    handle, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as cache_file:
+            pickle.dump(entry, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, _path(directory, key))
+    except BaseException:
+        os.remove(temp)
+        raise
@@ -0,0 +1,620 @@
+""" Contains the code generator used to compile a model.
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+import functools
+import math
+
+import numpy
+from sympy import Dummy, S, cse, numbered_symbols
+from sympy.printing.numpy import NumPyPrinter
+from sympy.printing.pycode import PythonCodePrinter
+
+from pysolve3.equation import EquationError
+from pysolve3.graph import block_decomposition
+
+
+# Filename given to the generated code, this is used to find
+# the equation that raised an error from the traceback.
+_FILENAME = '<pysolve3-compiled>'
+
+
+class _ScalarPrinter(PythonCodePrinter):
+    """ Prints a sympy expression as python code that works on
+        float values.  The symbols are replaced by the names of the
+        local variables used within the generated function.
+    """
+    def __init__(self, local_names):
+        super(_ScalarPrinter, self).__init__()
+        self._local_names = local_names
+
+    def _print_Symbol(self, expr):
+        """ Symbols are read from the local variables, the symbols
+            introduced by common subexpression elimination are
+            already local variables.
+        """
+        return self._local_names.get(expr.name, expr.name)
+
+    def _print__IfTrueNoEvalFunction(self, expr):
+        """ if_true(x) returns 1 if x is true, 0 otherwise """
+        return '(1.0 if {0} else 0.0)'.format(self._print(expr.args[0]))
+
+    _print__IfTrueFunction = _print__IfTrueNoEvalFunction
+
+    def _print_Heaviside(self, expr):
+        """ The derivative of Max()/Min() """
+        arg = self._print(expr.args[0])
+        return '(1.0 if {0} > 0 else (0.5 if {0} == 0 else 0.0))'.format(arg)
+
+
+class _VectorPrinter(NumPyPrinter):
+    """ Prints a sympy expression as python code that works on
+        numpy arrays (element-wise), this is used to evaluate
+        many scenarios at once.
+    """
+    def __init__(self, local_names):
+        super(_VectorPrinter, self).__init__()
+        self._local_names = local_names
+
+    def _print_Symbol(self, expr):
+        """ Symbols are read from the local variables """
+        return self._local_names.get(expr.name, expr.name)
+
+    def _print__IfTrueNoEvalFunction(self, expr):
+        """ if_true(x) returns 1 where x is true, 0 otherwise """
+        return 'numpy.where({0}, 1.0, 0.0)'.format(
+            self._print(expr.args[0]))
+
+    _print__IfTrueFunction = _print__IfTrueNoEvalFunction
+
+    def _print_Heaviside(self, expr):
+        """ The derivative of Max()/Min() """
+        return 'numpy.heaviside({0}, 0.5)'.format(self._print(expr.args[0]))
+
+
+class _SourceWriter(object):
+    """ Accumulates the lines of the generated source, keeping track
+        of the equation that each line evaluates.
+    """
+    def __init__(self):
+        self.lines = []
+        self.line_map = dict()
+
+    def emit(self, line, position=None):
+        """ Adds a line, position is the position of the equation
+            that is evaluated by this line (if any).
+        """
+        self.lines.append(line)
+        if position is not None:
+            self.line_map[len(self.lines)] = position
+
+    def source(self):
+        """ Returns the generated source """
+        return '\n'.join(self.lines) + '\n'
+
+
+def _local_name(position):
+    """ Returns the name of the local variable used for the symbol
+        at this position in the state vector.
+    """
+    return 'v{0}'.format(position)
+
+
+def _print_expr(printer, equation, expr):
+    """ Converts an expression of the equation into python code
+
+        Raises:
+            EquationError
+    """
+    code = printer.doprint(expr)
+    # pylint: disable=protected-access
+    if printer._not_supported:
+        raise EquationError('not-compilable',
+                            equation.equation,
+                            'cannot compile : ' +
+                            ', '.join(str(x) for x in printer._not_supported))
+    return code
+
+
+def _comment(equation):
+    """ Returns the equation text as a single line comment """
+    return '  # ' + ' '.join(equation.equation.split())
+
+
+def _emit_loads(writer, equations, index, exprs=None, copy=False):
+    """ Loads the symbols used by the equations (or by exprs,
+        if given) into local variables.  If copy is True, the
+        variables of the equations are loaded as copies (this is
+        needed for numpy rows, which are updated in place).
+
+        Raises:
+            EquationError
+    """
+    symbols = set()
+    targets = set(equation.variable.name for equation in equations)
+    for equation in equations:
+        symbols.add(equation.variable.name)
+        for atom in equation.expr.atoms():
+            if atom.is_Symbol:
+                if atom.name not in index:
+                    raise EquationError(
+                        'no-value',
+                        equation.equation,
+                        str(atom) + ' has no value, cannot solve equation')
+                symbols.add(atom.name)
+    for expr in exprs or []:
+        for atom in expr.atoms():
+            if atom.is_Symbol and atom.name in index:
+                symbols.add(atom.name)
+
+    for name in sorted(symbols, key=lambda k: index[k]):
+        load = 'x[{0}]'
+        if copy and name in targets:
+            load = 'x[{0}].copy()'
+        writer.emit('    {0} = {1}'.format(_local_name(index[name]),
+                                          load.format(index[name])))
+
+
+def _emit_step(writer, name, equations, positions, index, printer,
+               copy=False):
+    """ Generates a single Gauss-Seidel sweep over the equations.
+
+        The symbols used are loaded into local variables, the
+        equations are evaluated in order (so that each equation
+        sees the latest values), and the results are written back
+        into the state vector.
+    """
+    # pylint: disable=too-many-arguments
+    writer.emit('def {0}(x):'.format(name))
+    _emit_loads(writer, equations, index, copy=copy)
+
+    for position, equation in zip(positions, equations):
+        writer.emit('    {0} = {1}{2}'.format(
+            _local_name(index[equation.variable.name]),
+            _print_expr(printer, equation, equation.expr),
+            _comment(equation)), position)
+
+    for equation in equations:
+        target = index[equation.variable.name]
+        writer.emit('    x[{0}] = {1}'.format(target, _local_name(target)))
+    if not equations:
+        writer.emit('    pass')
+
+
+def _emit_residual(writer, name, equations, positions, index, printer):
+    """ Generates the function that returns the residuals
+            f(...) = var - expr
+        for the equations, evaluated at the current state.
+    """
+    # pylint: disable=too-many-arguments
+    writer.emit('def {0}(x):'.format(name))
+    _emit_loads(writer, equations, index)
+
+    for i, (position, equation) in enumerate(zip(positions, equations)):
+        writer.emit('    r{0} = {1} - ({2}){3}'.format(
+            i,
+            _local_name(index[equation.variable.name]),
+            _print_expr(printer, equation, equation.expr),
+            _comment(equation)), position)
+    writer.emit('    return [{0}]'.format(
+        ', '.join('r{0}'.format(i) for i in range(len(equations)))))
+
+
+def _derivatives(expr, names):
+    """ Returns a dict of symbol -> the partial derivative of expr with
+        respect to the symbol, for the symbols of expr in names.
+
+        The symbols are differentiated as real values, so that the
+        derivative of abs(x) is sign(x) (rather than an expression of
+        re(x) and im(x), which cannot be evaluated).
+    """
+    reals = {atom: Dummy(atom.name, real=True)
+             for atom in expr.free_symbols}
+    real_expr = expr.xreplace(reals)
+    symbols = {value: key for key, value in reals.items()}
+    return {atom: real_expr.diff(real).xreplace(symbols)
+            for atom, real in reals.items() if atom.name in names}
+
+
+def _jacobian_entries(equations):
+    """ Determines the non-zero entries of the jacobian of the
+        residuals f(...) = var - expr of the equations.  The rows
+        and columns are the positions of the equations (and thus
+        of the variables they define) within the list.
+
+        Returns: a dict of (column, row) -> derivative expression
+    """
+    columns = {eqn.variable.name: i for i, eqn in enumerate(equations)}
+    entries = dict()
+    for row, equation in enumerate(equations):
+        for atom, derivative in _derivatives(equation.expr, columns).items():
+            entries[(columns[atom.name], row)] = -derivative
+        # We store the equations as var_i = expr
+        # But what we really want is f(...) = var_i - expr = 0
+        # therefore df/dvar_i = 1 - dexpr/dvar_i
+        entries[(row, row)] = entries.get((row, row), S.Zero) + 1
+    return entries
+
+
+def _emit_jacobian(writer, name, equations, positions, index, printer):
+    """ Generates the function that evaluates the jacobian of the
+        residuals of the equations.
+
+        The non-zero entries are stored in column-major order (as in
+        the compressed sparse column format) in a flat data buffer.
+        Entries that are constant are not evaluated, they are part of
+        the initial data buffer.  The common subexpressions of the
+        derivatives are computed only once.
+
+        Returns: a CompiledJacobian
+    """
+    # pylint: disable=too-many-arguments, too-many-locals
+    entries = _jacobian_entries(equations)
+    keys = sorted(entries)
+    template = numpy.zeros(len(keys))
+    evaluated = []
+    for k, key in enumerate(keys):
+        if entries[key].is_number:
+            template[k] = float(entries[key])
+        else:
+            evaluated.append(k)
+
+    exprs = [entries[keys[k]] for k in evaluated]
+    replacements, reduced = cse(exprs, symbols=numbered_symbols('_c'))
+
+    writer.emit('def {0}(x, data):'.format(name))
+    _emit_loads(writer, [], index, exprs)
+    for symbol, expr in replacements:
+        writer.emit('    {0} = {1}'.format(symbol.name, printer.doprint(expr)))
+    for k, expr in zip(evaluated, reduced):
+        equation = equations[keys[k][1]]
+        writer.emit('    data[{0}] = {1}{2}'.format(
+            k,
+            _print_expr(printer, equation, expr),
+            _comment(equation)), positions[keys[k][1]])
+    if not evaluated:
+        writer.emit('    pass')
+
+    return CompiledJacobian(name,
+                            len(equations),
+                            [row for _, row in keys],
+                            [col for col, _ in keys],
+                            template)
+
+
+class CompiledJacobian(object):
+    """ The compiled jacobian of a set of equations.
+
+        The non-zero entries are kept in a flat data buffer, in
+        column-major order, so they can be used directly to build
+        a sparse matrix in compressed sparse column format.
+
+        Attributes:
+            size: The number of rows (and columns).
+            rows: The row of each entry in the data buffer.
+            cols: The column of each entry in the data buffer.
+            template: The initial data buffer, this contains the
+                constant entries.
+            fill: fill(x, data) evaluates the non-constant entries
+                at the state x into the data buffer.
+    """
+    def __init__(self, name, size, rows, cols, template):
+        # pylint: disable=too-many-arguments
+        self.name = name
+        self.size = size
+        self.rows = numpy.array(rows, dtype=numpy.int32)
+        self.cols = numpy.array(cols, dtype=numpy.int32)
+        self.template = template
+        self.indptr = numpy.searchsorted(
+            self.cols, numpy.arange(size + 1)).astype(numpy.int32)
+        self.fill = None
+
+    def __getstate__(self):
+        """ The generated function is linked again when the
+            CompiledModel is unpickled.
+        """
+        state = self.__dict__.copy()
+        state['fill'] = None
+        return state
+
+    def _link(self, namespace):
+        """ Looks up the generated function """
+        self.fill = namespace[self.name]
+
+    def new_data(self):
+        """ Returns a new data buffer, with the constant entries """
+        return self.template.copy()
+
+    def dense(self, data, out=None):
+        """ Scatters the data buffer into a dense matrix """
+        if out is None:
+            out = numpy.zeros((self.size, self.size))
+        out[self.rows, self.cols] = data
+        return out
+
+
+class CompiledBlock(object):
+    """ A block of equations within a compiled model.
+
+        Attributes:
+            simultaneous: False if the equations can be evaluated
+                once, in order.  True if the block has to be
+                iterated until it converges.
+            equations: The positions of the equations in the block.
+            variables: The positions (in the state vector) of the
+                variables solved by the block.
+            step: Performs a single Gauss-Seidel sweep of the block.
+            residual: Returns the residuals of the block equations
+                (only for simultaneous blocks).
+            jacobian: The CompiledJacobian of the residuals (only for
+                simultaneous blocks).
+    """
+    def __init__(self, name, simultaneous, equations, variables,
+                 jacobian=None):
+        # pylint: disable=too-many-arguments
+        self.name = name
+        self.simultaneous = simultaneous
+        self.equations = equations
+        self.variables = variables
+        self.jacobian = jacobian
+        self.step = None
+        self.residual = None
+
+    def __getstate__(self):
+        """ The generated functions are linked again when the
+            CompiledModel is unpickled.
+        """
+        state = self.__dict__.copy()
+        state['step'] = None
+        state['residual'] = None
+        return state
+
+    def _link(self, namespace):
+        """ Looks up the generated functions for this block """
+        # pylint: disable=protected-access
+        self.step = namespace[self.name]
+        if self.simultaneous:
+            self.residual = namespace[self.name + '_residual']
+            self.jacobian._link(namespace)
+
+
+class CompiledModel(object):
+    """ This class contains the compiled form of a model.
+
+        Rather than calling a lambdified function per equation, the
+        whole model is generated as python code that reads and writes
+        a flat state vector by position.  The state vector uses the
+        same ordering as the model's argument list.
+
+        A CompiledModel can be pickled, only the generated source is
+        stored and it is compiled again when unpickled.
+
+        Attributes:
+            names: The symbol names, in state vector order.
+            index: A dict of name -> position in the state vector.
+            source: The generated python source code.
+            step: A function that performs a single Gauss-Seidel
+                sweep, in equation order, updating the state
+                vector in place.
+            variables: The positions (in the state vector) of the
+                variables, in the order of the model's variables.
+            residual: A function that returns the list of residuals
+                (var - expr), in the order of the model's variables.
+            jacobian: The CompiledJacobian of the residuals, the
+                rows/columns are in the order of the model's variables.
+            blocks: The list of CompiledBlocks, in evaluation order.
+                Consecutive equations that do not need to be
+                iterated are merged into a single block.
+    """
+    def __init__(self, names, source, line_map, variables, jacobian, blocks):
+        # pylint: disable=too-many-arguments
+        self.names = names
+        self.index = {name: i for i, name in enumerate(names)}
+        self.source = source
+        self.variables = variables
+        self.jacobian = jacobian
+        self.blocks = blocks
+        self.step = None
+        self.residual = None
+
+        self._line_map = line_map
+        self._link()
+
+    def __getstate__(self):
+        """ Only the generated source is pickled, the functions
+            are compiled again when unpickled.
+        """
+        state = self.__dict__.copy()
+        state['step'] = None
+        state['residual'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._link()
+
+    def _link(self):
+        """ Compiles the generated source into functions """
+        # pylint: disable=protected-access
+        namespace = {'math': math, 'numpy': numpy, 'functools': functools}
+        exec(compile(self.source, _FILENAME, 'exec'), namespace)
+        self.step = namespace['step']
+        self.residual = namespace['residual']
+        self.jacobian._link(namespace)
+        for block in self.blocks:
+            block._link(namespace)
+
+    def find_equation(self, err):
+        """ Returns the position of the equation that raised the
+            error (from within the generated code), or None if
+            it cannot be determined.
+        """
+        lineno = None
+        trace = err.__traceback__
+        while trace is not None:
+            if trace.tb_frame.f_code.co_filename == _FILENAME:
+                lineno = trace.tb_lineno
+            trace = trace.tb_next
+        return self._line_map.get(lineno)
+
+
+def _merge_blocks(decomposition):
+    """ Merges consecutive blocks that do not need to be iterated,
+        so that they are evaluated by a single function call.
+    """
+    merged = []
+    for simultaneous, positions in decomposition:
+        if (not simultaneous and merged and not merged[-1][0]):
+            merged[-1][1].extend(positions)
+        else:
+            merged.append((simultaneous, list(positions)))
+    return merged
+
+
+def _emit_model(writer, model, equations, index, printer, copy=False):
+    """ Generates the step, residual and jacobian functions for
+        all of the equations of the model.
+
+        Returns: the CompiledJacobian
+    """
+    # pylint: disable=too-many-arguments
+    _emit_step(writer, 'step', equations, range(len(equations)),
+               index, printer, copy=copy)
+
+    # The residuals and the jacobian use the order of the variables
+    order = {eqn.variable.name: i for i, eqn in enumerate(equations)}
+    positions = [order[name] for name in model.variables]
+    ordered = [equations[i] for i in positions]
+    _emit_residual(writer, 'residual', ordered, positions, index, printer)
+    return _emit_jacobian(writer, 'jacobian', ordered, positions,
+                          index, printer)
+
+
+def compile_model(model):
+    """ Generates the compiled form of the model.
+
+        Arguments:
+            model: The model to compile.  The argument list of the
+                model must have been built, this determines the
+                layout of the state vector.
+
+        Returns: a CompiledModel
+
+        Raises:
+            EquationError
+    """
+    # pylint: disable=protected-access
+    names = [x.name for x in model._arg_list]
+    index = {name: i for i, name in enumerate(names)}
+    printer = _ScalarPrinter({name: _local_name(i)
+                              for name, i in index.items()})
+    equations = model.equations
+
+    writer = _SourceWriter()
+    jacobian = _emit_model(writer, model, equations, index, printer)
+
+    blocks = []
+    for simultaneous, positions in _merge_blocks(
+            block_decomposition(equations)):
+        name = 'block{0}'.format(len(blocks))
+        block_eqns = [equations[i] for i in positions]
+        _emit_step(writer, name, block_eqns, positions, index, printer)
+        block_jacobian = None
+        if simultaneous:
+            _emit_residual(writer, name + '_residual',
+                           block_eqns, positions, index, printer)
+            block_jacobian = _emit_jacobian(writer, name + '_jacobian',
+                                            block_eqns, positions,
+                                            index, printer)
+        blocks.append(CompiledBlock(
+            name, simultaneous, positions,
+            [index[eqn.variable.name] for eqn in block_eqns],
+            block_jacobian))
+
+    return CompiledModel(names, writer.source(), writer.line_map,
+                         [index[name] for name in model.variables],
+                         jacobian, blocks)
+
+
+def compile_batch(model):
+    """ Generates the vectorized form of the model, used to solve
+        many scenarios at once.
+
+        The functions have the same layout as the compiled model,
+        but each position of the state is a row (of one value per
+        scenario), and the equations are evaluated with numpy on
+        the whole row.  The model is not split into blocks.
+
+        Arguments:
+            model: The model to compile (see compile_model()).
+
+        Returns: a CompiledModel, whose functions work on a 2-D
+            (state x scenarios) array.
+
+        Raises:
+            EquationError
+    """
+    # pylint: disable=protected-access
+    names = [x.name for x in model._arg_list]
+    index = {name: i for i, name in enumerate(names)}
+    printer = _VectorPrinter({name: _local_name(i)
+                              for name, i in index.items()})
+    equations = model.equations
+
+    # the rows of the variables are copied, the loaded values must
+    # not change when the state is updated
+    writer = _SourceWriter()
+    jacobian = _emit_model(writer, model, model.equations, index, printer,
+                           copy=True)
+
+    return CompiledModel(names, writer.source(), writer.line_map,
+                         [index[name] for name in model.variables],
+                         jacobian, [])
+
+
+class _StationaryEquation(object):
+    """ An equation whose previous values have been replaced by the
+        current values, see compile_steady_state()
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, equation, replacements):
+        self.equation = equation.equation
+        self.variable = equation.variable
+        self.expr = equation.expr.xreplace(replacements)
+
+
+def compile_steady_state(model):
+    """ Generates the stationary form of the model, where the values
+        of the previous periods (such as x(-1), and thus d(x)) are
+        replaced by the current values.  A solution of this model is
+        the same in every period.
+
+        Arguments:
+            model: The model to compile (see compile_model()).
+
+        Returns: a CompiledModel, with the same state vector layout
+            as the compiled model (the positions of the previous
+            values are not used).  The model is not split into blocks.
+
+        Raises:
+            EquationError
+    """
+    # pylint: disable=protected-access
+    names = [x.name for x in model._arg_list]
+    index = {name: i for i, name in enumerate(names)}
+    printer = _ScalarPrinter({name: _local_name(i)
+                              for name, i in index.items()})
+    replacements = {param: param.variable
+                    for param in model._private_parameters.values()}
+    equations = [_StationaryEquation(equation, replacements)
+                 for equation in model.equations]
+
+    writer = _SourceWriter()
+    jacobian = _emit_model(writer, model, equations, index, printer)
+
+    return CompiledModel(names, writer.source(), writer.line_map,
+                         [index[name] for name in model.variables],
+                         jacobian, [])
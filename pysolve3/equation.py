@@ -5,9 +5,9 @@
 
 """
 
-import re
+import io
+import tokenize
 
-from sympy.parsing.sympy_parser import parse_expr
 from sympy.parsing.sympy_parser import factorial_notation, auto_number
 
 
@@ -30,6 +30,35 @@ class EquationError(ValueError):
         return self.text
 
 
+# The tokens that are not part of the expression
+_SKIPPED_TOKENS = (tokenize.NEWLINE, tokenize.NL, tokenize.ENDMARKER,
+                   tokenize.INDENT, tokenize.DEDENT, tokenize.COMMENT)
+
+
+def _tokenize(text):
+    """ Returns the python tokens of the text, as (type, string,
+        start, end) tuples, without the end of line/file tokens.
+
+        Raises:
+            EquationError: if the text cannot be tokenized
+    """
+    try:
+        return [tok[:4] for tok in
+                tokenize.generate_tokens(io.StringIO(text).readline)
+                if tok[0] not in _SKIPPED_TOKENS]
+    except (tokenize.TokenError, SyntaxError) as err:
+        raise EquationError('syntax', text, str(err))
+
+
+def _series_calls(tokens, variables, parameters):
+    """ Returns the positions of the tokens that call a variable or
+        parameter, such as x(-1).
+    """
+    return [i for i in range(len(tokens) - 1)
+            if tokens[i][0] == tokenize.NAME and tokens[i + 1][1] == '(' and
+            (tokens[i][1] in variables or tokens[i][1] in parameters)]
+
+
 def _rewrite(variables, parameters, equation):
     """ Internal function that will do some preprocessing of the equation
         expression.
@@ -38,22 +67,95 @@ def _rewrite(variables, parameters, equation):
             'x(-t)' -> '_series_acc(x, _iter-t)'
             We translate this into a function so that we can evaluate
             the parameter symbolically before the call.
-    """
-    new_equation = equation
 
-    # If variables are being called like functions, treat them
-    # as if we are trying to access the time series data.
-    for var in variables.keys():
-        new_equation = re.sub(r"\b{0}\(".format(var),
-                              "_series_acc({0},".format(var),
-                              new_equation)
+        The calls are found with a single pass over the tokens of
+        the equation (rather than a search for each name).
+    """
+    tokens = _tokenize(equation)
+    lines = equation.splitlines(True)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+
+    parts = []
+    position = 0
+    for i in _series_calls(tokens, variables, parameters):
+        start = offsets[tokens[i][2][0] - 1] + tokens[i][2][1]
+        end = offsets[tokens[i + 1][3][0] - 1] + tokens[i + 1][3][1]
+        parts.append(equation[position:start])
+        parts.append('_series_acc({0},'.format(tokens[i][1]))
+        position = end
+    parts.append(equation[position:])
+    return ''.join(parts)
+
+
+# The globals used to evaluate the parsed expressions, this is the
+# same as the globals created by parse_expr() (for each call)
+_GLOBALS = None
+
+
+def _parse_globals():
+    """ Returns the globals used to evaluate the expressions """
+    # pylint: disable=global-statement, exec-used
+    global _GLOBALS
+    if _GLOBALS is None:
+        import builtins
+        import types
+        from sympy import Max, Min
+        context = {}
+        exec('from sympy import *', context)
+        for name, obj in vars(builtins).items():
+            if isinstance(obj, types.BuiltinFunctionType):
+                context[name] = obj
+        context['max'] = Max
+        context['min'] = Min
+        _GLOBALS = context
+    return _GLOBALS
+
+
+def _build_expr(tokens, calls, context):
+    """ Creates the sympy expression from the tokens, the tokens
+        at the positions in calls are series accessor calls.
+    """
+    # pylint: disable=eval-used
+    calls = set(calls)
+    pairs = []
+    skip = False
+    for i, tok in enumerate(tokens):
+        if skip:
+            skip = False
+        elif i in calls:
+            pairs.extend([(tokenize.NAME, '_series_acc'), (tokenize.OP, '('),
+                          (tokenize.NAME, tok[1]), (tokenize.OP, ',')])
+            skip = True
+        else:
+            pairs.append(tok[:2])
+    if not pairs:
+        raise SyntaxError('empty expression')
+
+    global_dict = _parse_globals()
+    for transform in (factorial_notation, auto_number):
+        pairs = transform(pairs, context, global_dict)
+    return eval(tokenize.untokenize(pairs), global_dict, context)
+
+
+def _parse_expression(text, variables, parameters, context):
+    """ Parses an expression (without an equals sign) into a sympy
+        expression.
 
-    for param in parameters.keys():
-        new_equation = re.sub(r"\b{0}\(".format(param),
-                              "_series_acc({0},".format(param),
-                              new_equation)
+        Arguments:
+            text: The expression.
+            variables: The variables of the model, calls of these,
+                such as x(-1), access the values of other periods.
+            parameters: The parameters of the model.
+            context: The dictionary of name-symbol pairs.
 
-    return new_equation
+        Returns: a sympy expression
+    """
+    tokens = _tokenize(text)
+    return _build_expr(tokens,
+                       _series_calls(tokens, variables, parameters),
+                       context)
 
 
 def _is_linear(expr, var):
@@ -116,26 +218,32 @@ class Equation(object):
             Raises:
                 EquationError
         """
-        variables = self.model.variables
-        parameters = self.model.parameters
-
-        # Rewrite the equation into canonical form
-        equation = _rewrite(variables, parameters, self.equation)
+        tokens = _tokenize(self.equation)
 
-        # Find the location of the equal sign, also need to ignore
-        # things like <=, >=, ==, !=, etc...
-        sides = re.split(r"(?<![<>=!])=(?!=)", equation)
-        if len(sides) != 2:
+        # Find the location of the equal sign, the tokenizer keeps
+        # things like <=, >=, ==, !=, etc... as separate tokens
+        equals = [i for i, tok in enumerate(tokens)
+                  if tok[0] == tokenize.OP and tok[1] == '=']
+        if len(equals) != 1:
             raise EquationError('equals-sign',
                                 self.equation,
                                 "Equation must be of the form f(...) = g(...)")
 
-        transforms = (factorial_notation, auto_number)
+        # Variables called as functions, such as x(-1), access
+        # the values of previous iterations
+        calls = _series_calls(tokens,
+                              self.model.variables,
+                              self.model.parameters)
+        split = equals[0]
 
         # need to examine the left-hand side
-        rhs = parse_expr(sides[1], context, transformations=transforms)
+        rhs = _build_expr(tokens[split + 1:],
+                          [i - split - 1 for i in calls if i > split],
+                          context)
 
-        lhs = parse_expr(sides[0], context, transformations=transforms)
+        lhs = _build_expr(tokens[:split],
+                          [i for i in calls if i < split],
+                          context)
         lhs = lhs.expand()
 
         # Determine how to isolate the variable by addition/division
@@ -146,7 +254,8 @@ class Equation(object):
                                 self.equation,
                                 'the main variable is not linear')
 
-        if variable is not None and variable.equation is not None:
+        if (variable is not None and variable.equation is not None and
+                variable.equation is not self):
             raise EquationError('var-eqn-exists',
                                 self.equation,
                                 'equation for variable already defined : ' +
@@ -0,0 +1,115 @@
+""" Contains the functions used to analyze the structure of a model.
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+
+def dependency_graph(equations):
+    """ Builds the dependency graph of the equations.
+
+        Arguments:
+            equations: The list of equations.
+
+        Returns: a list, where entry i is the sorted list of the
+            positions of the equations that equation i depends on
+            (that is the equations that define a variable used on
+            the right-hand side of equation i).  Lagged values are
+            parameters and do not create a dependency.
+    """
+    defined_by = {eqn.variable.name: i for i, eqn in enumerate(equations)}
+    graph = []
+    for equation in equations:
+        edges = set()
+        for atom in equation.expr.atoms():
+            if atom.is_Symbol and atom.name in defined_by:
+                edges.add(defined_by[atom.name])
+        graph.append(sorted(edges))
+    return graph
+
+
+def strongly_connected_components(graph):
+    """ Finds the strongly connected components of a graph, using
+        Tarjan's algorithm.  This is implemented without recursion
+        so that large models do not hit the recursion limit.
+
+        Arguments:
+            graph: A list, where entry i is the list of nodes that
+                node i has an edge to.
+
+        Returns: a list of components (each a sorted list of nodes).
+            A component is returned only after all of the components
+            that it has an edge to, thus if the edges point to the
+            dependencies, this is the evaluation order.
+    """
+    # pylint: disable=too-many-locals
+    index = [None] * len(graph)
+    lowlink = [0] * len(graph)
+    on_stack = [False] * len(graph)
+    stack = []
+    components = []
+    counter = 0
+
+    for root in range(len(graph)):
+        if index[root] is not None:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, edge = work.pop()
+            if edge == 0:
+                index[node] = lowlink[node] = counter
+                counter += 1
+                stack.append(node)
+                on_stack[node] = True
+            if edge > 0:
+                child = graph[node][edge - 1]
+                lowlink[node] = min(lowlink[node], lowlink[child])
+
+            recurse = False
+            for i in range(edge, len(graph[node])):
+                child = graph[node][i]
+                if index[child] is None:
+                    work.append((node, i + 1))
+                    work.append((child, 0))
+                    recurse = True
+                    break
+                elif on_stack[child]:
+                    lowlink[node] = min(lowlink[node], index[child])
+            if recurse:
+                continue
+
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(sorted(component))
+    return components
+
+
+def block_decomposition(equations):
+    """ Splits the equations into blocks that can be solved
+        one after the other.
+
+        Arguments:
+            equations: The list of equations.
+
+        Returns: a list of (simultaneous, positions) tuples, in
+            evaluation order.  positions are the positions of the
+            equations in the block (kept in their original order).
+            If simultaneous is False, the block is a single equation
+            that only depends on values from earlier blocks and can
+            be evaluated once.  Otherwise the block has to be
+            iterated until it converges.
+    """
+    graph = dependency_graph(equations)
+    blocks = []
+    for component in strongly_connected_components(graph):
+        simultaneous = (len(component) > 1 or
+                        component[0] in graph[component[0]])
+        blocks.append((simultaneous, component))
+    return blocks
@@ -0,0 +1,427 @@
+""" Contains the SolutionHistory class.
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+import collections
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import numpy
+
+
+class SolutionView(Mapping):
+    """ A read-only view of the solution of a single period.
+
+        This behaves as the dict of name -> value that used to be
+        stored for each period.  A symbol that did not exist yet
+        in that period is not part of the view.
+    """
+    __slots__ = ('_history', '_row')
+
+    def __init__(self, history, row):
+        self._history = history
+        self._row = row
+
+    def __getitem__(self, name):
+        # pylint: disable=protected-access
+        history = self._history
+        col = history._index.get(name)
+        if col is None or self._row < history._first[col]:
+            raise KeyError(name)
+        return history._data[self._row, col]
+
+    def __iter__(self):
+        # pylint: disable=protected-access
+        history = self._history
+        for name, col in history._index.items():
+            if self._row >= history._first[col]:
+                yield name
+
+    def __len__(self):
+        # pylint: disable=protected-access
+        return sum(1 for first in self._history._first if self._row >= first)
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def copy(self):
+        """ Returns the solution as a new dict() """
+        return dict(self.items())
+
+
+class SolutionHistory(object):
+    """ Stores the solutions of the model, one row per period.
+
+        The values are stored in a single 2-D float64 array
+        (periods x symbols) that is grown as needed, with a
+        name -> column index.  Indexing the history returns a
+        read-only SolutionView of that period, so existing code
+        such as solutions[-1]['Y'] still works.
+
+        Attributes:
+            names: The names of the columns.
+            array: A view of the filled part of the array.
+    """
+    def __init__(self, names=None, capacity=64):
+        self._index = collections.OrderedDict()
+        self._first = []
+        self._size = 0
+        self._data = numpy.empty((capacity, max(len(names or []), 8)))
+        for name in names or []:
+            self._add_column(name)
+
+    @classmethod
+    def from_list(cls, solutions):
+        """ Creates a history from a list of dicts """
+        history = cls(capacity=max(len(solutions), 64))
+        for solution in solutions:
+            history.append(solution)
+        return history
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [SolutionView(self, row)
+                    for row in range(*key.indices(self._size))]
+        return SolutionView(self, self._row(key))
+
+    def __iter__(self):
+        for row in range(self._size):
+            yield SolutionView(self, row)
+
+    def _row(self, iteration):
+        """ Converts a +/- iteration into a row number
+
+            Raises:
+                IndexError: if the iteration is out of range
+        """
+        row = iteration + self._size if iteration < 0 else iteration
+        if row < 0 or row >= self._size:
+            raise IndexError('solution index out of range')
+        return row
+
+    def _grow(self, rows, cols):
+        """ Makes sure that the array can hold rows x cols values """
+        capacity, width = self._data.shape
+        if rows <= capacity and cols <= width:
+            return
+        while capacity < rows:
+            capacity *= 2
+        while width < cols:
+            width *= 2
+        # copy the row being appended as well
+        filled = min(self._size + 1, self._data.shape[0])
+        data = numpy.empty((capacity, width))
+        data[:filled, :len(self._index)] = \
+            self._data[:filled, :len(self._index)]
+        self._data = data
+
+    def _add_column(self, name):
+        """ Adds a column, the symbol exists from the next period on """
+        col = len(self._index)
+        self._grow(self._size + 1, col + 1)
+        self._index[name] = col
+        self._first.append(self._size)
+        self._data[:self._size, col] = numpy.nan
+        return col
+
+    @property
+    def names(self):
+        """ The names of the columns """
+        return list(self._index.keys())
+
+    @property
+    def array(self):
+        """ A (periods x symbols) view of the stored values """
+        return self._data[:self._size, :len(self._index)]
+
+    def columns(self, names):
+        """ Returns the columns of the names (as an array), the
+            columns are added if needed.
+        """
+        return numpy.array([self._index[name] if name in self._index
+                            else self._add_column(name) for name in names],
+                           dtype=numpy.intp)
+
+    def append_row(self, values, columns):
+        """ Adds the solution of a period, given as a sequence of
+            values for the columns (see columns()).  The other
+            columns are set to NaN.
+        """
+        self._grow(self._size + 1, len(self._index))
+        row = self._data[self._size, :len(self._index)]
+        if len(columns) != len(row):
+            row[:] = numpy.nan
+        row[columns] = values
+        self._size += 1
+
+    def append(self, solution):
+        """ Adds the solution of a period
+
+            Arguments:
+                solution: A dict (or mapping) of name -> value.  New
+                    names are added as new columns.
+        """
+        self._grow(self._size + 1, len(self._index))
+        self._data[self._size, :len(self._index)] = numpy.nan
+        for name, value in solution.items():
+            col = self._index.get(name)
+            if col is None:
+                col = self._add_column(name)
+            self._data[self._size, col] = value
+        self._size += 1
+
+    def value(self, name, iteration):
+        """ Returns the value of name for the iteration (+/-)
+
+            Raises:
+                IndexError: if the iteration is out of range
+                KeyError: if name is not part of that solution
+        """
+        row = self._row(iteration)
+        col = self._index.get(name)
+        if col is None or row < self._first[col]:
+            raise KeyError(name)
+        return float(self._data[row, col])
+
+    def column(self, name):
+        """ Returns the values of name for all periods.
+
+            This is a view of the underlying array (no copy), it
+            is not updated as new periods are added.
+
+            Raises:
+                KeyError: if name is not a column
+        """
+        return self._data[:self._size, self._index[name]]
+
+    def tail(self, count):
+        """ Returns a new history with (a copy of) the last count
+            periods
+        """
+        # pylint: disable=protected-access
+        start = max(self._size - count, 0)
+        history = SolutionHistory()
+        history._index = collections.OrderedDict(self._index)
+        history._first = [max(first - start, 0) for first in self._first]
+        history._size = self._size - start
+        history._data = numpy.empty((max(history._size, 8),
+                                     self._data.shape[1]))
+        history._data[:history._size] = self._data[start:self._size]
+        return history
+
+    def to_frame(self):
+        """ Returns the history as a pandas DataFrame """
+        import pandas as pd
+        return pd.DataFrame(self.array, columns=self.names)
+
+
+class LagTable(object):
+    """ The values of the lagged (and fixed iteration) parameters,
+        such as x(-1) or x(5).
+
+        Each parameter is an entry of (source column, offset) in the
+        history.  The values of all of the parameters for the next
+        period are read from the history array with a single gather,
+        rather than looking up each parameter separately.
+
+        Attributes:
+            params: The SeriesParameters, in table order.
+    """
+    def __init__(self, params):
+        self.params = list(params)
+        self._names = [param.variable.name for param in self.params]
+        self._offsets = numpy.array([param.iteration for param in self.params],
+                                    dtype=numpy.intp)
+        self._relative = self._offsets < 0
+        self._history = None
+        self._width = 0
+        self._columns = None
+        self._firsts = None
+
+    def __len__(self):
+        return len(self.params)
+
+    def _resolve(self, history):
+        """ Maps the names to the history columns, this only needs to
+            be done again if columns have been added.
+        """
+        # pylint: disable=protected-access
+        if history is self._history and len(history._index) == self._width:
+            return
+        self._columns = numpy.array(
+            [history._index.get(name, -1) for name in self._names],
+            dtype=numpy.intp)
+        self._firsts = numpy.array(
+            [history._first[col] if col >= 0 else 0
+             for col in self._columns],
+            dtype=numpy.intp)
+        self._history = history
+        self._width = len(history._index)
+
+    def gather(self, history):
+        """ Returns the values of the parameters for the period that
+            follows the last period of the history.
+
+            If the iteration is out of range, the variable's value
+            (or default) is used, as with SeriesParameter.value.
+
+            Returns: a list of values (None if there is no value)
+
+            Raises:
+                KeyError: if the variable is not part of the solution
+                    of that iteration
+        """
+        # pylint: disable=protected-access
+        if not self.params:
+            return []
+        self._resolve(history)
+        size = len(history)
+        rows = numpy.where(self._relative, self._offsets + size, self._offsets)
+        valid = (rows >= 0) & (rows < size)
+
+        missing = valid & ((self._columns < 0) | (rows < self._firsts))
+        if missing.any():
+            raise KeyError(self._names[int(numpy.argmax(missing))])
+
+        values = numpy.empty(len(self.params))
+        values[valid] = history._data[rows[valid], self._columns[valid]]
+        values = values.tolist()
+        if not valid.all():
+            for i in numpy.flatnonzero(~valid):
+                variable = self.params[i].variable
+                values[i] = variable.value or variable.default
+        return values
+
+
+def _value_or_default(value, default):
+    """ Returns value, or default where value is 0 (or None), as
+        with SeriesParameter.value.
+    """
+    if not isinstance(value, numpy.ndarray):
+        return value or default
+    if default is None:
+        return value
+    return numpy.where(value != 0, value, default)
+
+
+class LagBuffer(object):
+    """ Fills the lagged parameters while simulating.
+
+        The last periods of the state are kept in a ring buffer, so
+        that the values of the lagged parameters can be copied into
+        the state with a single gather, instead of being read from
+        a SolutionHistory.  This does not need the full history of
+        the simulation.
+
+        The state is either a list, or a 2-D (state x scenarios)
+        array when simulating many scenarios at once.
+
+        Arguments:
+            table: The LagTable of the model.
+            history: The solutions before the simulation.
+            size: The size of the state vector.
+            scenarios: The number of scenarios, if the state is
+                a 2-D array.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, table, history, size, scenarios=None):
+        params = [param for param in table.params if param._index is not None]
+        self._params = params
+        self._history = history
+        self._targets = numpy.array([param._index for param in params],
+                                    dtype=numpy.intp)
+        self._sources = numpy.array([param.variable._index for param in params],
+                                    dtype=numpy.intp)
+        self._offsets = numpy.array([param.iteration for param in params],
+                                    dtype=numpy.intp)
+        relative = self._offsets < 0
+        self.depth = int(-self._offsets[relative].min()) if relative.any() else 1
+        self._relative = numpy.flatnonzero(relative)
+        self._absolute = numpy.flatnonzero(~relative).tolist()
+        self._fixed = {}
+        self._start = len(history)
+        self._period = 0
+        if scenarios is None:
+            self._ring = numpy.empty((self.depth, size))
+        else:
+            self._ring = numpy.empty((self.depth, size, scenarios))
+
+    def fill(self, state):
+        """ Returns the state with the lagged parameters set to
+            their values for the next period.  A 2-D state is
+            updated in place.
+
+            Raises:
+                KeyError: if the variable is not part of the solution
+                    of that iteration
+        """
+        if not self._params:
+            return state
+        if self._period < self.depth:
+            # the ring buffer does not hold enough periods yet
+            return self._fill_each(state, range(len(self._params)))
+        if len(self._relative):
+            period = self._start + self._period
+            values = state if isinstance(state, numpy.ndarray) \
+                else numpy.array(state)
+            values[self._targets[self._relative]] = self._ring[
+                (self._offsets[self._relative] + period) % self.depth,
+                self._sources[self._relative]]
+            if values is not state:
+                state = values.tolist()
+        return self._fill_each(state, self._absolute)
+
+    def _fill_each(self, state, positions):
+        """ Looks up the values of the parameters at positions one
+            at a time.
+        """
+        # pylint: disable=protected-access
+        period = self._start + self._period
+        for i in positions:
+            param = self._params[i]
+            offset = int(self._offsets[i])
+            row = period + offset if offset < 0 else offset
+            if self._start <= row < period:
+                if offset < 0:
+                    value = self._ring[row % self.depth, self._sources[i]]
+                else:
+                    value = self._fixed[i]
+            elif 0 <= row < period:
+                value = self._history.value(param.variable.name, row)
+            else:
+                value = _value_or_default(state[param.variable._index],
+                                          param.variable.default)
+            if value is None:
+                continue
+            if isinstance(state, numpy.ndarray):
+                state[param._index] = value
+            else:
+                state[param._index] = float(value)
+        return state
+
+    def push(self, state):
+        """ Stores the solution of a period """
+        period = self._start + self._period
+        self._ring[period % self.depth] = state
+        for i in self._absolute:
+            if self._offsets[i] == period:
+                self._fixed[i] = numpy.copy(state[self._sources[i]])
+        self._period += 1
+
+    def last(self):
+        """ Returns the states of the last periods (up to depth), in
+            order, as a 2-D array.
+        """
+        count = min(self._period, self.depth)
+        end = self._start + self._period
+        return self._ring[[row % self.depth
+                           for row in range(end - count, end)]]
@@ -6,23 +6,26 @@
 """
 
 import collections
+import copy
 
 import numpy
 from builtins import range
 
-import sympy as sp
 from sympy import sympify 
-from sympy import Symbol, Function
-from sympy.core.cache import clear_cache
-from sympy.parsing.sympy_parser import parse_expr
-from sympy.parsing.sympy_parser import factorial_notation, auto_number
-from sympy.utilities import lambdify
-from sympy.utilities.lambdify import implemented_function
-from sympy.stats import sample
-
-from pysolve3.equation import Equation, EquationError, _rewrite
-from pysolve3.parameter import Parameter, SeriesParameter
-from pysolve3.utils import is_aclose
+from sympy import S, Symbol, Function
+
+from pysolve3 import cache
+from pysolve3.batch import run_batch
+from pysolve3.compiler import compile_batch, compile_model
+from pysolve3.compiler import compile_steady_state, _derivatives
+from pysolve3.equation import Equation, EquationError
+from pysolve3.equation import _parse_expression
+from pysolve3.graph import block_decomposition
+from pysolve3.history import LagBuffer, LagTable, SolutionHistory
+from pysolve3.parameter import Parameter, RandomParameter, SeriesParameter
+from pysolve3.spec import _equation_line, read_spec
+from pysolve3.telemetry import _timed
+from pysolve3.utils import Convergence
 from pysolve3.variable import ModVariable
 
 
@@ -55,6 +58,8 @@ class CalculationError(Exception):
         self.context = context
 
     def __str__(self):
+        if self.equation is None:
+            return str(self.inner)
         return str(self.inner) + ' : ' + str(self.equation.equation)
 
 
@@ -154,26 +159,54 @@ class _IfTrueNoEvalFunction(Function):
         """
         return 0
 
+    def _eval_derivative(self, symbol):
+        """ The derivative is 0 (see fdiff()), the argument is a
+            condition (such as x > y) that cannot be differentiated.
+        """
+        return S.Zero
+
     @classmethod
     def eval(cls, *args):
         """ Called during evaluation, but this one does nothing """
         pass
 
+# The names of sympy.stats that are available from this module,
+# sympy.stats is only imported when one of them is used
+_STATS_NAMES = ('Normal', 'Poisson', 'Exponential', 'Pareto', 'density',
+                'sample', 'StudentT')
+
+
+def _stats_function(name):
+    """ Returns a function that calls sympy.stats.name, importing
+        sympy.stats only when it is called.
+    """
+    def _call(*args, **kwargs):
+        import sympy.stats
+        return getattr(sympy.stats, name)(*args, **kwargs)
+    _call.__name__ = name
+    return _call
+
+
+def __getattr__(name):
+    """ Imports the sympy.stats names on first use """
+    if name in _STATS_NAMES:
+        import sympy.stats
+        return getattr(sympy.stats, name)
+    raise AttributeError(
+        "module {0!r} has no attribute {1!r}".format(__name__, name))
+
 # Functions defined and used at parse time
 _PARSE_FUNCS = [('_series_acc', _SeriesAccessor),
                 ('d', _deltaFunction),
                 ('if_true', _IfTrueNoEvalFunction),
-		('normal', numpy.random.normal),
-		('randint', numpy.random.randint),
-		('Normal', sp.stats.Normal),
-		('sample', sp.stats.sample),]
+		('Normal', _stats_function('Normal')),
+		('sample', _stats_function('sample')),]
 
 # Functions used at runtime
 _RT_FUNCS = [('if_true', _IfTrueFunction, _IfTrueNoEvalFunction), ]
 
 # Built-in funcs, supported by sympy
 from sympy import exp, log, Abs, Min, Max, sign, sqrt, sin, cos
-from sympy.stats import Normal, Poisson, Exponential, Pareto, density, sample, StudentT
 _BUILTIN_FUNCS = [('exp', exp),
                   ('log', log),
                   ('abs', Abs),
@@ -185,6 +218,10 @@ _BUILTIN_FUNCS = [('exp', exp),
                   ('cos', cos),
                   ]
 
+# Solver methods that solve the model block by block
+_BLOCK_METHODS = ('block-gauss-seidel', 'block-newton')
+
+
 def _add_functions(context):
     """ Adds our builtin functions.
     """
@@ -198,10 +235,9 @@ def _build_jacobian(model):
     nvars = len(model.variables.values())
     for var_i in model.variables.values():
         row_i = [None] * nvars
-        for atom in var_i.equation.expr.atoms():
-            if atom.is_Symbol and atom.name in model.variables:
-                expr = var_i - var_i.equation.expr
-                row_i[atom._index] = model._lambdify(expr.diff(atom))
+        derivatives = _derivatives(var_i.equation.expr, model.variables)
+        for atom, derivative in derivatives.items():
+            row_i[atom._index] = model._lambdify(-derivative)
 
         # add the partial derivative with respect to its own equation
         # We store the equations as var_i = expr
@@ -241,27 +277,318 @@ def _evaluate_jacobian(model, jacobian, current):
     return J
 
 
+def _calculation_error(model, compiled, err, context):
+    """ Creates the CalculationError for an error raised from
+        within the code of the compiled model.
+    """
+    position = compiled.find_equation(err)
+    equation = None
+    if position is not None:
+        equation = model.equations[position]
+    return CalculationError(err, equation, context)
+
+
+def _evaluate_compiled_equations(model, compiled, context, current):
+    """ Evaluates the vector of equations at current, using the
+        compiled model
+    """
+    # pylint: disable=invalid-name
+    try:
+        F = numpy.array(compiled.residual(current))
+    except Exception as err:
+        raise _calculation_error(model, compiled, err, context)
+    return numpy.negative(F, out=F)
+
+
+def _evaluate_compiled_jacobian(model, compiled, context, current, data):
+    """ Evaluates the non-zero entries of the jacobian at current
+        into data, using the compiled model
+    """
+    try:
+        compiled.jacobian.fill(current, data)
+    except Exception as err:
+        raise _calculation_error(model, compiled, err, context)
+    return data
+
+
+def _csc_matrix(data, indices, indptr, size):
+    """ Creates a scipy.sparse.csc_matrix that uses the buffers """
+    from scipy.sparse import csc_matrix
+    return csc_matrix((data, indices, indptr), shape=(size, size))
+
+
+class _SparseJacobian(object):
+    """ The jacobian in compressed sparse column (CSC) format.
+
+        The sparsity pattern is determined once from the equations.
+        Entries whose derivative is a constant are filled in when
+        the pattern is built, only the remaining entries are
+        evaluated for each iteration.
+
+        The rows/columns are ordered as the model's variables.
+    """
+    def __init__(self, model):
+        positions = {name: i for i, name in enumerate(model.variables)}
+        entries = dict()
+        for row, var_i in enumerate(model.variables.values()):
+            expr = var_i - var_i.equation.expr
+            for atom in var_i.equation.expr.atoms():
+                if atom.is_Symbol and atom.name in model.variables:
+                    entries[(positions[atom.name], row)] = expr.diff(atom)
+            # see _build_jacobian(), df/dvar_i = 1
+            entries[(row, row)] = expr.diff(var_i)
+
+        keys = sorted(entries)
+        nvars = len(positions)
+        self.size = nvars
+        self.indices = numpy.array([row for _, row in keys], dtype=numpy.int32)
+        self.indptr = numpy.searchsorted(
+            [col for col, _ in keys], numpy.arange(nvars + 1)).astype(
+                numpy.int32)
+        self.data = numpy.zeros(len(keys))
+
+        self._funcs = []
+        for k, key in enumerate(keys):
+            if entries[key].is_number:
+                self.data[k] = float(entries[key])
+            else:
+                self._funcs.append((k, model._lambdify(entries[key])))
+
+    def evaluate(self, current):
+        """ Evaluates the non-constant entries at current
+
+            Returns: the jacobian as a scipy.sparse.csc_matrix
+        """
+        data = self.data
+        for k, func in self._funcs:
+            data[k] = func(*current)
+        return _csc_matrix(data, self.indices, self.indptr, self.size)
+
+
+class _SparseLU(object):
+    """ Solves sparse linear systems with a SuperLU factorization.
+
+        The fill-reducing column ordering (COLAMD) is computed on
+        the first factorization and then reused for later matrices
+        with the same sparsity pattern, so only the ordering step is
+        saved.  SuperLU does not expose its symbolic factorization,
+        so each factorization still repeats the symbolic analysis
+        (elimination tree and fill pattern) as well as the numeric
+        factorization.
+    """
+    def __init__(self):
+        self._order = None
+
+    def reset(self):
+        """ Forget the column ordering """
+        self._order = None
+
+    def factorize(self, matrix):
+        """ Factorizes the matrix
+
+            Returns: a function that returns x, given rhs, such
+                that matrix * x = rhs
+
+            Raises:
+                RuntimeError: if the matrix is singular
+        """
+        from scipy.sparse.linalg import splu
+
+        if self._order is None:
+            lu_factor = splu(matrix, permc_spec='COLAMD')
+            self._order = numpy.argsort(lu_factor.perm_c)
+            return lu_factor.solve
+
+        order = self._order
+        lu_factor = splu(matrix[:, order], permc_spec='NATURAL')
+
+        def _solve(rhs):
+            """ Solves the permuted system """
+            soln = numpy.empty_like(rhs)
+            soln[order] = lu_factor.solve(rhs)
+            return soln
+        return _solve
+
+    def solve(self, matrix, rhs):
+        """ Solves matrix * x = rhs
+
+            Raises:
+                RuntimeError: if the matrix is singular
+        """
+        return self.factorize(matrix)(rhs)
+
+
+def _dense_factorize(matrix):
+    """ Factorizes a dense matrix, uses the LU factorization from
+        scipy if it is available.  Otherwise each call solves the
+        linear equations with numpy.linalg.solve() (the matrix is
+        never inverted).
+
+        Returns: a function that returns x, given rhs, such
+            that matrix * x = rhs (or transpose(matrix) * x = rhs
+            if its trans argument is 1)
+
+        Raises:
+            numpy.linalg.LinAlgError: if the matrix is singular
+    """
+    if not numpy.all(numpy.isfinite(matrix)):
+        raise numpy.linalg.LinAlgError('jacobian is not finite')
+    try:
+        from scipy.linalg import get_lapack_funcs
+    except ImportError:
+        matrix = numpy.array(matrix)
+        return lambda rhs, trans=0: numpy.linalg.solve(
+            matrix.T if trans else matrix, rhs)
+
+    getrf, getrs = get_lapack_funcs(('getrf', 'getrs'), (matrix,))
+    lu_matrix, pivots, info = getrf(matrix)
+    if info != 0:
+        raise numpy.linalg.LinAlgError('Singular matrix')
+    # call LAPACK directly, scipy.linalg.lu_solve() adds a lot of
+    # overhead for the small systems that are typical here
+    return lambda rhs, trans=0: getrs(lu_matrix, pivots, rhs,
+                                      trans=trans)[0]
+
+
+def _steady_state_step(J, F):
+    """ Solves J * dx = F for the Newton step of steady_state(), J
+        may be a sparse matrix.  If J is singular (some variables are
+        not determined), the least squares solution is used, this does
+        not change the variables that are not determined.
+    """
+    # pylint: disable=invalid-name
+    try:
+        if isinstance(J, numpy.ndarray):
+            dx = numpy.linalg.solve(J, F)
+        else:
+            dx = _SparseLU().solve(J, F)
+        if numpy.all(numpy.isfinite(dx)):
+            return dx
+    except (numpy.linalg.LinAlgError, RuntimeError):
+        pass
+    if not isinstance(J, numpy.ndarray):
+        J = J.toarray()
+    return numpy.linalg.lstsq(J, F, rcond=None)[0]
+
+
 class BroydenSolver(object):
     """ Implements the Broyden method for solving nonlinear equations.
+
+        The first step is computed from an LU factorization of the
+        jacobian, after that the approximate inverse jacobian is
+        updated with each iteration (rank-one updates).  The
+        approximate inverse is never stored as a matrix, it is
+        represented by the factorization of the initial jacobian and
+        the update vectors.  The approximation is kept from one
+        period to the next.
+
+        By default all of the updates are kept, until there are as
+        many updates as variables (when they would take more memory
+        than a matrix), then the jacobian is evaluated and factorized
+        again.  If memory is set, only the last memory updates are
+        kept, and the jacobian is only evaluated again if the model
+        changes.
     """
+    # pylint: disable=too-many-instance-attributes
+
     def __init__(self, model):
         self.model = model
         self.jacobian = None
-        self.prev_d_inv = None
+        self.compiled = None
+        self.memory = None
+        self.carryover = True
         self.prev_d = None
+        self.telemetry = None
+        self._data = None
+        self._matrix = None
+        self._factor = None
+        self._updates = None
+
+    def setup(self, compiled=None, memory=None, carryover=True):
+        """ Perform any prep work
 
-    def setup(self):
-        """ Perform any prep work """
-        self.prev_d_inv = None
+            Arguments:
+                compiled: If set, the CompiledModel used to evaluate
+                    the equations and the jacobian.
+                memory: If set, use the limited-memory variant, that
+                    keeps only the last memory update vectors.
+                carryover: If True, the approximate inverse jacobian
+                    is kept from one period to the next.
+        """
+        if compiled is not self.compiled or memory != self.memory:
+            self.reset()
+        self.compiled = compiled
+        self.memory = memory
+        self.carryover = carryover
         self.prev_d = None
+        if not carryover:
+            self._clear_inverse()
         if self.jacobian is None:
-            self.jacobian = _build_jacobian(self.model)
+            if compiled is not None:
+                self.jacobian = compiled.jacobian
+                self._data = compiled.jacobian.new_data()
+                size = compiled.jacobian.size
+                self._matrix = numpy.zeros((size, size))
+            else:
+                self.jacobian = _build_jacobian(self.model)
 
     def reset(self):
         """ Clear any prep work """
         self.jacobian = None
-        self.prev_d_inv = None
+        self.compiled = None
         self.prev_d = None
+        self._data = None
+        self._matrix = None
+        self._clear_inverse()
+
+    def _clear_inverse(self):
+        """ Forget the approximate inverse jacobian """
+        self._factor = None
+        self._updates = None
+
+    def _evaluate_equations(self, context, current):
+        """ Evaluates the vector of equations at current """
+        if self.compiled is not None:
+            return _evaluate_compiled_equations(
+                self.model, self.compiled, context, current)
+        return _evaluate_equations_vector(self.model, context, current)
+
+    def _evaluate_jacobian(self, context, current):
+        """ Evaluates the (dense) jacobian at current """
+        if self.compiled is not None:
+            data = _evaluate_compiled_jacobian(
+                self.model, self.compiled, context, current, self._data)
+            return self.jacobian.dense(data, self._matrix)
+        return _evaluate_jacobian(self.model, self.jacobian, current)
+
+    def _initialize(self, context, current):
+        """ Factorizes the jacobian at current, this is the initial
+            approximate inverse jacobian.
+        """
+        # pylint: disable=invalid-name
+        J = _timed(self.telemetry, 'jacobian',
+                   self._evaluate_jacobian, context, current)
+        _timed(self.telemetry, 'linear', self._factorize, J)
+
+    def _factorize(self, J):
+        """ Sets the initial approximate inverse from the jacobian """
+        # pylint: disable=invalid-name
+        self._factor = _dense_factorize(J)
+        self._updates = collections.deque(maxlen=self.memory)
+
+    def _apply_inverse(self, vector):
+        """ Returns inv(D) * vector """
+        result = self._factor(vector)
+        for a_k, b_k in self._updates:
+            result += a_k * b_k.dot(vector)
+        return result
+
+    def _apply_inverse_t(self, vector):
+        """ Returns transpose(inv(D)) * vector """
+        result = self._factor(vector, trans=1)
+        for a_k, b_k in self._updates:
+            result += b_k * a_k.dot(vector)
+        return result
 
     def solve(self, context, current, next_soln):
         """ Performs a single iteration of the solver, generating a solution
@@ -274,10 +601,11 @@ class BroydenSolver(object):
             Raises:
                 CalculationError
         """
-        # pylint: disable=invalid-name, too-many-locals
+        # pylint: disable=invalid-name
 
         # Here's the algorithm
         #   http://www.math.usm.edu/lambers/mat419/lecture11.pdf
+        # with g(x) = x - f(x), the residuals of the equations
         # initial solution: x0
         # D[0] = J(x[0])
         # d[0] = - inv(D[0]) * g(x[0])
@@ -290,66 +618,153 @@ class BroydenSolver(object):
         #   d[k+1] = - inv(D[k+1])*g(x[k+1])
         #   x[k+2] = x[k+1] + d[k+1]
         #   k = k + 1
+        #
+        # The update is the rank-one matrix a[k] * b[k] with
+        #   a[k] = - u[k]/c[k],  b[k] = transpose(inv(D[k])) * d[k]
+        # The approximate inverse is carried into the next period,
+        # the first iteration of a period does not update it.
+        g1 = numpy.negative(_timed(self.telemetry, 'equations',
+                                   self._evaluate_equations,
+                                   context, current))
 
-        if self.prev_d is None:
-            g0 = _evaluate_equations_vector(self.model, context, current)
-            # D[0] = J(x[0])
-            D0 = _evaluate_jacobian(self.model, self.jacobian, current)
-
-            # d[0] = - inv(D[0]) * g(x[0])
-            D0inv = numpy.linalg.inv(D0)    # D0**-1
-            d0 = numpy.inner(D0inv.dot(g0), -1)  # - (D0**-1 * g0)
-
-            self.prev_d_inv = D0inv
-            self.prev_d = d0
-
-            dx = d0
-        else:
-            D0inv = self.prev_d_inv
-            d0 = self.prev_d
-            g1 = _evaluate_equations_vector(self.model, context, current)
-
-            #   u[k] = inv(D[k]) * g(x[k+1])
-            u0 = numpy.dot(D0inv, g1)       # D0inv * g1
-
-            #   c[k] = d[k] * (d[k] + u[k])
-            c0 = d0.dot(numpy.add(d0, u0))  # d0 * (d0 + u0)
-
-            #   inv(D[k+1]) = inv(D[k]) - (u[k] * d[k])*inv(D[k])/c[k]
-            D1inv = D0inv - (u0*d0.transpose())*D0inv/c0
-            term1 = numpy.dot(numpy.outer(u0, d0), D0inv)  # (u0*d0T)*D0inv
-            term1 = numpy.divide(term1, c0)
-            D1inv = numpy.subtract(D0inv, term1)
+        try:
+            if self._factor is None:
+                self._initialize(context, current)
+            d1 = _timed(self.telemetry, 'linear', self._step, g1)
+        except (numpy.linalg.LinAlgError, RuntimeError) as err:
+            raise CalculationError(err, None, context)
 
-            #   d[k+1] = - inv(D[k+1])*g(x[k+1])
-            d1 = numpy.inner(numpy.dot(D1inv, g1), -1)
+        self.prev_d = d1
 
-            self.prev_d_inv = D1inv
-            self.prev_d = d1
+        # d1 now contains x(n+1) - x(n), to get x(n+1) add back in x(n)
+        for i, var in enumerate(self.model.variables.values()):
+            next_soln[var._index] += float(d1[i])
 
-            dx = d1
+    def _step(self, g1):
+        """ Updates the approximate inverse jacobian
 
-        # dx now contains x(n+1) - x(n), to get x(n+1) add back in x(n)
-        for i, var in enumerate(self.model.variables.values()):
-            next_soln[var._index] += float(dx[i])
+            Returns: the step d1 (see solve())
+        """
+        # pylint: disable=invalid-name
+        u0 = self._apply_inverse(g1)
+        if self.prev_d is None:
+            return numpy.negative(u0)
+        d0 = self.prev_d
+        c0 = d0.dot(d0 + u0)
+        if c0 == 0:
+            return numpy.negative(u0)
+        a0 = numpy.divide(u0, -c0)
+        b0 = self._apply_inverse_t(d0)
+        self._updates.append((a0, b0))
+        if self.memory is None and len(self._updates) >= len(g1):
+            # the next iteration starts from the jacobian again
+            self._factor = None
+        # inv(D[k+1]) * g1 = u0 + a0 * (b0 * g1)
+        return numpy.negative(u0 + a0 * b0.dot(g1))
 
 
 class NewtonRaphsonSolver(object):
     """ Implements the Newton-Raphson method for solving a system of
         non-linear equations.
+
+        In the modified Newton mode, the factorization of the jacobian
+        is reused for later iterations (and periods), and is only
+        recomputed when the iterations stop contracting fast enough.
+
+        Attributes:
+            refactorizations: The number of times the jacobian has
+                been factorized in the modified Newton mode.
     """
+    # pylint: disable=too-many-instance-attributes
+
     def __init__(self, model):
         self.model = model
         self.jacobian = None
+        self.compiled = None
+        self.sparse = False
+        self.modified = False
+        self.contraction = 0.5
+        self.refactorizations = 0
+        self.telemetry = None
+        self._data = None
+        self._matrix = None
+        self._sparse_lu = _SparseLU()
+        self._factor = None
+        self._prev_norm = None
+
+    def setup(self, compiled=None, sparse=False, modified=False,
+              contraction=0.5):
+        """ Perform any prepatory work before solving
 
-    def setup(self):
-        """ Perform any prepatory work before solving """
+            Arguments:
+                compiled: If set, the CompiledModel used to evaluate
+                    the equations and the jacobian.
+                sparse: If True, the jacobian is stored as a sparse
+                    matrix and the linear equations are solved with
+                    a sparse LU factorization (requires scipy).  Only
+                    the column ordering is reused (see _SparseLU), to
+                    reuse the factorization set modified.
+                modified: If True, use the modified Newton method,
+                    the factorization of the jacobian is kept across
+                    iterations and periods.
+                contraction: In the modified Newton mode, the jacobian
+                    is refactorized when the size of a step is more than
+                    this fraction of the size of the previous step.
+        """
+        if sparse != self.sparse or compiled is not self.compiled:
+            self.reset()
+        self.sparse = sparse
+        self.compiled = compiled
+        self.contraction = contraction
+        if not modified:
+            self._factor = None
+        self.modified = modified
+        self._prev_norm = None
         if self.jacobian is None:
-            self.jacobian = _build_jacobian(self.model)
+            if compiled is not None:
+                self.jacobian = compiled.jacobian
+                self._data = compiled.jacobian.new_data()
+                if not sparse:
+                    size = compiled.jacobian.size
+                    self._matrix = numpy.zeros((size, size))
+            elif sparse:
+                self.jacobian = _SparseJacobian(self.model)
+            else:
+                self.jacobian = _build_jacobian(self.model)
 
     def reset(self):
         """ Reset the solver """
         self.jacobian = None
+        self.compiled = None
+        self._data = None
+        self._matrix = None
+        self._sparse_lu.reset()
+        self._factor = None
+        self._prev_norm = None
+
+    def _evaluate_equations(self, context, current):
+        """ Evaluates the vector of equations at current """
+        if self.compiled is not None:
+            return _evaluate_compiled_equations(
+                self.model, self.compiled, context, current)
+        return _evaluate_equations_vector(self.model, context, current)
+
+    def _evaluate_jacobian(self, context, current):
+        """ Evaluates the jacobian at current
+
+            Returns: a scipy.sparse.csc_matrix if using the sparse
+                solver, otherwise a dense numpy array.
+        """
+        if self.compiled is not None:
+            data = _evaluate_compiled_jacobian(
+                self.model, self.compiled, context, current, self._data)
+            if self.sparse:
+                return _csc_matrix(data, self.jacobian.rows,
+                                   self.jacobian.indptr, self.jacobian.size)
+            return self.jacobian.dense(data, self._matrix)
+        if self.sparse:
+            return self.jacobian.evaluate(current)
+        return _evaluate_jacobian(self.model, self.jacobian, current)
 
     def solve(self, context, current, next_soln):
         """ Performs a single iteration of the solver, generating a solution
@@ -366,18 +781,60 @@ class NewtonRaphsonSolver(object):
 
         # evaluate the jacobian, and solve the linear equations
         #   J(X)(x(n+1) - x(n)) = -F(xn)
-        F = _evaluate_equations_vector(self.model, context, current)
-        J = _evaluate_jacobian(self.model, self.jacobian, current)
+        telemetry = self.telemetry
+        F = _timed(telemetry, 'equations',
+                   self._evaluate_equations, context, current)
 
         try:
-            x = numpy.linalg.solve(J, F)
-        except numpy.linalg.LinAlgError as err:
+            if self.modified:
+                x = self._modified_step(context, current, F)
+            else:
+                J = _timed(telemetry, 'jacobian',
+                           self._evaluate_jacobian, context, current)
+                if self.sparse:
+                    x = _timed(telemetry, 'linear',
+                               self._sparse_lu.solve, J, F)
+                else:
+                    x = _timed(telemetry, 'linear', numpy.linalg.solve, J, F)
+        except (numpy.linalg.LinAlgError, RuntimeError) as err:
             raise CalculationError(err, None, context)
 
         # x now contains x(n+1) - x(n), to get x(n+1) add back in x(n)
         for i, var in enumerate(self.model.variables.values()):
             next_soln[var._index] += float(x[i])
 
+    def _refactorize(self, context, current):
+        """ Evaluates and factorizes the jacobian at current """
+        J = _timed(self.telemetry, 'jacobian',
+                   self._evaluate_jacobian, context, current)
+        if self.sparse:
+            self._factor = _timed(self.telemetry, 'linear',
+                                  self._sparse_lu.factorize, J)
+        else:
+            self._factor = _timed(self.telemetry, 'linear',
+                                  _dense_factorize, J)
+        self.refactorizations += 1
+
+    def _modified_step(self, context, current, F):
+        """ Computes the step using the stored factorization,
+            refactorizing if the step does not contract.
+        """
+        # pylint: disable=invalid-name
+        refactorized = False
+        if self._factor is None:
+            self._refactorize(context, current)
+            refactorized = True
+
+        x = _timed(self.telemetry, 'linear', self._factor, F)
+        norm = numpy.max(numpy.abs(x)) if len(x) else 0.
+        if (not refactorized and self._prev_norm is not None and
+                norm > self.contraction * self._prev_norm):
+            self._refactorize(context, current)
+            x = _timed(self.telemetry, 'linear', self._factor, F)
+            norm = numpy.max(numpy.abs(x)) if len(x) else 0.
+        self._prev_norm = norm
+        return x
+
 
 class GaussSeidelSolver(object):
     """ Implements the Gauss-Seidel method for solving a system
@@ -385,14 +842,23 @@ class GaussSeidelSolver(object):
     """
     def __init__(self, model):
         self.model = model
+        self.compiled = None
+        self.telemetry = None
+        self.profiler = None
 
-    def setup(self):
-        """ Perform any prepatory work before solving """
-        pass
+    def setup(self, compiled=None):
+        """ Perform any prepatory work before solving
+
+            Arguments:
+                compiled: If set, the CompiledModel whose fused step
+                    function is used instead of the per-equation
+                    functions.
+        """
+        self.compiled = compiled
 
     def reset(self):
         """ Reset the solver """
-        pass
+        self.compiled = None
 
     def solve(self, context, current, next_soln):
         """ Performs a single iteration of the solver, generating a solution
@@ -405,12 +871,27 @@ class GaussSeidelSolver(object):
             Raises:
                 CalculationError
         """
-        # pylint: disable=star-args, unused-argument
+        if self.compiled is not None and self.profiler is None:
+            _timed(self.telemetry, 'equations',
+                   self._solve_compiled, context, next_soln)
+        else:
+            _timed(self.telemetry, 'equations',
+                   self._solve_equations, context, next_soln)
+
+    def _solve_equations(self, context, next_soln):
+        """ Performs a single sweep using the per-equation functions,
+            these are timed by the profiler (if there is one).
+        """
+        # pylint: disable=star-args
+        profiler = self.profiler
         for equation in self.model.equations:
             variable = equation.variable
             value = None
             try:
-                value = variable.equation.func(*next_soln)
+                if profiler is None:
+                    value = variable.equation.func(*next_soln)
+                else:
+                    value = profiler.evaluate(variable, next_soln)
                 next_soln[variable._index] = float(value)
             except Exception as err:
                 # check to see if any of the atoms have a None value
@@ -427,39 +908,237 @@ class GaussSeidelSolver(object):
                     variable.equation,
                     curr_context)
 
+    def _solve_compiled(self, context, next_soln):
+        """ Performs a single sweep using the compiled step function """
+        try:
+            self.compiled.step(next_soln)
+        except Exception as err:
+            curr_context = {v: next_soln[v._index] for v in context.keys()}
+            raise _calculation_error(self.model, self.compiled, err,
+                                     curr_context)
+
+
+def _fill_dense(jacobian, soln, data, matrix):
+    """ Evaluates the compiled jacobian into the dense matrix """
+    jacobian.fill(soln, data)
+    jacobian.dense(data, matrix)
+
+
+class BlockSolver(object):
+    """ Solves the model one block at a time.
+
+        The equations are split into the strongly connected components
+        of their dependency graph (see Model.blocks()).  The blocks
+        are solved in order, the equations that do not depend on
+        each other are evaluated only once, and only the simultaneous
+        blocks are iterated until they converge (using either the
+        Gauss-Seidel or the Newton-Raphson method).
+
+        This solver always uses the compiled model.
+    """
+    def __init__(self, model, method):
+        self.model = model
+        self.method = method
+        self.compiled = None
+        self.max_iterations = 10
+        self.convergence = None
+        self.telemetry = None
+        self._jacobians = None
+        self._tests = None
+
+    def setup(self, compiled=None, max_iterations=10, convergence=None):
+        """ Perform any prepatory work before solving
+
+            Arguments:
+                compiled: The CompiledModel that contains the blocks.
+                max_iterations: The maximum number of iterations
+                    used to solve each simultaneous block.
+                convergence: The Convergence test of the model, the
+                    simultaneous blocks are tested with the tolerances
+                    of their variables.
+        """
+        if compiled is not self.compiled:
+            self._jacobians = {
+                block.name: (block.jacobian.new_data(),
+                             numpy.zeros((len(block.variables),
+                                          len(block.variables))))
+                for block in compiled.blocks if block.simultaneous}
+        if compiled is not self.compiled or convergence is not self.convergence:
+            self._tests = {block.name: convergence.select(block.variables)
+                           for block in compiled.blocks if block.simultaneous}
+        self.compiled = compiled
+        self.max_iterations = max_iterations
+        self.convergence = convergence
+
+    def reset(self):
+        """ Reset the solver """
+        self.compiled = None
+        self.convergence = None
+        self._jacobians = None
+        self._tests = None
+
+    def solve(self, context, current, next_soln):
+        """ Solves every block of the model.
+
+            Arguments:
+                current: The current solution, should not be modified.
+                next_soln: On entry, this contains a copy of current,
+                    the solution is placed here.
+
+            Returns: True, the solution does not need to be iterated.
+
+            Raises:
+                CalculationError
+                SolutionNotFoundError
+        """
+        # pylint: disable=unused-argument
+        for block in self.compiled.blocks:
+            try:
+                if not block.simultaneous:
+                    _timed(self.telemetry, 'equations', block.step, next_soln)
+                elif self.method == 'newton-raphson':
+                    self._solve_newton(block, next_soln)
+                else:
+                    self._solve_gauss_seidel(block, next_soln)
+            except (SolutionNotFoundError, CalculationError):
+                raise
+            except Exception as err:
+                curr_context = {v: next_soln[v._index]
+                                for v in context.keys()}
+                raise _calculation_error(self.model, self.compiled, err,
+                                         curr_context)
+        return True
+
+    def _not_converged(self, block):
+        """ Raises the error for a block that did not converge """
+        names = [self.model.equations[i].variable.name
+                 for i in block.equations]
+        raise SolutionNotFoundError(', '.join(names) +
+                                    ' have not converged')
+
+    def _solve_gauss_seidel(self, block, soln):
+        """ Iterates the block until it converges """
+        test = self._tests[block.name]
+        test.reset()
+        for _ in range(self.max_iterations):
+            prev = test.values(soln)
+            _timed(self.telemetry, 'equations', block.step, soln)
+            if test.converged(prev, soln):
+                return
+        self._not_converged(block)
+
+    def _solve_newton(self, block, soln):
+        """ Solves the block with Newton-Raphson """
+        # pylint: disable=invalid-name
+        data, J = self._jacobians[block.name]
+        test = self._tests[block.name]
+        test.reset()
+        telemetry = self.telemetry
+        for _ in range(self.max_iterations):
+            F = numpy.array(_timed(telemetry, 'equations',
+                                   block.residual, soln))
+            _timed(telemetry, 'jacobian', _fill_dense, block.jacobian,
+                   soln, data, J)
+            try:
+                dx = _timed(telemetry, 'linear', numpy.linalg.solve, J, -F)
+            except numpy.linalg.LinAlgError as err:
+                raise CalculationError(err, None, None)
+
+            prev = test.values(soln)
+            for i, delta in zip(block.variables, dx.tolist()):
+                soln[i] += delta
+            if test.converged(prev, soln):
+                return
+        self._not_converged(block)
+
+
+class Snapshot(object):
+    """ The state of a solved model: the values of the variables and
+        parameters, and the last periods of the solutions (as many as
+        are needed by the lagged values).
+
+        New models are branched from a snapshot without parsing the
+        equations (they share the compiled model), and they continue
+        from the period the snapshot was taken.  Each branch starts
+        with a copy of the random generator of the model, so the
+        branches draw the same stochastic terms.  A snapshot can be
+        pickled.
+
+        Attributes:
+            periods: The number of periods solved by the model when
+                the snapshot was taken.
+            names: The names of the variables and parameters.
+    """
+    def __init__(self, state, periods):
+        self._state = state
+        self.periods = periods
+
+    @property
+    def names(self):
+        """ The names of the variables and parameters """
+        return ([x[0] for x in self._state['variables']] +
+                [x[0] for x in self._state['parameters']])
+
+    def branch(self):
+        """ Returns a new Model that starts from the snapshot, the
+            snapshot (and the model it was taken from) is not changed
+            by the new model.
+        """
+        solutions = self._state['solutions']
+        model = Model.__new__(Model)
+        model.__setstate__(dict(
+            self._state,
+            no_equations=collections.OrderedDict(
+                self._state['no_equations']),
+            generator=copy.deepcopy(self._state['generator']),
+            solutions=solutions.tail(len(solutions))))
+        return model
+
 
 class Model(object):
     """ This is the main Model class.  Variables, parameters, and
         equations are defined through this class.
 
+        Arguments:
+            cache_dir: If set, the compiled form of the model is
+                stored in this directory (keyed by a hash of the
+                equations), and used again by later models with the
+                same equations, without parsing the equations.  The
+                equations are then only parsed when needed, thus
+                errors in the equations are not raised by add().
+
         Attributes:
             variables:
             parameters:
             solutions:
             equations:
+            cache_dir:
+            random: The numpy.random.Generator used to draw the
+                stochastic terms of the equations (see seed()).
     """
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self):
+    def __init__(self, cache_dir=None):
 
-        # Upon creating a new model, clear the cache
-        # Otherwise creating multiple models creates
-        # problems because sympy() will not reevaluate
-        # functions and the series accessor will not
-        # get created.  Because sympy keeps this cache
-        # around, will have to be careful if using these
-        # models in a multi-threaded context.
-        clear_cache()
+        # The sympy cache is not cleared: the variables and parameters
+        # of each model are distinct symbols (see ModVariable), so the
+        # expressions cached for another model are never used here.
 
         self.variables = collections.OrderedDict()
         self.parameters = collections.OrderedDict()
         self.desc_variables = collections.OrderedDict()
         self.desc_parameters = collections.OrderedDict()
         self.no_equations = collections.OrderedDict()
-        self.solutions = list()
+        self.solutions = SolutionHistory()
         self.equations = list()
+        # the number of periods solved that are not kept in the
+        # solutions (see simulate() and snapshot())
+        self._dropped_periods = 0
 
         self._private_parameters = collections.OrderedDict()
+        self._random_parameters = collections.OrderedDict()
+        self._random_count = 0
+        self._lags = None
         self._local_context = dict()
         self._var_default = None
         self._param_default = None
@@ -467,15 +1146,305 @@ class Model(object):
         self._need_function_update = True
 
         _add_functions(self._local_context)
+        self._local_context['normal'] = self._normal
+        self._local_context['uniform'] = self._uniform
+        self._local_context['randint'] = self._randint
+        self.random = None
 
         # Variables used to lambdify the expressions
         self._arg_list = None
         self._private_funcs = None
+        self._lambdified = False
+        self._compiled = None
+        self._compiled_batch = None
+        self._compiled_steady = None
+
+        self.cache_dir = cache_dir
+        self._cache_entry = None
 
         self._solvers = dict()
         self._solvers['newton-raphson'] = NewtonRaphsonSolver(self)
         self._solvers['gauss-seidel'] = GaussSeidelSolver(self)
         self._solvers['broyden'] = BroydenSolver(self)
+        self._solvers['block-gauss-seidel'] = BlockSolver(self,
+                                                          'gauss-seidel')
+        self._solvers['block-newton'] = BlockSolver(self, 'newton-raphson')
+
+    def __getstate__(self):
+        """ The model is pickled without any of the sympy objects.
+
+            The names, values and equations are stored as plain
+            data, along with the compiled form of the model (if the
+            model has been compiled), so that an unpickled model can
+            be solved with the compiled model without parsing the
+            equations again.
+        """
+        compiled = None
+        if not self._need_function_update:
+            compiled = self._compiled
+        arg_list = None
+        if compiled is not None:
+            arg_list = [x.name for x in self._arg_list]
+        return {
+            'var_default': self._var_default,
+            'param_default': self._param_default,
+            'variables': [(x.name, x.desc, x.default, x.value)
+                          for x in self.variables.values()],
+            'parameters': [(x.name, x.desc, x.default, x.value)
+                           for x in self.parameters.values()],
+            'series': [(x.name, x.variable.name, x.iteration, x.default)
+                       for x in self._private_parameters.values()],
+            'random': [(x.name, x.distribution, x.bounds)
+                       for x in self._random_parameters.values()],
+            'generator': self.random,
+            'equations': [(x.equation, x.desc, x.variable.name)
+                          for x in self.equations],
+            'no_equations': self.no_equations,
+            'solutions': self._solutions,
+            'dropped_periods': self._dropped_periods,
+            'arg_list': arg_list,
+            'compiled': compiled,
+        }
+
+    def __setstate__(self, state):
+        """ Rebuilds the model, the equations are parsed only when
+            they are needed (see _parse_equations())
+        """
+        # pylint: disable=protected-access
+        self.__init__()
+        for name, desc, default, value in state['variables']:
+            var = self.var(name, desc=desc, default=default)
+            var.default = default
+            var.value = value
+            self.desc_variables[name] = desc, default
+        for name, desc, default, value in state['parameters']:
+            param = self.param(name, desc=desc, default=default)
+            param.default = default
+            param.value = value
+            self.desc_parameters[name] = desc, default
+        self._add_series_parameters(state['series'])
+        self._add_random_parameters(state['random'])
+        self.random = state['generator']
+        for text, desc, variable in state['equations']:
+            eqn = Equation(self, text, desc)
+            eqn.variable = self.variables[variable]
+            eqn.variable.equation = eqn
+            self.equations.append(eqn)
+        self.no_equations = state['no_equations']
+        self._var_default = state['var_default']
+        self._param_default = state['param_default']
+        self.solutions = state['solutions']
+        self._dropped_periods = state['dropped_periods']
+
+        if state['compiled'] is not None:
+            symbols = dict(self.variables)
+            symbols.update(self.parameters)
+            symbols.update(self._private_parameters)
+            symbols.update(self._random_parameters)
+            self._arg_list = [symbols[name] for name in state['arg_list']]
+            for i, symbol in enumerate(self._arg_list):
+                symbol._index = i
+            self._build_lambda_args(None)
+            self._compiled = state['compiled']
+            self._need_function_update = False
+
+    def _add_series_parameters(self, series):
+        """ Creates the parameters used to access the previous
+            values, series is a list of (name, variable name,
+            iteration, default) tuples.
+        """
+        for name, variable, iteration, default in series:
+            if name in self._private_parameters:
+                continue
+            variable = self.variables.get(variable,
+                                          self.parameters.get(variable))
+            param = SeriesParameter(name,
+                                    variable=variable,
+                                    iteration=iteration,
+                                    default=default)
+            self._private_parameters[name] = param
+            _add_param_to_context(self._local_context, param)
+            self._lags = None
+            self._need_function_update = True
+
+    def _add_random_parameters(self, random):
+        """ Creates the parameters of the stochastic terms, random
+            is a list of (name, distribution, bounds) tuples.
+        """
+        for name, distribution, bounds in random:
+            if name in self._random_parameters:
+                continue
+            param = RandomParameter(name,
+                                    distribution=distribution,
+                                    bounds=bounds)
+            self._random_parameters[name] = param
+            _add_param_to_context(self._local_context, param)
+            self._need_function_update = True
+
+    def _random_term(self, distribution, bounds=()):
+        """ Returns the parameter of a stochastic term of an equation.
+
+            The terms are named by the order in which they are parsed,
+            so that parsing the equations again (for example for an
+            unpickled model) gives the same parameters.
+        """
+        name = '_{0}_{1}'.format(distribution, self._random_count)
+        self._random_count += 1
+        self._add_random_parameters([(name, distribution, bounds)])
+        return self._random_parameters[name]
+
+    def _normal(self, loc=0, scale=1):
+        """ normal(loc, scale) within an equation, a normally
+            distributed term that is drawn for each period
+        """
+        return loc + scale*self._random_term('normal')
+
+    def _uniform(self, low=0, high=1):
+        """ uniform(low, high) within an equation, a uniformly
+            distributed term (over [low, high)) that is drawn for
+            each period
+        """
+        return low + (high - low)*self._random_term('uniform')
+
+    def _randint(self, low, high=None):
+        """ randint(low, high) within an equation, an integer in
+            [low, high) that is drawn for each period.  As with
+            numpy, randint(high) draws from [0, high).
+
+            Raises:
+                EquationError: if the bounds are not integers
+        """
+        if high is None:
+            low, high = 0, low
+        bounds = (sympify(low), sympify(high))
+        if not all(x.is_Integer for x in bounds):
+            raise EquationError('randint-bounds', str(bounds),
+                                'the bounds of randint must be integers')
+        return self._random_term('randint', tuple(int(x) for x in bounds))
+
+    def seed(self, seed=None):
+        """ Sets the generator of the stochastic terms, the
+            draws of the following periods are reproducible.
+
+            Arguments:
+                seed: The seed of numpy.random.default_rng(), such
+                    as an int or a numpy.random.SeedSequence.
+        """
+        self.random = numpy.random.default_rng(seed)
+
+    def _generator(self):
+        """ Returns the generator of the stochastic terms, one is
+            created (without a seed) if seed() was not called.
+        """
+        if self.random is None:
+            self.random = numpy.random.default_rng()
+        return self.random
+
+    def _draw(self, values):
+        """ Draws the stochastic terms of the next period, values
+            is the state vector (or context) that gets the draws.
+        """
+        if not self._random_parameters:
+            return
+        generator = self._generator()
+        for param in self._random_parameters.values():
+            param.value = float(param.draw(generator))
+            if isinstance(values, dict):
+                values[param] = param.value
+            else:
+                values[param._index] = param.value
+
+    def _link_equations(self):
+        """ Makes sure that each equation is linked to the variable
+            it defines.  The links (and the parameters used for the
+            previous values) are taken from the compile cache if
+            possible, otherwise the equations are parsed.
+        """
+        if all(eqn.variable is not None for eqn in self.equations):
+            return
+        if self.cache_dir is not None:
+            key = cache.model_key(self)
+            entry = cache.load(self.cache_dir, key)
+            if entry is not None and entry.get('key') == key:
+                self._add_series_parameters(entry['series'])
+                self._add_random_parameters(entry['random'])
+                for eqn, name in zip(self.equations, entry['equations']):
+                    if eqn.variable is None:
+                        eqn.variable = self.variables[name]
+                        eqn.variable.equation = eqn
+                self._cache_entry = entry
+                return
+        self._parse_equations()
+
+    def _compile_model(self):
+        """ Returns the compiled model, from the compile cache if the
+            entry matches the argument list, otherwise the model is
+            compiled (and stored in the cache).
+        """
+        names = [x.name for x in self._arg_list]
+        key = cache.model_key(self) if self.cache_dir is not None else None
+        entry = self._cache_entry
+        if (entry is not None and entry['key'] == key and
+                entry['arg_list'] == names):
+            return entry['compiled']
+
+        self._parse_equations()
+        compiled = compile_model(self)
+        if self.cache_dir is not None:
+            entry = {
+                'key': key,
+                'series': [(x.name, x.variable.name, x.iteration, x.default)
+                           for x in self._private_parameters.values()],
+                'random': [(x.name, x.distribution, x.bounds)
+                           for x in self._random_parameters.values()],
+                'equations': [x.variable.name for x in self.equations],
+                'arg_list': names,
+                'compiled': compiled,
+            }
+            cache.store(self.cache_dir, key, entry)
+            self._cache_entry = entry
+        return compiled
+
+    def _parse_equations(self):
+        """ Parses the equations that have not been parsed yet, this
+            is the case for an unpickled model.
+        """
+        for eqn in self.equations:
+            if eqn.expr is None:
+                eqn.parse(self._local_context)
+
+    @property
+    def solutions(self):
+        """ The solutions of the model, one per period (see
+            SolutionHistory).  solutions[i] is a read-only dict-like
+            view of the values of period i.
+        """
+        return self._solutions
+
+    @solutions.setter
+    def solutions(self, solutions):
+        """ Replaces the solutions, this may be a list of dicts """
+        if not isinstance(solutions, SolutionHistory):
+            solutions = SolutionHistory.from_list(solutions)
+        self._solutions = solutions
+
+    @property
+    def periods(self):
+        """ The number of periods of the model, counting the periods
+            that are not kept in the solutions (see simulate()).  This
+            is the period of the next solution.
+        """
+        return self._dropped_periods + len(self._solutions)
+
+    def series(self, name):
+        """ Returns the values of a variable/parameter for all
+            periods, as a numpy array.  This is a view of the stored
+            solutions (no copy).
+
+            Raises:
+                KeyError: if there are no values for the name
+        """
+        return self._solutions.column(name)
 
     def set_var_default(self, default):
         """ Sets the general default value for all variables. """
@@ -579,14 +1548,88 @@ class Model(object):
         """
         eqn = Equation(self, equation, no)
         self.no_equations[equation] = no
-        eqn.parse(self._local_context)
+        if self.cache_dir is None:
+            eqn.parse(self._local_context)
         self._need_function_update = True
 
         self.equations.append(eqn)
         return eqn
 
+    def add_many(self, text):
+        """ Adds a block of equations to the model, one equation per
+            line.  Empty lines and lines starting with '#' are
+            skipped, a comment after an equation is used as the
+            description of the equation.  An equation may start
+            with its number, as in '3.1: Cs = Cd'.
+
+            Example:
+                model.add_many('''
+                    Cs = Cd   # consumption
+                    3.2: Gs = Gd
+                ''')
+
+            Arguments:
+                text: A string containing the equations.
+
+            Returns: a list of the Equations added
+        """
+        return self._add_equations(
+            [eqn for eqn in map(_equation_line, text.splitlines())
+             if eqn is not None])
+
+    def _add_equations(self, equations):
+        """ Adds a list of (equation, desc, no) tuples
+
+            Returns: a list of the Equations added
+        """
+        added = list()
+        for equation, desc, number in equations:
+            eqn = Equation(self, equation, desc)
+            self.no_equations[equation] = number
+            if self.cache_dir is None:
+                eqn.parse(self._local_context)
+            self.equations.append(eqn)
+            added.append(eqn)
+        self._need_function_update = True
+        return added
+
+    @classmethod
+    def from_spec(cls, spec, cache_dir=None):
+        """ Creates a model from a specification (see pysolve3.spec
+            for the format).
+
+            Arguments:
+                spec: The path of the specification file, or the
+                    result of parse_spec() (which can be sent to
+                    other processes).
+                cache_dir: The directory of the compile cache, with
+                    a cache the equations of a model that has been
+                    compiled before are not parsed.
+
+            Returns: a Model
+
+            Raises:
+                SpecError: if the specification is not valid
+        """
+        # pylint: disable=protected-access
+        if not isinstance(spec, dict):
+            spec = read_spec(spec)
+        model = cls(cache_dir=cache_dir)
+        if 'variables' in spec['defaults']:
+            model.set_var_default(spec['defaults']['variables'])
+        if 'parameters' in spec['defaults']:
+            model.set_param_default(spec['defaults']['parameters'])
+        for name, desc, default in spec['variables']:
+            model.var(name, desc=desc, default=default)
+        for name, desc, default in spec['parameters']:
+            model.param(name, desc=desc, default=default)
+        model._add_equations(spec['equations'])
+        model.set_values(spec['values'])
+        return model
+
     def _validate_equations(self):
         """ Does some validation """
+        self._link_equations()
         # Make sure that each variable has an equation
         for variable in self.variables.values():
             if variable.equation is None:
@@ -604,9 +1647,14 @@ class Model(object):
         for param in self.parameters.values():
             if param.value is not None:
                 context[param] = float(param.value)
-        for param in self._private_parameters.values():
-            if param.value is not None:
-                context[param] = float(param.value)
+        if self._lags is None:
+            self._lags = LagTable(self._private_parameters.values())
+        for param, value in zip(self._lags.params,
+                                self._lags.gather(self._solutions)):
+            if value is not None:
+                context[param] = float(value)
+        for param in self._random_parameters.values():
+            context[param] = float(param.value)
         return context
 
     def _update_solutions(self, solution):
@@ -614,7 +1662,7 @@ class Model(object):
             solutions list.
         """
         self.set_values(solution, ignore_errors=True)
-        self.solutions.append(solution.copy())
+        self._solutions.append(solution)
 
     def _clear_lambda_args(self):
         """ Clears the list of lambda args, ensures that the
@@ -622,6 +1670,10 @@ class Model(object):
         """
         self._arg_list = None
         self._private_funcs = None
+        self._lambdified = False
+        self._compiled = None
+        self._compiled_batch = None
+        self._compiled_steady = None
 
     def _build_lambda_args(self, context):
         """ Creates the argument list for lambdify
@@ -642,15 +1694,94 @@ class Model(object):
 	   
     def _lambdify(self, expr):
         """ Creates a lambdified expression with the appropriate args """
+        from sympy.utilities import lambdify
         return lambdify(self._arg_list, expr, self._private_funcs)
 
+    def _update_functions(self, context):
+        """ Rebuilds the argument list if the number of
+            variables/parameters/equations has changed.
+        """
+        if self._need_function_update:
+            self._clear_lambda_args()
+            self._build_lambda_args(context)
+
+            for solver in self._solvers.values():
+                solver.reset()
+
+            self._need_function_update = False
+
+    def get_solver(self, method):
+        """ Returns the solver used for the method, this can be used
+            to look at the solver statistics (for example the number
+            of refactorizations of the modified Newton method).
+
+            Raises:
+                ValueError: if the method is not valid
+        """
+        if method not in self._solvers:
+            raise ValueError(
+                '{0} is not a valid solver method type'.format(method))
+        return self._solvers[method]
+
+    def blocks(self):
+        """ Splits the equations into blocks, using the strongly
+            connected components of the equation dependency graph.
+
+            Returns: a list of the blocks in evaluation order.  Each
+                block is a list of equations, a block with a single
+                equation that does not depend on itself can be
+                evaluated directly, the other blocks contain
+                equations that have to be solved simultaneously.
+        """
+        self._parse_equations()
+        return [[self.equations[i] for i in positions]
+                for _, positions in block_decomposition(self.equations)]
+
+    def compile(self):
+        """ Generates the compiled form of the model.
+
+            The whole model is generated as a single python function
+            that evaluates the equations in order on a flat state
+            vector.  The result is cached until the model changes.
+
+            Returns: a CompiledModel
+
+            Raises:
+                EquationError:
+        """
+        if self._compiled is None or self._need_function_update:
+            self._validate_equations()
+            self._update_functions(self._get_context())
+            self._compiled = self._compile_model()
+        return self._compiled
+
+    def compile_batch(self):
+        """ Generates the vectorized form of the model, used by
+            simulate_batch().  The result is cached until the
+            model changes.
+
+            Returns: a CompiledModel
+
+            Raises:
+                EquationError:
+        """
+        if self._compiled_batch is None or self._need_function_update:
+            self._validate_equations()
+            self._update_functions(self._get_context())
+            self._parse_equations()
+            self._compiled_batch = compile_batch(self)
+        return self._compiled_batch
+
     def _run_solver(self,
                     solver,
                     context,
+                    convergence,
                     max_iterations=10,
                     until=None,
-                    threshold=0.001,
-                    debuglist=None):
+                    debuglist=None,
+                    norms=None,
+                    telemetry=None,
+                    profiler=None):
         """ Runs the main solver loop
 
             Returns: a context with the values of the solution
@@ -658,43 +1789,108 @@ class Model(object):
             Raises:
                 SolutionNotFoundError
         """
-        # pylint: disable=too-many-locals
-
-        testf = (until or (lambda x1, x2: is_aclose(x1, x2, rtol=threshold)))
-
+        # pylint: disable=too-many-arguments
         if debuglist is not None:
             debuglist.append(context)
 
-        next_soln = [float(x) for x in context.values()]
-        soln = None
+        period = self.periods
+        next_soln = self._iterate(solver,
+                                  context,
+                                  [float(x) for x in context.values()],
+                                  convergence,
+                                  max_iterations=max_iterations,
+                                  until=until,
+                                  debuglist=debuglist,
+                                  norms=norms,
+                                  telemetry=telemetry,
+                                  profiler=profiler,
+                                  period=period)
+        return {v: next_soln[v._index] for v in context.keys()}
+
+    def _iterate(self,
+                 solver,
+                 context,
+                 next_soln,
+                 convergence,
+                 max_iterations=10,
+                 until=None,
+                 debuglist=None,
+                 norms=None,
+                 telemetry=None,
+                 profiler=None,
+                 period=None):
+        """ Iterates the solver from the state next_soln (a list in
+            the order of the context) until it converges.
 
-        for _ in range(max_iterations):
+            Arguments:
+                convergence: The Convergence test, used unless there
+                    is an until condition.
+                norms: If set, the norms of the iterations (see
+                    Convergence) are appended as a list.
+                telemetry: If set, the SolverTelemetry that gets the
+                    statistics of the period.
+                profiler: If set, the EquationProfiler that gets the
+                    changes of the variables of each iteration.
+                period: The index of the period (for the telemetry).
+
+            Returns: the state of the solution (a list)
+
+            Raises:
+                SolutionNotFoundError
+        """
+        # pylint: disable=too-many-arguments
+        testf = until or convergence
+        convergence.reset()
+        if telemetry is not None:
+            telemetry.start_period(period)
+        if profiler is not None:
+            profiler.start_period()
+
+        for iteration in range(max_iterations):
             current = next_soln
             next_soln = list(current)
 
-            solver.solve(context, current, next_soln)
+            # The solver returns True if the solution is complete
+            # and does not need to be iterated further
+            done = solver.solve(context, current, next_soln)
+            if profiler is not None:
+                profiler.sweep(convergence, current, next_soln)
 
             if debuglist is not None:
                 debuglist.append({v: next_soln[v._index]
                                  for v in context.keys()})
 
-            if testf(current, next_soln):
-                soln = {v: next_soln[v._index] for v in context.keys()}
-                break
-
-        if soln is None:
-            # determine the variables that have not converged
-            problem_vars = []
-            for variable in self.variables.values():
-                if not testf([current[variable._index], ],
-                             [next_soln[variable._index], ]):
-                    problem_vars.append(variable.name)
-            raise SolutionNotFoundError(', '.join(problem_vars) +
-                                        ' have not converged')
-        return soln
+            if done or testf(current, next_soln):
+                if norms is not None:
+                    norms.append(convergence.norms)
+                if telemetry is not None:
+                    telemetry.end_period(iteration + 1, True,
+                                         convergence.norms)
+                return next_soln
+
+        if norms is not None:
+            norms.append(convergence.norms)
+        if telemetry is not None:
+            telemetry.end_period(max_iterations, False, convergence.norms)
+
+        # determine the variables that have not converged
+        if until is None:
+            failed = set(convergence.failed(current, next_soln))
+            problem_vars = [variable.name
+                            for variable in self.variables.values()
+                            if variable._index in failed]
+        else:
+            problem_vars = [variable.name
+                            for variable in self.variables.values()
+                            if not until([current[variable._index], ],
+                                         [next_soln[variable._index], ])]
+        raise SolutionNotFoundError(', '.join(problem_vars) +
+                                    ' have not converged')
 
     def solve(self, iterations=10, until=None, threshold=0.001,
-              debuglist=None, method='gauss-seidel'):
+              debuglist=None, method='gauss-seidel', compiled=False,
+              atol=1e-4, norm='max', norms=None, telemetry=None,
+              profiler=None, **options):
         """ Runs the solver.
 
             The solver will try to find a solution until one of the
@@ -711,7 +1907,10 @@ class Model(object):
                     This takes two parameters, the previous solution
                     vector and the current solution vector.
                 threshold: If using the default end condition, this is the
-                    threshold that the residuals must be less than.
+                    threshold that the residuals must be less than
+                    (the relative tolerance).  This may also be a dict
+                    of variable name -> threshold, the other variables
+                    use the default threshold.
                 debuglist: If this is set, then the current context will
                     be appended every iteration when solving.
                 method: The method that should be used for solving the
@@ -719,46 +1918,464 @@ class Model(object):
                     available methods:
                         gauss-seidel
                         newton-raphson
+                        broyden
+                        block-gauss-seidel
+                        block-newton
+                    The block methods solve the model one block at
+                    a time (see blocks()), iterating only the
+                    simultaneous blocks.  The until condition is not
+                    used by the block methods.
+                compiled: If True, the equations (and the jacobian)
+                    are evaluated by the compiled form of the model
+                    (see compile()) rather than one lambdified function
+                    per equation (or jacobian entry).  The block methods
+                    always use the compiled model.
+                atol: The absolute tolerance of the default end
+                    condition, a value or a dict of variable name ->
+                    tolerance (as with threshold).  Only the variables
+                    are tested, a variable has converged when
+                        abs(x - prev) <= atol + threshold*abs(x)
+                norm: How the scaled errors of the variables (see
+                    pysolve3.utils.Convergence) are combined: 'max'
+                    (every variable within its tolerances) or 'rms'
+                    (root-mean-square).
+                norms: If this is set, the list of the norms of the
+                    iterations is appended (one list per period), this
+                    shows how fast the periods converge.
+                telemetry: If set, a SolverTelemetry that collects
+                    the number of iterations, the time spent in each
+                    phase of the solver and the norms of the periods.
+                profiler: If set, an EquationProfiler that collects
+                    the changes of the variables of each iteration,
+                    and (with gauss-seidel) the time spent evaluating
+                    each equation.
+                options: Solver specific options, these are passed
+                    to the setup() of the solver.
+                        newton-raphson
+                            sparse: use a sparse jacobian and a sparse
+                                LU solver (requires scipy), only the
+                                column ordering is reused, the matrix
+                                is factorized in every iteration
+                                unless modified is set
+                            modified: reuse the factorization of the
+                                jacobian across iterations and periods
+                            contraction: the step size ratio above
+                                which the modified method refactorizes
+                        broyden
+                            memory: keep only the last memory update
+                                vectors (limited-memory Broyden)
+                            carryover: keep the approximate inverse
+                                jacobian from one period to the next
+                                (default True)
 
             Raises:
                 SolutionNotFoundError:
         """
-        # pylint: disable=invalid-name
+        # pylint: disable=invalid-name, too-many-arguments
+        solver, current, _, convergence = self._prepare(
+            method, iterations, (atol, threshold, norm), compiled, options,
+            telemetry, profiler)
+        self._draw(current)
+
+        solution = self._run_solver(solver,
+                                    current,
+                                    convergence,
+                                    max_iterations=iterations,
+                                    until=until,
+                                    debuglist=debuglist,
+                                    norms=norms,
+                                    telemetry=telemetry,
+                                    profiler=profiler)
+
+        soln = {k.name: v for k, v in solution.items()}
+        self._update_solutions(soln)
+
+    def _prepare(self, method, iterations, tolerances, compiled, options,
+                 telemetry=None, profiler=None):
+        """ Validates the model and sets up the solver for the method
+
+            Arguments:
+                tolerances: The (atol, threshold, norm) of the
+                    convergence test.
+                telemetry: The SolverTelemetry of the solver (if any).
+                profiler: The EquationProfiler (if any).
+
+            Returns: a (solver, context, options, convergence) tuple,
+                context contains the values for the next period,
+                options are the arguments passed to the setup() of the
+                solver and convergence is the Convergence test.
+
+            Raises:
+                ValueError: if the method (or a tolerance) is not valid
+        """
+        # pylint: disable=too-many-arguments
         self._validate_equations()
 
+        if method not in self._solvers:
+            raise ValueError(
+                '{0} is not a valid solver method type'.format(method))
+        solver = self._solvers[method]
+
         current = self._get_context()
         if len(self.solutions) == 0:
             self._update_solutions({k.name: v for k, v in current.items()})
 
         # do we need to update the function lambdas?  This is needed
         # if the number of variables/parameters/equations change.
-        if self._need_function_update:
-            self._clear_lambda_args()
-            self._build_lambda_args(current)
-
+        self._update_functions(current)
+
+        atol, threshold, norm = tolerances
+        convergence = Convergence(
+            [var._index for var in self.variables.values()],
+            atol=self._tolerances(atol, 1e-4),
+            rtol=self._tolerances(threshold, 0.001),
+            norm=norm)
+
+        options = dict(options)
+        if method in _BLOCK_METHODS:
+            options.update(compiled=self.compile(),
+                           max_iterations=iterations,
+                           convergence=convergence)
+        elif compiled:
+            options.update(compiled=self.compile())
+        else:
+            self._lambdify_equations()
+        solver.setup(**options)
+        solver.telemetry = telemetry
+        if method == 'gauss-seidel':
+            # the profiler times the per-equation functions
+            if profiler is not None:
+                self._lambdify_equations()
+            solver.profiler = profiler
+        if profiler is not None:
+            profiler.setup(self)
+        return solver, current, options, convergence
+
+    def _lambdify_equations(self):
+        """ Creates the functions of the equations (if needed) """
+        if not self._lambdified:
+            self._parse_equations()
             for var in self.variables.values():
                 var.equation.func = self._lambdify(var.equation.expr)
+            self._lambdified = True
 
-            for solver in self._solvers.values():
-                solver.reset()
+    def _tolerances(self, tolerance, default):
+        """ Returns the tolerance of each variable, tolerance is either
+            a single value or a dict of variable name -> tolerance.
 
-            self._need_function_update = False
+            Raises:
+                ValueError: if a name is not a variable
+        """
+        if not isinstance(tolerance, dict):
+            return tolerance
+        for name in tolerance:
+            if name not in self.variables:
+                raise ValueError("{0} is not a variable".format(name))
+        return [tolerance.get(name, default) for name in self.variables]
+
+    def simulate(self, periods, method='gauss-seidel', iterations=10,
+                 until=None, threshold=0.001, record=None, atol=1e-4,
+                 norm='max', norms=None, telemetry=None, profiler=None,
+                 writer=None, **options):
+        """ Solves the model for a number of periods.
+
+            This gives the same results as calling solve() once for
+            each period, but the model is validated and compiled only
+            once, and the periods are solved on the state vector,
+            without building the per-period contexts.  The values of
+            the parameters are not changed during the simulation, the
+            stochastic terms (such as normal(0, 1)) are drawn for
+            each period from the generator of the model (see seed()).
 
-        if method not in self._solvers:
-            raise ValueError(
-                '{0} is not a valid solver method type'.format(method))
-        solver = self._solvers[method]
+            Arguments:
+                periods: The number of periods to solve.
+                method: The solver method (see solve()), the model
+                    is always evaluated in its compiled form.
+                iterations: The maximum number of iterations for
+                    each period.
+                until: The end condition for each period (see solve())
+                threshold: The convergence threshold (see solve())
+                record: If set, the list of the names of the
+                    variables/parameters to record.  Only these
+                    values are kept for the periods that are solved,
+                    and they are returned in a new SolutionHistory.
+                    The model's solutions only get the last periods
+                    (the ones needed by the lagged values, or all of
+                    them if an equation uses a fixed period such as
+                    x(5)), so that the model can be solved further.
+                atol: The absolute tolerance (see solve())
+                norm: The norm of the convergence test (see solve())
+                norms: If set, the list of the norms of the iterations
+                    of each period is appended (see solve())
+                telemetry: If set, the SolverTelemetry that collects
+                    the statistics of the periods (see solve())
+                profiler: If set, the EquationProfiler that collects
+                    the statistics of the equations (see solve())
+                writer: If set, the ResultWriter (see writers.py) the
+                    solutions are streamed to, a row per period
+                    indexed by the period of the model (see periods).
+                    The recorded names default to the names of the
+                    writer, and the solutions are not kept (as with
+                    record).
+                options: Solver specific options (see solve())
+
+            Returns: the SolutionHistory with the solutions, this is
+                the model's solutions unless record is set, or the
+                writer if it is set.
 
-        solver.setup()
-        solution = self._run_solver(solver,
-                                    current,
-                                    max_iterations=iterations,
-                                    until=until,
-                                    threshold=threshold,
-                                    debuglist=debuglist)
+            Raises:
+                SolutionNotFoundError:
+                ValueError: if a name in record is not a
+                    parameter/variable
+        """
+        # pylint: disable=too-many-arguments, too-many-locals
+        solver, context, options, convergence = self._prepare(
+            method, iterations, (atol, threshold, norm), True, options,
+            telemetry, profiler)
+        names = [symbol.name for symbol in context.keys()]
+        if writer is not None and record is None:
+            record = writer.names or names
+
+        if record is None:
+            history = self._solutions
+            columns = history.columns(names)
+            positions = None
+        else:
+            for name in record:
+                if name not in names:
+                    raise ValueError(
+                        "{0} is not a parameter/variable".format(name))
+            if writer is None:
+                history = SolutionHistory(names=record,
+                                          capacity=max(periods, 1))
+                columns = history.columns(record)
+            else:
+                writer.open(record, ('period',))
+                history = writer
+            positions = numpy.array([names.index(name) for name in record],
+                                    dtype=numpy.intp)
+
+        lags = LagBuffer(self._lags, self._solutions, len(names))
+        start = self.periods
+        # with a fixed period (such as x(5)), the solutions keep all
+        # of the periods, not only those needed by the lags
+        kept = [] if record is not None and self._uses_fixed_periods() \
+            else None
+        state = [float(x) for x in context.values()]
+        for period in range(periods):
+            if period > 0:
+                # the solvers are set up for each period, as with solve()
+                solver.setup(**options)
+            state = lags.fill(state)
+            self._draw(state)
+            state = self._iterate(solver,
+                                  context,
+                                  state,
+                                  convergence,
+                                  max_iterations=iterations,
+                                  until=until,
+                                  norms=norms,
+                                  telemetry=telemetry,
+                                  profiler=profiler,
+                                  period=start + period)
+            lags.push(state)
+            if kept is not None:
+                kept.append(list(state))
+            if positions is None:
+                history.append_row(state, columns)
+            elif writer is None:
+                history.append_row(numpy.take(state, positions), columns)
+            else:
+                writer.write_row(numpy.take(state, positions),
+                                 start + period)
+
+        if record is not None and periods > 0:
+            columns = self._solutions.columns(names)
+            rows = lags.last() if kept is None else kept
+            for row in rows:
+                self._solutions.append_row(row, columns)
+            self._dropped_periods += periods - len(rows)
+        self.set_values(dict(zip(names, state)), ignore_errors=True)
+        return history
+
+    def simulate_batch(self, periods, values, method='gauss-seidel',
+                       iterations=10, threshold=0.001, record=None,
+                       writer=None, atol=1e-4, norm='max'):
+        """ Solves many scenarios of the model at once.
+
+            Each scenario starts from the current values of the
+            model, with the given values replaced.  Every position of
+            the state holds one value per scenario, the equations are
+            evaluated with numpy for all of the scenarios, and each
+            scenario is iterated only until it converges, with the
+            same convergence test as solve().  The stochastic terms
+            are drawn for each period and scenario from the generator
+            of the model (see seed()).  The model itself is not
+            changed (other than the initial solution, as with
+            solve()).
 
-        soln = {k.name: v for k, v in solution.items()}
-        self._update_solutions(soln)
+            Arguments:
+                periods: The number of periods to solve.
+                values: A dict of name -> values, for the
+                    variables/parameters that differ between the
+                    scenarios.  The values are arrays of one value per
+                    scenario (or a single value for all scenarios).
+                method: 'gauss-seidel' or 'newton-raphson'
+                iterations: The maximum number of iterations for
+                    each period.
+                threshold: The convergence threshold (see solve())
+                record: If set, the list of the names of the
+                    variables/parameters to record.  This limits the
+                    memory used, which is periods x names x scenarios.
+                writer: If set, the ResultWriter (see writers.py) the
+                    solutions are streamed to, a row per period and
+                    scenario indexed by (scenario, period), the period
+                    of the model as with simulate().  The BatchHistory
+                    then only has the failed scenarios.
+                atol: The absolute tolerance (see solve())
+                norm: The norm of the convergence test (see solve())
+
+            Returns: a BatchHistory.  The scenarios that do not
+                converge are marked as failed, rather than raising
+                a SolutionNotFoundError.
+
+            Raises:
+                ValueError:
+        """
+        # pylint: disable=too-many-arguments
+        self._validate_equations()
+        context = self._get_context()
+        if len(self.solutions) == 0:
+            self._update_solutions({k.name: v for k, v in context.items()})
+        self._update_functions(context)
+        return run_batch(self, self.compile_batch(), context, periods,
+                         values, method=method, iterations=iterations,
+                         threshold=threshold, record=record,
+                         generator=self._generator(), writer=writer,
+                         atol=atol, norm=norm)
+
+    def steady_state(self, iterations=50, threshold=1e-8, atol=1e-8,
+                     sparse=False, load=False):
+        """ Solves for the stationary solution of the model, the
+            solution that is the same in every period.
+
+            The values of the previous periods (such as x(-1), and
+            thus d(x)) are replaced by the current values, and this
+            static system is solved with Newton-Raphson, using the
+            compiled jacobian.  The current values of the variables
+            are the starting point.
+
+            A variable that is not determined by the stationary system
+            keeps its starting value, for example a stock whose
+            equation only gives a condition on the flows
+            (Hs - Hs(-1) = Gd - Td gives Gd = Td).  The stochastic
+            terms are replaced by their means.
+
+            Arguments:
+                iterations: The maximum number of Newton iterations.
+                threshold: The relative tolerance (see solve())
+                atol: The absolute tolerance (see solve())
+                sparse: If True, the linear equations are solved with
+                    a sparse LU factorization (requires scipy).
+                load: If True, the values of the variables are set to
+                    the solution, and the solution is added as the
+                    last period, so that the next period starts from
+                    the steady state.
+
+            Returns: a dict of name -> value of the variables and
+                parameters.
+
+            Raises:
+                CalculationError:
+                SolutionNotFoundError:
+                ValueError: if iterations is less than 1
+        """
+        # pylint: disable=invalid-name, too-many-arguments, too-many-locals
+        if iterations < 1:
+            raise ValueError('iterations must be at least 1')
+        self._validate_equations()
+        context = self._get_context()
+        self._update_functions(context)
+        if self._compiled_steady is None:
+            self._parse_equations()
+            self._compiled_steady = compile_steady_state(self)
+        compiled = self._compiled_steady
+
+        jacobian = compiled.jacobian
+        data = jacobian.new_data()
+        size = jacobian.size
+        matrix = None if sparse else numpy.zeros((size, size))
+        convergence = Convergence(compiled.variables, atol=atol,
+                                  rtol=threshold)
+        state = [float(x) for x in context.values()]
+        for param in self._random_parameters.values():
+            state[param._index] = param.mean
+        for _ in range(iterations):
+            F = _evaluate_compiled_equations(self, compiled, context, state)
+            _evaluate_compiled_jacobian(self, compiled, context, state, data)
+            if sparse:
+                J = _csc_matrix(data, jacobian.rows, jacobian.indptr,
+                                jacobian.size)
+            else:
+                J = jacobian.dense(data, matrix)
+            dx = _steady_state_step(J, F)
+
+            prev = list(state)
+            for i, delta in zip(compiled.variables, dx.tolist()):
+                state[i] += delta
+            if convergence(prev, state):
+                break
+        else:
+            failed = set(convergence.failed(prev, state))
+            raise SolutionNotFoundError(
+                ', '.join(var.name for var in self.variables.values()
+                          if var._index in failed) + ' have not converged')
+
+        solution = {symbol.name: state[symbol._index]
+                    for symbol in context.keys()
+                    if symbol.name in self.variables or
+                    symbol.name in self.parameters}
+        if load:
+            self.set_values({name: solution[name] for name in self.variables})
+            self._update_solutions(solution)
+        return solution
+
+    def snapshot(self):
+        """ Takes a snapshot of the state of the model, new models
+            can be branched from the snapshot (see Snapshot).  The
+            model is compiled if needed, but not changed otherwise.
+
+            Only the periods needed by the lagged values are kept,
+            unless an equation uses a fixed period (such as x(5)),
+            then all of the periods are kept.
+
+            Returns: a Snapshot
+
+            Raises:
+                EquationError:
+        """
+        self.compile()
+        periods = self.periods
+        depth = 1
+        if self._uses_fixed_periods():
+            depth = periods
+        else:
+            for param in self._private_parameters.values():
+                depth = max(depth, -param.iteration)
+
+        state = self.__getstate__()
+        state['solutions'] = self._solutions.tail(depth)
+        state['dropped_periods'] = periods - len(state['solutions'])
+        state['generator'] = copy.deepcopy(self._generator())
+        return Snapshot(state, periods)
+
+    def _uses_fixed_periods(self):
+        """ Returns True if an equation uses the value of a fixed
+            period (such as x(5)), then all of the periods must be
+            kept in the solutions.
+        """
+        return any(param.iteration >= 0
+                   for param in self._private_parameters.values())
 
     def get_at(self, variable, iteration):
         """ Returns the variable for a previous iteration.
@@ -805,14 +2422,8 @@ class Model(object):
         else:
             iter_name = "_{0}_{1}".format(str(variable), iter_value)
 
-        if iter_name not in self._private_parameters:
-            param = SeriesParameter(iter_name,
-                                    variable=variable,
-                                    iteration=iter_value,
-                                    default=variable.default)
-            self._private_parameters[iter_name] = param
-            _add_param_to_context(self._local_context, param)
-            self._need_function_update = True
+        self._add_series_parameters(
+            [(iter_name, variable.name, iter_value, variable.default)])
         return self._private_parameters[iter_name]
 
     def get_value(self, variable, iteration):
@@ -833,7 +2444,7 @@ class Model(object):
                 returned. If the iteration is out of range, an
                 IndexError exception will be raised.
         """
-        return self.solutions[iteration][variable.name]
+        return self._solutions.value(variable.name, iteration)
 
     def evaluate(self, equation):
         """ Evaluates an arbitrary function using the current values
@@ -845,10 +2456,10 @@ class Model(object):
             Returns:
                 The value of the expression.
         """
-        equation = _rewrite(self.variables, self.parameters, equation)
-        expr = parse_expr(equation,
-                          self._local_context,
-                          transformations=(factorial_notation, auto_number))
+        expr = _parse_expression(equation,
+                                 self.variables,
+                                 self.parameters,
+                                 self._local_context)
         expr = sympify(expr).subs(self._get_context())
         for func in _RT_FUNCS:
             expr = expr.replace(func[2], func[1])
@@ -10,7 +10,7 @@ from builtins import range
 
 
 from pysolve3 import InvalidNameError
-from pysolve3.variable import ModVariable
+from pysolve3.variable import ModVariable, _new_symbol
 
 
 class Parameter(Symbol):
@@ -27,6 +27,13 @@ class Parameter(Symbol):
     """
     # pylint: disable=too-many-ancestors
 
+    def __new__(cls, name, *args, **kwargs):
+        # pylint: disable=unused-argument
+        return _new_symbol(cls, name)
+
+    def _hashable_content(self):
+        return super(Parameter, self)._hashable_content() + (self._token,)
+
     def __init__(self, name, desc=None, default=None):
         if name in ModVariable.ILLEGAL_NAMES:
             raise InvalidNameError(name, 'Name already used by sympy')
@@ -81,3 +88,52 @@ class SeriesParameter(Parameter):
                 self.variable, self.iteration)
         except IndexError:
             return self.variable.value or self.variable.default
+
+
+class RandomParameter(Parameter):
+    """ A parameter whose value is drawn for each period, this is
+        used for the stochastic terms of the equations, such as
+        normal(0, 1).
+
+        Attributes:
+            name:
+            distribution: 'normal' (standard normal), 'uniform'
+                (uniform over [0, 1)) or 'randint' (integers in
+                [low, high))
+            bounds: The (low, high) of 'randint'.
+            mean: The mean of the distribution.
+    """
+    # pylint: disable=too-many-ancestors
+
+    DISTRIBUTIONS = ('normal', 'uniform', 'randint')
+
+    def __init__(self, name, distribution=None, bounds=()):
+        if distribution not in RandomParameter.DISTRIBUTIONS:
+            raise ValueError('{0} is not a valid distribution'.format(
+                distribution))
+        self.distribution = distribution
+        self.bounds = tuple(bounds)
+        super(RandomParameter, self).__init__(name, default=self.mean)
+
+    @property
+    def mean(self):
+        """ The mean of the distribution """
+        if self.distribution == 'normal':
+            return 0.
+        if self.distribution == 'uniform':
+            return 0.5
+        return (self.bounds[0] + self.bounds[1] - 1) / 2.
+
+    def draw(self, generator, size=None):
+        """ Draws values from the distribution.
+
+            Arguments:
+                generator: A numpy.random.Generator
+                size: The number of values, a single value is
+                    returned if this is None.
+        """
+        if self.distribution == 'normal':
+            return generator.standard_normal(size)
+        if self.distribution == 'uniform':
+            return generator.random(size)
+        return generator.integers(self.bounds[0], self.bounds[1], size=size)
@@ -0,0 +1,232 @@
+""" Contains the functions used to run scenarios of a model in
+    parallel.
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+import concurrent.futures
+import pickle
+
+import numpy
+
+from pysolve3.model import Snapshot
+
+
+class Scenario(object):
+    """ A scenario of a model.
+
+        Attributes:
+            name: The name of the scenario, this is used as the key
+                of the results.
+            values: A dict of name -> value, set before the first
+                period is solved (for example parameter overrides).
+            shocks: A dict of period -> dict of name -> value.  The
+                values are set before solving that period (the first
+                period solved is period 0).
+    """
+    def __init__(self, name, values=None, shocks=None):
+        self.name = name
+        self.values = values or dict()
+        self.shocks = shocks or dict()
+
+    def __repr__(self):
+        return 'Scenario({0!r})'.format(self.name)
+
+
+def _run_scenario(data, scenario, periods, record, options, seed=None):
+    """ Runs a single scenario, this is called within the workers.
+
+        Arguments:
+            data: The pickled (compiled) model.
+            scenario: The Scenario to run.
+            periods: The number of periods to solve.
+            record: The names of the values to return.
+            options: The arguments passed to Model.simulate()
+            seed: If set, the seed of the random generator of the
+                model (see Model.seed()).
+
+        Returns: a (periods x record) array of the values
+    """
+    # pylint: disable=too-many-arguments
+    model = pickle.loads(data)
+    if seed is not None:
+        model.seed(seed)
+    return _simulate_scenario(model, scenario, periods, record, options)
+
+
+def _simulate_scenario(model, scenario, periods, record, options):
+    """ Runs a single scenario on the model (see _run_scenario()),
+        the model is changed.
+
+        Returns: a (periods x record) array of the values
+    """
+    model.set_values(scenario.values)
+
+    result = numpy.empty((periods, len(record)))
+    start = 0
+    for shock in sorted(scenario.shocks) + [None]:
+        end = periods if shock is None else min(max(shock, 0), periods)
+        if end > start:
+            history = model.simulate(end - start, record=record, **options)
+            result[start:end] = history.array
+            start = end
+        if shock is not None and shock < periods:
+            model.set_values(scenario.shocks[shock])
+    return result
+
+
+def _check_names(scenarios):
+    """ Returns the names of the scenarios
+
+        Raises:
+            ValueError: if the names of the scenarios are not unique
+    """
+    names = [scenario.name for scenario in scenarios]
+    if len(set(names)) != len(names):
+        raise ValueError('the names of the scenarios must be unique')
+    return names
+
+
+def _to_frame(names, periods, record, results):
+    """ Returns the (periods x record) arrays of the scenarios as a
+        pandas DataFrame, indexed by (scenario, period)
+    """
+    import pandas as pd
+    index = pd.MultiIndex.from_product([names, range(periods)],
+                                       names=['scenario', 'period'])
+    values = (numpy.concatenate(results) if results
+              else numpy.empty((0, len(record))))
+    return pd.DataFrame(values, index=index, columns=record)
+
+
+def _write_results(writer, futures, periods):
+    """ Writes the results of the futures (in order), the futures
+        are dropped once written so that their results are released.
+    """
+    keys = numpy.empty((periods, 2), dtype=numpy.int64)
+    keys[:, 1] = numpy.arange(periods)
+    futures.reverse()
+    scenario = 0
+    while futures:
+        keys[:, 0] = scenario
+        writer.write(futures.pop().result(), keys)
+        scenario += 1
+
+
+def run_scenarios(create_function, scenarios, periods, executor=None,
+                  record=None, seed=None, writer=None, **options):
+    """ Runs the scenarios of a model, spreading the runs over an
+        executor.
+
+        The model is created (and compiled) once, the workers get
+        the pickled compiled model and do not parse the equations.
+
+        Arguments:
+            create_function: A function that returns the model, this
+                is only called in the calling process.  The model may
+                already have been solved for some periods, each
+                scenario starts from the last solution.
+            scenarios: A list of Scenarios.
+            periods: The number of periods to solve.
+            executor: A concurrent.futures.Executor used to run
+                the scenarios.  By default a ProcessPoolExecutor
+                is created (and shut down when done).
+            record: The names of the variables/parameters to return
+                (all of the variables and parameters by default).
+            seed: If set, each scenario draws the stochastic terms of
+                the model from its own stream, spawned from this seed
+                (see numpy.random.SeedSequence), so the results do not
+                depend on the workers that run the scenarios.
+            writer: If set, the ResultWriter (see writers.py) the
+                results are written to, indexed by (scenario, period)
+                where scenario is the position of the scenario in the
+                list.  Each result is written (and released) as soon
+                as the scenarios before it are done.
+            options: The arguments passed to Model.simulate(), such
+                as method, iterations and threshold.
+
+        Returns: a pandas DataFrame, indexed by (scenario, period), or
+            the writer if it is set.
+
+        Raises:
+            ValueError: if the names of the scenarios are not unique
+    """
+    # pylint: disable=too-many-arguments, too-many-locals
+    names = _check_names(scenarios)
+
+    model = create_function()
+    model.compile()
+    if record is None and writer is not None:
+        record = writer.names
+    if record is None:
+        record = list(model.variables) + list(model.parameters)
+    if writer is not None:
+        writer.open(record, ('scenario', 'period'))
+    data = pickle.dumps(model, pickle.HIGHEST_PROTOCOL)
+    seeds = [None] * len(scenarios)
+    if seed is not None:
+        seeds = numpy.random.SeedSequence(seed).spawn(len(scenarios))
+
+    owned = executor is None
+    if owned:
+        executor = concurrent.futures.ProcessPoolExecutor()
+    try:
+        futures = [executor.submit(_run_scenario, data, scenario, periods,
+                                   record, options, child)
+                   for scenario, child in zip(scenarios, seeds)]
+        if writer is None:
+            results = [future.result() for future in futures]
+        else:
+            _write_results(writer, futures, periods)
+    finally:
+        if owned:
+            executor.shutdown()
+
+    if writer is not None:
+        return writer
+    return _to_frame(names, periods, record, results)
+
+
+def impulse_responses(baseline, scenarios, periods, record=None, **options):
+    """ Runs shock scenarios from the state of a solved model, and
+        returns the responses as the differences from the baseline
+        path (the path of the model without any shock).
+
+        Each scenario is branched from a snapshot of the model, the
+        equations are not parsed again, the periods before the
+        snapshot are not simulated again, and the baseline path is
+        simulated only once.  The model itself is not changed.
+
+        Arguments:
+            baseline: A solved Model, or a Snapshot of it (see
+                Model.snapshot()).
+            scenarios: A list of Scenarios, the shocks are given by
+                their values (set before the first period) and by
+                their schedule of shocks.
+            periods: The number of periods to solve.
+            record: The names of the variables/parameters to return
+                (all of the variables and parameters by default).
+            options: The arguments passed to Model.simulate(), such
+                as method, iterations and threshold.
+
+        Returns: a pandas DataFrame of the differences from the
+            baseline, indexed by (scenario, period)
+
+        Raises:
+            ValueError: if the names of the scenarios are not unique
+    """
+    names = _check_names(scenarios)
+    snapshot = baseline
+    if not isinstance(snapshot, Snapshot):
+        snapshot = baseline.snapshot()
+    if record is None:
+        record = snapshot.names
+
+    path = _simulate_scenario(snapshot.branch(), Scenario(None), periods,
+                              record, options)
+    results = [_simulate_scenario(snapshot.branch(), scenario, periods,
+                                  record, options) - path
+               for scenario in scenarios]
+    return _to_frame(names, periods, record, results)
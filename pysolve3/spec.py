@@ -0,0 +1,167 @@
+""" Contains the functions used to read model specification files.
+
+    A specification file declares a model as text, in sections:
+
+        # Model SIM (comments start with '#')
+        [defaults]
+        variables = 0
+        parameters = 0
+
+        [variables]
+        Cd          # Consumption goods demand by households
+        Hh = 0      # Cash money held by households
+
+        [parameters]
+        alpha1 = 0.6    # Propensity to consume out of income
+
+        [equations]
+        3.1: Cs = Cd    # the equation number is optional
+        Gs = Gd
+
+        [values]
+        Hh = 80
+
+    The '= value' of a variable or parameter is its default, the
+    [values] section sets the initial values.  A comment after an
+    entry is used as its description.
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+import re
+
+
+_SECTIONS = ('defaults', 'variables', 'parameters', 'equations', 'values')
+
+# An equation may be prefixed by its number, as in '3.1: Cs = Cd'
+_NUMBERED = re.compile(r'^\s*([0-9][\w.]*)\s*:(.*)$')
+
+_NAME = re.compile(r'^[A-Za-z_]\w*$')
+
+
+class SpecError(ValueError):
+    """ Exception: An error in the model specification was found
+
+        Arguments:
+            lineno: The line number of the error
+            line: The text of the line
+            text: A description of the error
+    """
+    def __init__(self, lineno, line, text):
+        super(SpecError, self).__init__()
+        self.text = 'Error in the specification:line {0} : {1} : {2}'.format(
+            lineno, line.strip(), text)
+        self.lineno = lineno
+
+    def __str__(self):
+        return self.text
+
+
+def _equation_line(line):
+    """ Splits a line of equations into (equation, desc, no), the
+        description and number are None if they are not given.
+
+        Returns: None if the line does not contain an equation
+    """
+    equation, _, desc = line.partition('#')
+    number = None
+    match = _NUMBERED.match(equation)
+    if match:
+        number, equation = match.group(1), match.group(2)
+    equation = equation.strip()
+    if not equation:
+        return None
+    return equation, desc.strip() or None, number
+
+
+def _value(text):
+    """ Returns the float value, or the text if it is an expression
+        (evaluated by Model.set_values())
+    """
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def _float(lineno, line, text):
+    """ Returns the float value of a default
+
+        Raises:
+            SpecError: if the text is not a number
+    """
+    try:
+        return float(text)
+    except ValueError:
+        raise SpecError(lineno, line, 'the default must be a number')
+
+
+def parse_spec(text):
+    """ Parses the text of a specification.
+
+        Arguments:
+            text: The specification.
+
+        Returns: a dict with the entries
+            defaults: a dict of 'variables'/'parameters' -> default
+            variables: a list of (name, desc, default)
+            parameters: a list of (name, desc, default)
+            equations: a list of (equation, desc, no)
+            values: a list of (name, value)
+            The result only contains plain data, it can be pickled.
+
+        Raises:
+            SpecError: if the specification is not valid
+    """
+    spec = {'defaults': dict(),
+            'variables': list(),
+            'parameters': list(),
+            'equations': list(),
+            'values': list()}
+    section = None
+    for lineno, line in enumerate(text.splitlines(), 1):
+        content, _, desc = line.partition('#')
+        content = content.strip()
+        if not content:
+            continue
+        if content.startswith('['):
+            section = content.strip('[]').strip().lower()
+            if not content.endswith(']') or section not in _SECTIONS:
+                raise SpecError(lineno, line, 'unknown section')
+            continue
+        if section is None:
+            raise SpecError(lineno, line, 'entry outside of a section')
+
+        if section == 'equations':
+            spec['equations'].append(_equation_line(line))
+            continue
+
+        name, equals, value = content.partition('=')
+        name = name.strip()
+        value = value.strip()
+        if not _NAME.match(name):
+            raise SpecError(lineno, line, 'not a valid name')
+        if equals and not value:
+            raise SpecError(lineno, line, 'missing value')
+
+        if section == 'defaults':
+            if name not in ('variables', 'parameters') or not equals:
+                raise SpecError(lineno, line,
+                                'expected variables = x or parameters = x')
+            spec['defaults'][name] = _float(lineno, line, value)
+        elif section == 'values':
+            if not equals:
+                raise SpecError(lineno, line, 'missing value')
+            spec['values'].append((name, _value(value)))
+        else:
+            default = _float(lineno, line, value) if equals else None
+            spec[section].append((name, desc.strip() or None, default))
+    return spec
+
+
+def read_spec(path):
+    """ Reads and parses a specification file (see parse_spec()) """
+    with open(path) as spec_file:
+        return parse_spec(spec_file.read())
@@ -0,0 +1,297 @@
+""" Contains the classes used to collect statistics of the solver,
+    and to profile the equations of a model.
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+import collections
+import json
+from time import perf_counter
+
+import numpy
+
+
+# The phases of an iteration that are timed
+PHASES = ('equations', 'jacobian', 'linear')
+
+
+def _timed(telemetry, phase, func, *args):
+    """ Calls func(*args), the time of the call is added to the phase
+        of the telemetry (if there is one).
+    """
+    if telemetry is None:
+        return func(*args)
+    start = perf_counter()
+    try:
+        return func(*args)
+    finally:
+        telemetry.timings[phase] += perf_counter() - start
+
+
+class SolverTelemetry(object):
+    """ Collects the statistics of the periods solved by the model,
+        see Model.solve() and Model.simulate().
+
+        Only the totals and the last capacity periods are kept, so a
+        telemetry can be used for any number of periods.  The records
+        of the periods can also be written to a JSON-lines file, one
+        line per period.  A record is a dict with the entries
+            period: The period of the model (the index of the period
+                in the solutions, counting the periods that are not
+                kept).
+            iterations: The number of iterations.
+            converged: False if the period did not converge.
+            seconds: The time taken to solve the period.
+            equations, jacobian, linear: The time spent evaluating
+                the equations, evaluating the jacobian and solving
+                the linear equations (factorizations included).
+            step_norm: The norm of the step of the last iteration,
+                the scaled change of the variables (see Convergence),
+                None if the convergence test was not used.  This is
+                not the norm of the residuals of the equations.
+
+        Arguments:
+            capacity: The number of periods (and norms) kept.
+            path: If set, the records are written to this file (the
+                file is truncated).
+            on_period_start: If set, called with the index of the
+                period before it is solved.
+            on_period_end: If set, called with the record of the
+                period after it is solved (or has failed).
+
+        Attributes:
+            records: The records of the last capacity periods.
+            norms: The (period, iteration, step norm) of the last
+                capacity iterations.
+            timings: The total time spent in each phase.
+            periods: The number of periods solved.
+            iterations: The total number of iterations.
+            failures: The number of periods that did not converge.
+            seconds: The total time spent solving the periods.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, capacity=1000, path=None, on_period_start=None,
+                 on_period_end=None):
+        self.records = collections.deque(maxlen=capacity)
+        self.norms = collections.deque(maxlen=capacity)
+        self.timings = dict.fromkeys(PHASES, 0.)
+        self.periods = 0
+        self.iterations = 0
+        self.failures = 0
+        self.seconds = 0.
+        self.on_period_start = on_period_start
+        self.on_period_end = on_period_end
+
+        self._file = open(path, 'w') if path is not None else None
+        self._period = None
+        self._start = None
+        self._timings = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Closes the JSON-lines file """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def start_period(self, period):
+        """ Called before the period is solved """
+        if self.on_period_start is not None:
+            self.on_period_start(period)
+        self._period = period
+        self._timings = dict(self.timings)
+        self._start = perf_counter()
+
+    def end_period(self, iterations, converged, norms):
+        """ Called when the period has been solved (or has failed),
+            norms are the step norms of the iterations.
+
+            Returns: the record of the period
+        """
+        seconds = perf_counter() - self._start
+        record = {'period': self._period,
+                  'iterations': iterations,
+                  'converged': converged,
+                  'seconds': seconds}
+        for phase in PHASES:
+            record[phase] = self.timings[phase] - self._timings[phase]
+        record['step_norm'] = norms[-1] if norms else None
+
+        self.records.append(record)
+        self.norms.extend((self._period, i, norm)
+                          for i, norm in enumerate(norms))
+        self.periods += 1
+        self.iterations += iterations
+        self.failures += not converged
+        self.seconds += seconds
+
+        if self._file is not None:
+            self._file.write(json.dumps(record) + '\n')
+        if self.on_period_end is not None:
+            self.on_period_end(record)
+        return record
+
+    def summary(self):
+        """ Returns a dict with the totals: periods, iterations,
+            failures, seconds and the time of each phase.
+        """
+        summary = {'periods': self.periods,
+                   'iterations': self.iterations,
+                   'failures': self.failures,
+                   'seconds': self.seconds}
+        summary.update(self.timings)
+        return summary
+
+    def slowest(self, count=10):
+        """ Returns the records of the slowest periods (of the
+            periods that are kept)
+        """
+        return sorted(self.records, key=lambda x: -x['seconds'])[:count]
+
+
+class EquationProfiler(object):
+    """ Profiles the equations of a model, to find the equations that
+        drive the number of iterations (see Model.solve() and
+        Model.simulate()).
+
+        For each iteration (sweep), the change of each variable is
+        scaled by its tolerances (see Convergence.errors()).  A
+        variable has not converged in a sweep if its scaled change is
+        more than 1, and it oscillates if its change has the opposite
+        sign of the change in the previous sweep of the period.
+
+        With the gauss-seidel method, each equation is evaluated by
+        its own function (rather than by the compiled model), and the
+        time of each evaluation is recorded.  The other methods only
+        record the changes of the variables.
+
+        Attributes:
+            names: The names of the variables (in the order of the
+                model), each variable is defined by one equation.
+            equations: The text of the equations of the variables.
+            seconds: The time spent evaluating each equation.
+            evaluations: The number of evaluations of each equation.
+            unconverged: The number of sweeps in which each variable
+                had not converged.
+            oscillations: The number of sweeps in which each variable
+                changed direction (while it had not converged).
+            errors: The largest scaled change of each variable.
+            sweeps: The number of sweeps.
+            periods: The number of periods.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self):
+        self.names = []
+        self.equations = []
+        self.seconds = numpy.zeros(0)
+        self.evaluations = numpy.zeros(0, dtype=int)
+        self.unconverged = numpy.zeros(0, dtype=int)
+        self.oscillations = numpy.zeros(0, dtype=int)
+        self.errors = numpy.zeros(0)
+        self.sweeps = 0
+        self.periods = 0
+        self._rows = dict()
+        self._delta = None
+
+    def setup(self, model):
+        """ Prepares the profiler for the variables of the model, the
+            statistics are cleared if the variables have changed.
+        """
+        names = list(model.variables)
+        if names == self.names:
+            return
+        size = len(names)
+        self.__init__()
+        self.names = names
+        self.equations = [var.equation.equation
+                          for var in model.variables.values()]
+        self.seconds = numpy.zeros(size)
+        self.evaluations = numpy.zeros(size, dtype=int)
+        self.unconverged = numpy.zeros(size, dtype=int)
+        self.oscillations = numpy.zeros(size, dtype=int)
+        self.errors = numpy.zeros(size)
+        self._rows = {name: i for i, name in enumerate(names)}
+
+    def start_period(self):
+        """ Called before the period is solved """
+        self.periods += 1
+        self._delta = None
+
+    def evaluate(self, variable, values):
+        """ Evaluates the equation of the variable, recording the time
+            of the evaluation.
+
+            Returns: the value of the equation
+        """
+        row = self._rows[variable.name]
+        start = perf_counter()
+        try:
+            return variable.equation.func(*values)
+        finally:
+            self.seconds[row] += perf_counter() - start
+            self.evaluations[row] += 1
+
+    def sweep(self, convergence, current, next_soln):
+        """ Records the changes of the variables during a sweep,
+            convergence is the test of the variables of the model.
+        """
+        prev = convergence.values(current)
+        delta = convergence.values(next_soln)
+        errors = convergence.errors(prev, delta)
+        delta -= prev
+
+        moving = errors > 1.
+        self.unconverged += moving
+        numpy.maximum(self.errors, errors, out=self.errors)
+        if self._delta is not None:
+            self.oscillations += moving & (delta * self._delta < 0)
+        self._delta = delta
+        self.sweeps += 1
+
+    def costliest(self, count=10):
+        """ Returns the (name, seconds) of the equations that took the
+            most time to evaluate
+        """
+        return self._largest(self.seconds, count)
+
+    def slowest(self, count=10):
+        """ Returns the (name, sweeps) of the variables that needed
+            the most sweeps to converge
+        """
+        return self._largest(self.unconverged, count)
+
+    def oscillating(self, count=10):
+        """ Returns the (name, oscillations) of the variables that
+            changed direction most often
+        """
+        return self._largest(self.oscillations, count)
+
+    def _largest(self, values, count):
+        """ Returns the (name, value) of the largest values, values
+            of 0 are left out.
+        """
+        order = numpy.argsort(-values, kind='stable')[:count]
+        return [(self.names[i], values[i].item())
+                for i in order if values[i] > 0]
+
+    def to_frame(self):
+        """ Returns the statistics as a pandas DataFrame, indexed by
+            the names of the variables
+        """
+        import pandas as pd
+        return pd.DataFrame({'equation': self.equations,
+                             'seconds': self.seconds,
+                             'evaluations': self.evaluations,
+                             'unconverged': self.unconverged,
+                             'oscillations': self.oscillations,
+                             'error': self.errors},
+                            index=pd.Index(self.names, name='variable'))
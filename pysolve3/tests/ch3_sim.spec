@@ -0,0 +1,39 @@
+# Model SIM, chapter 3 of Godley and Lavoie
+[defaults]
+variables = 0
+
+[variables]
+Cd          # Consumption goods demand by households
+Cs          # Consumption goods supply
+Gs          # Government goods, supply
+Hh          # Cash money held by households
+Hs          # Cash money supplied by the government
+Nd          # Demand for labor
+Ns          # Supply of labor
+Td          # Taxes, demand
+Ts          # Taxes, supply
+Y           # Income = GDP
+YD          # Disposable income of households
+
+[parameters]
+Gd = 20         # Government goods, demand
+W = 1           # Wage rate
+alpha1 = 0.6    # Propensity to consume out of income
+alpha2 = 0.4    # Propensity to consume out of wealth
+theta = 0.2     # Tax rate
+
+[equations]
+3.1: Cs = Cd
+3.2: Gs = Gd
+3.3: Ts = Td
+3.4: Ns = Nd
+3.5: YD = (W*Ns) - Ts
+3.6: Td = theta * W * Ns
+3.7: Cd = alpha1*YD + alpha2*Hh(-1)     # consumption function
+3.8: Hs - Hs(-1) =  Gd - Td
+3.9: Hh - Hh(-1) = YD - Cd
+3.10: Y = Cs + Gs
+3.11: Nd = Y/W
+
+[values]
+Hh = 0
@@ -5,14 +5,47 @@
 
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import pickle
+import shutil
+import tempfile
 import unittest
 
 import numpy
 
+try:
+    import scipy
+except ImportError:
+    scipy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from pysolve import batch
 from pysolve.equation import EquationError
 from pysolve.model import Model, DuplicateNameError, SolutionNotFoundError
 from pysolve.model import CalculationError
-from pysolve.utils import round_solution, is_close
+from pysolve.scenarios import Scenario, impulse_responses, run_scenarios
+from pysolve.spec import SpecError, parse_spec, read_spec
+from pysolve.telemetry import EquationProfiler, SolverTelemetry
+from pysolve.utils import round_solution, is_close, Convergence
+from pysolve.writers import CSVWriter, NpyWriter, ParquetWriter
+from pysolve.writers import ResultWriter, create_writer
+
+
+def _simple_model(equation='y = 0.5*x', cache_dir=None):
+    """ Creates the small model with a lag used by several tests """
+    model = Model(cache_dir=cache_dir)
+    model.var('x', default=1)
+    model.var('y', default=2)
+    model.param('a', default=0.5)
+    model.add('x = a*y + 1 + x(-1)/10')
+    model.add(equation)
+    return model
 
 
 class TestModel(unittest.TestCase):
@@ -357,6 +390,18 @@ class TestModel(unittest.TestCase):
         self.assertEquals(6.5, model.solutions[1]['x'])
         self.assertEquals(1, model.solutions[1]['y'])
 
+        # the step function does not change the jacobian of the blocks
+        for method in ['block-gauss-seidel', 'block-newton']:
+            model = Model()
+            model.var('x', default=0)
+            model.var('y', default=0)
+            model.add('2*x = 12 + y')
+            model.add('y = if_true(x > 5)')
+            model.compile()
+            model.solve(iterations=10, threshold=1e-4, method=method)
+            self.assertEquals(6.5, model.solutions[1]['x'])
+            self.assertEquals(1, model.solutions[1]['y'])
+
     def test_newton_raphson(self):
         """ Test solving with Newton-Raphson, instead of the
             default Gauss-Seidel
@@ -550,3 +595,977 @@ class TestModel(unittest.TestCase):
         self.assertTrue(numpy.isclose(12.3, soln['Hh']))
         self.assertTrue(numpy.isclose(0, soln['_Hs__1']))
         self.assertTrue(numpy.isclose(0, soln['_Hh__1']))
+
+    def test_compiled(self):
+        """ Test solving with the compiled step function """
+        # pylint: disable=too-many-statements
+        model = Model()
+        model.set_var_default(0)
+        model.vars('Y', 'YD', 'Ts', 'Td', 'Hs', 'Hh', 'Gs', 'Cs',
+                   'Cd', 'Ns', 'Nd')
+        model.set_param_default(0)
+        model.param('Gd', default=20.)
+        model.param('W', default=1.0)
+        model.param('alpha1', default=0.6)
+        model.param('alpha2', default=0.4)
+        model.param('theta', default=0.2)
+
+        model.add('Cs = Cd')
+        model.add('Gs = Gd')
+        model.add('Ts = Td')
+        model.add('Ns = Nd')
+        model.add('YD = (W*Ns) - Ts')
+        model.add('Td = theta * W * Ns')
+        model.add('Cd = alpha1*YD + alpha2*Hh(-1)')
+        model.add('Hs - Hs(-1) =  Gd - Td')
+        model.add('Hh - Hh(-1) = YD - Cd')
+        model.add('Y = Cs + Gs')
+        model.add('Nd = Y/W')
+
+        compiled = model.compile()
+        self.assertEquals(compiled, model.compile())
+        self.assertEquals(0, compiled.index['Y'])
+
+        model.solve(iterations=100, threshold=1e-4, compiled=True)
+        soln = round_solution(model.solutions[-1], decimals=1)
+        self.assertTrue(numpy.isclose(38.5, soln['Y']))
+        self.assertTrue(numpy.isclose(7.7, soln['Ts']))
+        self.assertTrue(numpy.isclose(30.8, soln['YD']))
+        self.assertTrue(numpy.isclose(18.5, soln['Cs']))
+        self.assertTrue(numpy.isclose(12.3, soln['Hs']))
+        self.assertTrue(numpy.isclose(12.3, soln['Hh']))
+
+        model.solve(iterations=100, threshold=1e-4,
+                    method='newton-raphson', compiled=True)
+        soln = round_solution(model.solutions[-1], decimals=1)
+        self.assertTrue(numpy.isclose(47.9, soln['Y']))
+        self.assertTrue(numpy.isclose(22.7, soln['Hs']))
+
+        model.solve(iterations=100, threshold=1e-4,
+                    method='broyden', compiled=True)
+        soln = round_solution(model.solutions[-1], decimals=1)
+        self.assertTrue(numpy.isclose(55.9, soln['Y']))
+        self.assertTrue(numpy.isclose(31.5, soln['Hs']))
+
+    def test_compiled_jacobian(self):
+        """ Test the compiled jacobian """
+        model = Model()
+        model.var('x', default=2)
+        model.var('y', default=3)
+        model.param('a', default=5)
+        model.add('x = a*y**2 + exp(y)')
+        model.add('y = x/a + exp(y)')
+
+        compiled = model.compile()
+        jacobian = compiled.jacobian
+        state = [float(model._get_context()[v]) for v in model._arg_list]
+        data = jacobian.new_data()
+        jacobian.fill(state, data)
+        J = jacobian.dense(data)
+
+        expected = numpy.array([[1, -(2*5*3 + numpy.exp(3))],
+                                [-1./5, 1 - numpy.exp(3)]])
+        self.assertTrue(numpy.allclose(expected, J))
+
+    def test_jacobian_abs(self):
+        """ Test the jacobian of a model with abs() """
+        def _create_abs_model():
+            """ Creates the model """
+            model = Model()
+            model.var('x', default=1)
+            model.var('y', default=2)
+            model.param('a', default=0.5)
+            model.add('x = a*y + 1 + x(-1)/10')
+            model.add('y = abs(x-3)/10')
+            return model
+
+        model = _create_abs_model()
+        model.solve(iterations=100, threshold=1e-10)
+        expected = model.solutions[-1]
+
+        for options in [dict(compiled=True),
+                        dict(method='newton-raphson'),
+                        dict(method='newton-raphson', compiled=True),
+                        dict(method='broyden', compiled=True),
+                        dict(method='block-newton')]:
+            model = _create_abs_model()
+            model.solve(iterations=100, threshold=1e-10, **options)
+            self.assertTrue(abs(expected['x'] - model.solutions[-1]['x'])
+                            < 1e-6)
+            self.assertTrue(abs(expected['y'] - model.solutions[-1]['y'])
+                            < 1e-6)
+
+        # d|x-3|/dx = sign(x-3) = -1
+        compiled = model.compile()
+        state = [float(model._get_context()[v]) for v in model._arg_list]
+        data = compiled.jacobian.new_data()
+        compiled.jacobian.fill(state, data)
+        self.assertTrue(numpy.allclose([[1, -0.5], [0.1, 1]],
+                                       compiled.jacobian.dense(data)))
+
+        model = _create_abs_model()
+        model.simulate(3, iterations=100, method='newton-raphson')
+        self.assertEquals(4, len(model.solutions))
+
+    def test_compiled_calculation_error(self):
+        """ Test an error while calculating with the compiled model """
+        model = Model()
+        model.var('y', default=0)
+        model.var('x', default=0)
+        model.add('y = 2/x')
+        model.add('x = 12')
+
+        with self.assertRaises(CalculationError) as context:
+            model.solve(iterations=10, threshold=1e-4, compiled=True)
+        self.assertTrue(isinstance(context.exception.inner, ZeroDivisionError))
+        self.assertEquals(model.equations[0], context.exception.equation)
+
+    def test_blocks(self):
+        """ Test the block decomposition of the equations """
+        model = Model()
+        model.set_var_default(0)
+        model.vars('Y', 'YD', 'C', 'T', 'H')
+        model.param('G', default=20)
+        model.param('alpha1', default=0.6)
+        model.param('alpha2', default=0.4)
+        model.param('theta', default=0.2)
+
+        model.add('H - H(-1) = YD - C')
+        model.add('Y = C + G')
+        model.add('T = theta*Y')
+        model.add('YD = Y - T')
+        model.add('C = alpha1*YD + alpha2*H(-1)')
+
+        blocks = [[eqn.variable.name for eqn in block]
+                  for block in model.blocks()]
+        self.assertEquals([['Y', 'T', 'YD', 'C'], ['H']], blocks)
+
+        compiled = model.compile()
+        self.assertEquals([True, False],
+                          [block.simultaneous for block in compiled.blocks])
+
+        for method in ['block-gauss-seidel', 'block-newton']:
+            model.solutions = []
+            model.set_values({'Y': 0, 'YD': 0, 'C': 0, 'T': 0, 'H': 0})
+            model.solve(iterations=100, threshold=1e-6, method=method)
+            soln = round_solution(model.solutions[-1], decimals=1)
+            self.assertTrue(numpy.isclose(38.5, soln['Y']))
+            self.assertTrue(numpy.isclose(7.7, soln['T']))
+            self.assertTrue(numpy.isclose(30.8, soln['YD']))
+            self.assertTrue(numpy.isclose(18.5, soln['C']))
+            self.assertTrue(numpy.isclose(12.3, soln['H']))
+
+    def test_block_failure(self):
+        """ Test for divergence of a simultaneous block """
+        model = Model()
+        model.var('x', default=1.1)
+        model.var('y', default=2.3)
+        model.add('2*x = 11 - 3*y')
+        model.add('7*y = 13 - 5*x')
+
+        with self.assertRaises(SolutionNotFoundError):
+            model.solve(iterations=100, threshold=1e-4,
+                        method='block-gauss-seidel')
+
+    @unittest.skipIf(scipy is None, 'requires scipy')
+    def test_newton_raphson_sparse(self):
+        """ Test solving with Newton-Raphson using a sparse jacobian """
+        model = Model()
+        model.set_var_default(0)
+        model.vars('Y', 'YD', 'C', 'T', 'H')
+        model.param('G', default=20)
+        model.param('alpha1', default=0.6)
+        model.param('alpha2', default=0.4)
+        model.param('theta', default=0.2)
+
+        model.add('H - H(-1) = YD - C')
+        model.add('Y = C + G')
+        model.add('T = theta*Y')
+        model.add('YD = Y - T')
+        model.add('C = alpha1*YD + alpha2*H(-1)')
+
+        model.solve(iterations=100, threshold=1e-6,
+                    method='newton-raphson', sparse=True)
+        soln = round_solution(model.solutions[-1], decimals=1)
+        self.assertTrue(numpy.isclose(38.5, soln['Y']))
+        self.assertTrue(numpy.isclose(7.7, soln['T']))
+        self.assertTrue(numpy.isclose(30.8, soln['YD']))
+        self.assertTrue(numpy.isclose(18.5, soln['C']))
+        self.assertTrue(numpy.isclose(12.3, soln['H']))
+
+        model.solve(iterations=100, threshold=1e-6,
+                    method='newton-raphson', sparse=True)
+        soln = round_solution(model.solutions[-1], decimals=1)
+        self.assertTrue(numpy.isclose(47.9, soln['Y']))
+        self.assertTrue(numpy.isclose(22.7, soln['H']))
+
+    def test_modified_newton(self):
+        """ Test the modified Newton method, reusing the factorization """
+        model = Model()
+        model.set_var_default(0)
+        model.vars('Y', 'YD', 'C', 'T', 'H')
+        model.param('G', default=20)
+        model.param('alpha1', default=0.6)
+        model.param('alpha2', default=0.4)
+        model.param('theta', default=0.2)
+
+        model.add('H - H(-1) = YD - C')
+        model.add('Y = C + G')
+        model.add('T = theta*Y')
+        model.add('YD = Y - T')
+        model.add('C = alpha1*YD + alpha2*H(-1)')
+
+        for _ in range(3):
+            model.solve(iterations=100, threshold=1e-6,
+                        method='newton-raphson', compiled=True,
+                        modified=True)
+        soln = round_solution(model.solutions[-1], decimals=1)
+        self.assertTrue(numpy.isclose(55.9, soln['Y']))
+        self.assertTrue(numpy.isclose(31.5, soln['H']))
+
+        # the model is linear, the jacobian never changes
+        solver = model.get_solver('newton-raphson')
+        self.assertEquals(1, solver.refactorizations)
+
+    def test_broyden_limited_memory(self):
+        """ Test the limited-memory Broyden method, with the
+            approximate inverse jacobian carried across periods
+        """
+        model = Model()
+        model.set_var_default(0)
+        model.vars('Y', 'YD', 'C', 'T', 'H')
+        model.param('G', default=20)
+        model.param('alpha1', default=0.6)
+        model.param('alpha2', default=0.4)
+        model.param('theta', default=0.2)
+
+        model.add('H - H(-1) = YD - C')
+        model.add('Y = C + G')
+        model.add('T = theta*Y')
+        model.add('YD = Y - T')
+        model.add('C = alpha1*YD + alpha2*H(-1)')
+
+        for _ in range(3):
+            model.solve(iterations=100, threshold=1e-6,
+                        method='broyden', memory=2)
+        soln = round_solution(model.solutions[-1], decimals=1)
+        self.assertTrue(numpy.isclose(55.9, soln['Y']))
+        self.assertTrue(numpy.isclose(44.8, soln['YD']))
+        self.assertTrue(numpy.isclose(31.5, soln['H']))
+
+        solver = model.get_solver('broyden')
+        self.assertTrue(len(solver._updates) <= 2)
+
+        # by default the jacobian is factorized again once there are
+        # as many updates as variables
+        for _ in range(5):
+            model.solve(iterations=100, threshold=1e-6, method='broyden')
+        solver = model.get_solver('broyden')
+        self.assertTrue(len(solver._updates) <= len(model.variables))
+        soln = round_solution(model.solutions[-1], decimals=1)
+        self.assertTrue(numpy.isclose(80.9, soln['Y']))
+
+    def test_solution_history(self):
+        """ Test the columnar solution history """
+        model = Model()
+        varx = model.var('x', default=1)
+        model.var('y', default=2)
+        model.add('x = x(-1) + 1')
+        model.add('y = 2*x')
+
+        for _ in range(3):
+            model.solve(iterations=10, threshold=1e-4)
+
+        self.assertEquals(4, len(model.solutions))
+        self.assertTrue(numpy.allclose([1, 2, 3, 4], model.series('x')))
+        self.assertTrue(numpy.allclose([2, 4, 6, 8], model.series('y')))
+        self.assertEquals(4, model.solutions[-1]['x'])
+        self.assertEquals(3, model.solutions[-1]['_x__1'])
+        self.assertEquals(3, model.get_value(varx, -2))
+
+        # the series is a view of the stored solutions
+        series = model.series('x')
+        self.assertTrue(numpy.shares_memory(series,
+                                            model.solutions.array))
+
+        soln = model.solutions[-1].copy()
+        self.assertEquals(4, soln['x'])
+        with self.assertRaises(TypeError):
+            model.solutions[-1]['x'] = 12
+
+    def test_lag_table(self):
+        """ Test that the lag table matches the series parameters """
+        model = Model()
+        model.var('x', default=1)
+        model.var('y', default=2)
+        model.add('x = x(-1) + 1')
+        model.add('y = x(-3) + x(1)')
+
+        for _ in range(5):
+            # pylint: disable=protected-access
+            context = model._get_context()
+            for param in model._private_parameters.values():
+                self.assertEquals(param.value, context[param])
+            model.solve(iterations=10, threshold=1e-4)
+
+        # out of range iterations use the current value of x
+        self.assertTrue(numpy.allclose([2, 2, 4, 3, 4, 5],
+                                       model.series('y')))
+
+    def test_simulate(self):
+        """ Test that simulate() matches solving period by period """
+        def create_model(fixed='x(1)'):
+            model = Model()
+            model.var('x', default=1)
+            model.var('y', default=2)
+            model.param('a', default=0.5)
+            model.add('x = a*x(-1) + 1 + y(-2)/10')
+            model.add('y = x(-3) + d(x) + ' + fixed)
+            return model
+
+        model = create_model()
+        for _ in range(10):
+            model.solve(iterations=10, threshold=1e-6)
+
+        simulated = create_model()
+        history = simulated.simulate(10, iterations=10, threshold=1e-6)
+        self.assertTrue(history is simulated.solutions)
+        self.assertEquals(11, len(history))
+        self.assertTrue(numpy.allclose(model.series('y'),
+                                       simulated.series('y')))
+        self.assertEquals(model.variables['x'].value,
+                          simulated.variables['x'].value)
+
+        # record only y, then continue solving the model
+        model = create_model(fixed='a')
+        for _ in range(10):
+            model.solve(iterations=10, threshold=1e-6)
+        recorded = create_model(fixed='a')
+        history = recorded.simulate(6, iterations=10, threshold=1e-6,
+                                    record=['y'])
+        self.assertEquals(['y'], history.names)
+        self.assertTrue(numpy.allclose(model.series('y')[1:7],
+                                       history.column('y')))
+        for _ in range(4):
+            recorded.solve(iterations=10, threshold=1e-6)
+        self.assertEquals(model.solutions[-1]['y'],
+                          recorded.solutions[-1]['y'])
+
+        # with a fixed period, all of the periods are kept
+        model = create_model()
+        for _ in range(10):
+            model.solve(iterations=10, threshold=1e-6)
+        recorded = create_model()
+        recorded.simulate(6, iterations=10, threshold=1e-6, record=['y'])
+        self.assertEquals(7, len(recorded.solutions))
+        for _ in range(4):
+            recorded.solve(iterations=10, threshold=1e-6)
+        self.assertTrue(numpy.allclose(model.series('y'),
+                                       recorded.series('y')))
+
+        with self.assertRaises(ValueError):
+            create_model().simulate(2, record=['z'])
+
+    def test_simulate_batch(self):
+        """ Test solving many scenarios at once """
+        def create_model():
+            model = Model()
+            model.var('x', default=1)
+            model.var('y', default=2)
+            model.param('a', default=0.5)
+            model.add('x = a*y + 1 + x(-1)/10')
+            model.add('y = 0.5*x + exp(-x(-2))')
+            return model
+
+        alphas = [0.1, 0.5, 0.9]
+        for method in ['gauss-seidel', 'newton-raphson']:
+            history = create_model().simulate_batch(
+                5, {'a': alphas}, method=method, iterations=100,
+                threshold=1e-8)
+            self.assertEquals(5, len(history))
+            self.assertEquals(3, history.scenarios)
+            self.assertFalse(history.failed.any())
+            for i, alpha in enumerate(alphas):
+                model = create_model()
+                model.set_values({'a': alpha})
+                model.simulate(5, method=method, iterations=100,
+                               threshold=1e-8)
+                self.assertTrue(numpy.allclose(model.series('x')[1:],
+                                               history.column('x')[:, i]))
+                self.assertTrue(numpy.allclose(
+                    model.series('y')[1:],
+                    history.scenario(i).column('y')))
+
+        # the scenarios are solved in chunks of bounded memory
+        self.addCleanup(setattr, batch, '_NEWTON_MEMORY',
+                        batch._NEWTON_MEMORY)
+        batch._NEWTON_MEMORY = 2 * 2 * 8
+        chunked = create_model().simulate_batch(
+            5, {'a': alphas}, method='newton-raphson', iterations=100,
+            threshold=1e-8)
+        self.assertTrue(numpy.array_equal(history.array, chunked.array))
+        chunked = create_model().simulate_batch(
+            1, {'a': alphas}, method='newton-raphson', iterations=1,
+            threshold=1e-12, atol=1e-12)
+        self.assertTrue(chunked.failed.all())
+
+        # the scenario that diverges is marked as failed
+        history = create_model().simulate_batch(
+            3, {'a': [0.5, 4.0]}, iterations=20, record=['x'])
+        self.assertEquals(['x'], history.names)
+        self.assertEquals([False, True], history.failed.tolist())
+        self.assertTrue(numpy.isnan(history.column('x')[:, 1]).all())
+        self.assertEquals((6, 1), history.to_frame().shape)
+
+        # the convergence test is the one of simulate()
+        for tolerances in [{'x': 1e-12, 'y': 1e-2}, 1e-2]:
+            history = create_model().simulate_batch(
+                5, {'a': [0.5, 0.5]}, iterations=100, threshold=tolerances,
+                atol=1e-12, norm='rms')
+            model = create_model()
+            model.simulate(5, iterations=100, threshold=tolerances,
+                           atol=1e-12, norm='rms')
+            self.assertTrue(numpy.allclose(model.series('x')[1:],
+                                           history.column('x')[:, 1],
+                                           rtol=1e-12, atol=0))
+        loose = history.column('x')[:, 0]
+        history = create_model().simulate_batch(5, {'a': [0.5]},
+                                                iterations=100,
+                                                threshold=1e-12, atol=1e-12)
+        self.assertFalse(numpy.allclose(loose, history.column('x')[:, 0],
+                                        rtol=1e-12, atol=0))
+
+        with self.assertRaises(ValueError):
+            create_model().simulate_batch(2, {'a': [1, 2]}, norm='l1')
+        with self.assertRaises(ValueError):
+            create_model().simulate_batch(2, {'a': [1, 2]},
+                                          threshold={'a': 1e-3})
+        with self.assertRaises(ValueError):
+            create_model().simulate_batch(2, {'z': [1, 2]})
+        with self.assertRaises(ValueError):
+            create_model().simulate_batch(2, {'a': [1, 2]}, method='broyden')
+
+    def test_pickle(self):
+        """ Test pickling a compiled model """
+        model = _simple_model()
+        model.simulate(3)
+
+        copy = pickle.loads(pickle.dumps(model))
+        self.assertEquals(list(model.variables), list(copy.variables))
+        self.assertEquals(4, len(copy.solutions))
+        self.assertEquals(model.solutions[-1]['x'], copy.solutions[-1]['x'])
+
+        # the compiled model is used, the equations are not parsed
+        model.simulate(3)
+        copy.simulate(3)
+        self.assertTrue(copy.equations[0].expr is None)
+        self.assertEquals(model.solutions[-1]['x'], copy.solutions[-1]['x'])
+
+        # the equations are parsed when they are needed
+        model.solve()
+        copy.solve()
+        self.assertFalse(copy.equations[0].expr is None)
+        self.assertEquals(model.solutions[-1]['x'], copy.solutions[-1]['x'])
+
+    def test_run_scenarios(self):
+        """ Test running scenarios with an executor """
+        scenarios = [Scenario('base'),
+                     Scenario('low', values={'a': 0.1}),
+                     Scenario('shock', shocks={2: {'a': 0.9}})]
+        with ThreadPoolExecutor(2) as executor:
+            frame = run_scenarios(_simple_model, scenarios, 4,
+                                  executor=executor, record=['x', 'a'],
+                                  iterations=100, threshold=1e-6)
+        self.assertEquals((12, 2), frame.shape)
+        self.assertEquals([0.5, 0.5, 0.9, 0.9],
+                          frame.loc['shock']['a'].tolist())
+
+        model = _simple_model()
+        model.simulate(2, iterations=100, threshold=1e-6)
+        model.set_values({'a': 0.9})
+        model.simulate(2, iterations=100, threshold=1e-6)
+        self.assertEquals(model.solutions[-1]['x'],
+                          frame.loc[('shock', 3), 'x'])
+
+        # the default executor is a process pool
+        other = run_scenarios(_simple_model, scenarios, 4,
+                              record=['x', 'a'], iterations=100,
+                              threshold=1e-6)
+        self.assertTrue(numpy.allclose(frame.values, other.values))
+
+    def test_compile_cache(self):
+        """ Test storing the compiled model on disk """
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        def create_model(equation='y = 0.5*x'):
+            return _simple_model(equation, cache_dir=cache_dir)
+
+        model = create_model()
+        model.simulate(3)
+        self.assertEquals(1, len(os.listdir(cache_dir)))
+
+        # the second model uses the cache, the equations are not parsed
+        cached = create_model()
+        cached.simulate(3)
+        self.assertTrue(cached.equations[0].expr is None)
+        self.assertEquals('_x__1', list(cached._private_parameters)[0])
+        self.assertEquals(model.solutions[-1]['x'], cached.solutions[-1]['x'])
+
+        # a different equation is another entry
+        other = create_model('y = 0.25*x')
+        other.simulate(3)
+        self.assertFalse(other.equations[0].expr is None)
+        self.assertEquals(2, len(os.listdir(cache_dir)))
+
+        # an unreadable entry is ignored
+        for name in os.listdir(cache_dir):
+            with open(os.path.join(cache_dir, name), 'wb') as cache_file:
+                cache_file.write(b'garbage')
+        broken = create_model()
+        broken.simulate(3)
+        self.assertEquals(model.solutions[-1]['x'], broken.solutions[-1]['x'])
+
+    def test_add_many(self):
+        """ Test adding a block of equations """
+        model = Model()
+        model.var('x', default=1)
+        model.var('y', default=2)
+        model.param('a', default=0.5)
+        equations = model.add_many("""
+            # the equations of the model
+            x = a*y + 1 + x(-1)/10   # x depends on its previous value
+
+            y = 0.5*x
+            """)
+        self.assertEquals(2, len(equations))
+        self.assertEquals('x = a*y + 1 + x(-1)/10', equations[0].equation)
+        self.assertEquals('x depends on its previous value',
+                          equations[0].desc)
+        self.assertEquals(None, equations[1].desc)
+        self.assertEquals(model.variables['y'], equations[1].variable)
+        self.assertTrue('_x__1' in model._private_parameters)
+
+        other = Model()
+        other.var('x', default=1)
+        other.var('y', default=2)
+        other.param('a', default=0.5)
+        other.add('x = a*y + 1 + x(-1)/10')
+        other.add('y = 0.5*x')
+        model.solve(iterations=100)
+        other.solve(iterations=100)
+        self.assertEquals(other.solutions[-1]['x'], model.solutions[-1]['x'])
+
+        with self.assertRaises(EquationError) as context:
+            model.add_many('x = (y')
+        self.assertEquals('syntax', context.exception.errorid)
+
+    def test_from_spec(self):
+        """ Test creating a model from a specification file """
+        path = os.path.join(os.path.dirname(__file__), 'ch3_sim.spec')
+        model = Model.from_spec(path)
+        self.assertEquals(11, len(model.variables))
+        self.assertEquals(('Income = GDP', 0), model.desc_variables['Y'])
+        self.assertEquals(0.6, model.parameters['alpha1'].value)
+        self.assertEquals('3.7', model.no_equations[
+            'Cd = alpha1*YD + alpha2*Hh(-1)'])
+        self.assertEquals('consumption function', model.equations[6].desc)
+        model.simulate(100, iterations=100, threshold=1e-5)
+        self.assertTrue(abs(model.solutions[-1]['Y'] - 100) < 0.1)
+
+        # the parsed specification is plain data
+        spec = read_spec(path)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        Model.from_spec(pickle.loads(pickle.dumps(spec)),
+                        cache_dir=cache_dir).simulate(3, iterations=100)
+        cached = Model.from_spec(spec, cache_dir=cache_dir)
+        cached.simulate(100, iterations=100, threshold=1e-5)
+        self.assertTrue(cached.equations[0].expr is None)
+        self.assertEquals(model.solutions[-1]['Y'], cached.solutions[-1]['Y'])
+
+        with self.assertRaises(SpecError) as context:
+            parse_spec('[variables]\nx\n[unknown]\n')
+        self.assertEquals(3, context.exception.lineno)
+        with self.assertRaises(SpecError):
+            parse_spec('x = 1\n')
+        with self.assertRaises(SpecError):
+            parse_spec('[parameters]\na = b\n')
+
+    def test_convergence(self):
+        """ Test the convergence test and the norms """
+        test = Convergence([0, 2], atol=[1e-4, 1.], rtol=0.)
+        self.assertTrue(test([1., 5., 2.], [1.00001, 7., 2.5]))
+        self.assertFalse(test([1., 5., 2.], [1.001, 5., 2.]))
+        self.assertEquals([0], test.failed([1., 5., 2.], [1.001, 5., 2.]))
+        self.assertEquals([2], test.failed([1., 5., 2.], [1., 5., 4.]))
+        self.assertEquals([0, 2],
+                          test.failed([1., 5., 2.], [float('nan'), 5., 4.]))
+        self.assertEquals(2, len(test.norms))
+        self.assertTrue(abs(test.norms[0] - 0.5) < 1e-6)
+        self.assertEquals([1.], test.select([2]).atol.tolist())
+        with self.assertRaises(ValueError):
+            Convergence([0], norm='l1')
+
+        model = _simple_model()
+        norms = []
+        model.simulate(5, iterations=100, norms=norms)
+        self.assertEquals(5, len(norms))
+        self.assertTrue(all(period[-1] <= 1 for period in norms))
+        self.assertTrue(all(period[0] >= period[-1] for period in norms))
+        self.assertTrue(norms[0][0] > norms[0][1] > norms[0][2])
+
+        # a looser tolerance for x converges in fewer iterations
+        loose = []
+        _simple_model().simulate(5, iterations=100, norms=loose,
+                                 atol={'x': 0.1, 'y': 0.1},
+                                 threshold={'x': 0.01})
+        self.assertTrue(sum(map(len, loose)) < sum(map(len, norms)))
+
+        for method in ('gauss-seidel', 'block-gauss-seidel', 'newton-raphson'):
+            other = _simple_model()
+            other.simulate(5, method=method, iterations=100, norm='rms')
+            self.assertTrue(abs(model.solutions[-1]['x'] -
+                                other.solutions[-1]['x']) < 1e-3)
+
+        with self.assertRaises(ValueError):
+            _simple_model().solve(iterations=100, atol={'a': 0.1})
+        with self.assertRaises(SolutionNotFoundError) as context:
+            _simple_model().solve(iterations=2)
+        self.assertEquals('x, y have not converged', str(context.exception))
+
+    def test_steady_state(self):
+        """ Test solving for the steady state """
+        path = os.path.join(os.path.dirname(__file__), 'ch3_sim.spec')
+        model = Model.from_spec(path)
+        solution = model.steady_state()
+        self.assertTrue(abs(solution['Y'] - 100) < 1e-6)
+        self.assertTrue(abs(solution['Hh'] - 80) < 1e-6)
+        self.assertEquals(0.6, solution['alpha1'])
+        self.assertFalse('_Hh__1' in solution)
+        # the steady state is not loaded by default
+        self.assertEquals(0, len(model.solutions))
+        self.assertEquals(0, model.variables['Y'].value)
+
+        # the same solution as simulating until the model settles
+        other = Model.from_spec(path)
+        other.simulate(200, iterations=100, threshold=1e-6)
+        for name in ('Y', 'YD', 'Hh', 'Cd', 'Td'):
+            self.assertTrue(abs(solution[name] -
+                                other.solutions[-1][name]) < 1e-3)
+
+        model.steady_state(load=True)
+        self.assertEquals(1, len(model.solutions))
+        self.assertTrue(abs(model.variables['Y'].value - 100) < 1e-6)
+        model.simulate(2, iterations=100, threshold=1e-6)
+        self.assertTrue(abs(model.solutions[-1]['Y'] - 100) < 1e-4)
+
+        with self.assertRaises(SolutionNotFoundError):
+            Model.from_spec(path).steady_state(iterations=1)
+        with self.assertRaises(ValueError):
+            Model.from_spec(path).steady_state(iterations=0)
+
+    def test_impulse_responses(self):
+        """ Test branching shocks from a snapshot """
+        path = os.path.join(os.path.dirname(__file__), 'ch3_sim.spec')
+        model = Model.from_spec(path)
+        model.simulate(20, iterations=100, threshold=1e-6)
+        before = model.solutions.array.copy()
+
+        snapshot = model.snapshot()
+        self.assertEquals(21, snapshot.periods)
+        snapshot = pickle.loads(pickle.dumps(snapshot))
+
+        # a branch continues from the snapshot
+        branch = snapshot.branch()
+        branch.simulate(5, iterations=100, threshold=1e-6)
+        model.simulate(5, iterations=100, threshold=1e-6)
+        self.assertEquals(model.solutions[-1]['Y'], branch.solutions[-1]['Y'])
+        self.assertEquals(26, len(model.solutions))
+        numpy.testing.assert_array_equal(before, model.solutions.array[:21])
+
+        scenarios = [Scenario('G+5', shocks={2: {'Gd': 25}}),
+                     Scenario('theta', values={'theta': 0.25},
+                              shocks={3: {'Gd': 30, 'alpha1': 0.5}})]
+        frame = impulse_responses(snapshot, scenarios, 10, record=['Y', 'Gd'],
+                                  iterations=100, threshold=1e-6)
+        self.assertEquals(20, len(frame))
+        self.assertEquals(['Y', 'Gd'], list(frame.columns))
+        shock = frame.loc['G+5']
+        self.assertEquals(0, shock['Y'].iloc[1])
+        self.assertTrue(abs(shock['Gd'].iloc[2] - 5) < 1e-9)
+        self.assertTrue(shock['Y'].iloc[2] > 5)
+        self.assertTrue(frame.loc['theta']['Y'].iloc[0] < 0)
+
+        # the model is not changed
+        self.assertEquals(26, len(model.solutions))
+        self.assertEquals(20, model.parameters['Gd'].value)
+
+    def test_random_terms(self):
+        """ Test the stochastic terms, drawn for each period """
+        def _create_model():
+            model = Model()
+            model.set_var_default(0)
+            model.vars('x', 'y')
+            model.param('a', default=0.5)
+            model.add('x = a*x(-1) + normal(0, 2)')
+            model.add('y = x + uniform(1, 3) + randint(5)')
+            return model
+
+        model = _create_model()
+        model.seed(42)
+        history = model.simulate(5, record=['x', 'y'])
+        self.assertEquals(5, len(set(history.column('x'))))
+
+        # the same seed gives the same draws, also with solve()
+        other = _create_model()
+        other.seed(42)
+        for _ in range(5):
+            other.solve()
+        for i in range(5):
+            self.assertEquals(history.column('x')[i],
+                              other.solutions[i+1]['x'])
+
+        # the generator is part of the state of the model
+        copied = pickle.loads(pickle.dumps(model))
+        model.simulate(2)
+        copied.simulate(2)
+        self.assertEquals(model.variables['y'].value,
+                          copied.variables['y'].value)
+
+        # the scenarios of a batch get different draws
+        batch = _create_model()
+        batch.seed(1)
+        result = batch.simulate_batch(3, {'a': numpy.array([0.5, 0.5])})
+        self.assertTrue((result.column('x')[:, 0] !=
+                         result.column('x')[:, 1]).all())
+
+        # the means are used by the steady state
+        solution = _create_model().steady_state()
+        self.assertEquals(0, solution['x'])
+        self.assertEquals(4, solution['y'])
+
+        with self.assertRaises(EquationError):
+            _create_model().add('y = randint(a)')
+
+        # seeded scenarios are reproducible, each has its own stream
+        scenarios = [Scenario('s0'), Scenario('s1')]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first = run_scenarios(_create_model, scenarios, 3,
+                                  executor=executor, seed=7, record=['x'])
+            second = run_scenarios(_create_model, scenarios, 3,
+                                   executor=executor, seed=7, record=['x'])
+        numpy.testing.assert_array_equal(first.values, second.values)
+        self.assertTrue(first.loc['s0']['x'].iloc[0] !=
+                        first.loc['s1']['x'].iloc[0])
+
+    def test_models_in_threads(self):
+        """ Test creating and solving models concurrently """
+        def _create_model(offset):
+            model = Model()
+            model.set_var_default(0)
+            model.vars('x', 'y')
+            model.param('a', default=offset)
+            model.add('x = a + 1')
+            model.add('y = x(-1) + d(x) + a')
+            return model
+
+        # models with the same names do not share their symbols
+        first = _create_model(1)
+        second = _create_model(2)
+        self.assertNotEqual(first.variables['x'], second.variables['x'])
+        first.solve()
+        second.solve()
+        self.assertEquals(2, first.variables['x'].value)
+        self.assertEquals(3, second.variables['x'].value)
+
+        def _run(offset):
+            model = _create_model(offset)
+            model.simulate(5)
+            return model.variables['y'].value
+
+        expected = [_run(i) for i in range(16)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(_run, range(16)))
+        self.assertEquals(expected, results)
+
+    def test_telemetry(self):
+        """ Test the statistics collected by the telemetry """
+        path = os.path.join(os.path.dirname(__file__), 'ch3_sim.spec')
+        model = Model.from_spec(path)
+        started = []
+        ended = []
+        directory = tempfile.mkdtemp()
+        try:
+            export = os.path.join(directory, 'periods.jsonl')
+            with SolverTelemetry(capacity=5, path=export,
+                                 on_period_start=started.append,
+                                 on_period_end=ended.append) as telemetry:
+                model.simulate(10, iterations=100, threshold=1e-6,
+                               method='newton-raphson', telemetry=telemetry,
+                               record=['Y'])
+                model.solve(iterations=100, telemetry=telemetry)
+            with open(export) as export_file:
+                lines = [json.loads(line) for line in export_file]
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEquals(list(range(1, 12)), started)
+        self.assertEquals(11, len(ended))
+        self.assertEquals(ended, lines)
+        self.assertEquals(5, len(telemetry.records))
+        self.assertEquals(5, len(telemetry.norms))
+        self.assertEquals(11, telemetry.periods)
+        self.assertEquals(sum(x['iterations'] for x in ended),
+                          telemetry.iterations)
+        self.assertTrue(telemetry.timings['jacobian'] > 0)
+        self.assertTrue(telemetry.timings['linear'] > 0)
+        self.assertTrue(ended[0]['iterations'] > 1)
+        self.assertTrue(ended[0]['step_norm'] <= 1)
+
+        # a failed period is recorded before the error is raised
+        telemetry = SolverTelemetry()
+        with self.assertRaises(SolutionNotFoundError):
+            model.simulate(1, iterations=1, threshold=1e-12,
+                           telemetry=telemetry)
+        self.assertEquals(1, telemetry.failures)
+        self.assertEquals(1, telemetry.summary()['iterations'])
+
+    def test_equation_profiler(self):
+        """ Test the costs and convergence of the equations """
+        path = os.path.join(os.path.dirname(__file__), 'ch3_sim.spec')
+        model = Model.from_spec(path)
+        profiler = EquationProfiler()
+        model.simulate(5, iterations=100, threshold=1e-6, profiler=profiler)
+
+        # the per-equation functions give the same solution
+        other = Model.from_spec(path)
+        other.simulate(5, iterations=100, threshold=1e-6)
+        self.assertEquals(other.variables['Y'].value,
+                          model.variables['Y'].value)
+
+        self.assertEquals(5, profiler.periods)
+        self.assertEquals(list(model.variables), profiler.names)
+        self.assertTrue((profiler.evaluations == profiler.sweeps).all())
+        self.assertEquals(3, len(profiler.costliest(3)))
+        # Gs = Gd only changes in the first sweep of the first period
+        unconverged = dict(zip(profiler.names, profiler.unconverged))
+        self.assertEquals(1, unconverged['Gs'])
+        self.assertEquals(0, dict(profiler.oscillating(20)).get('Gs', 0))
+        self.assertTrue(profiler.slowest(1)[0][1] > 10)
+        self.assertTrue(profiler.oscillating(1)[0][1] > 0)
+        frame = profiler.to_frame()
+        self.assertEquals('Gs = Gd', frame.loc['Gs', 'equation'])
+
+        # the other methods record only the changes of the variables
+        profiler = EquationProfiler()
+        model.simulate(2, method='newton-raphson', profiler=profiler)
+        self.assertEquals(0, profiler.evaluations.sum())
+        self.assertTrue(profiler.sweeps >= 2)
+
+    def test_writers(self):
+        """ Test streaming the solutions to files """
+        import pandas as pd
+        path = os.path.join(os.path.dirname(__file__), 'ch3_sim.spec')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        expected = Model.from_spec(path)
+        expected.simulate(10, iterations=100, threshold=1e-6)
+        model = Model.from_spec(path)
+        export = os.path.join(directory, 'sim.csv')
+        with CSVWriter(export, names=['Y', 'Hh'], chunk_size=3) as writer:
+            self.assertTrue(
+                writer is model.simulate(4, iterations=100, threshold=1e-6,
+                                         writer=writer))
+            model.simulate(6, iterations=100, threshold=1e-6, writer=writer)
+            self.assertEquals(10, writer.rows)
+        frame = pd.read_csv(export, index_col='period',
+                            float_precision='round_trip')
+        self.assertEquals(['Y', 'Hh'], list(frame.columns))
+        # the rows are keyed by the periods of the model
+        self.assertEquals(list(range(1, 11)), list(frame.index))
+        self.assertEquals(expected.solutions.column('Y')[1:].tolist(),
+                          frame['Y'].tolist())
+        # only the lagged periods are kept by the model
+        self.assertTrue(len(model.solutions) < 10)
+        with CSVWriter(export, names=['Y']) as writer:
+            model.snapshot().branch().simulate(2, iterations=100,
+                                               writer=writer)
+        frame = pd.read_csv(export, index_col='period')
+        self.assertEquals([11, 12], list(frame.index))
+        self.assertEquals(11, model.periods)
+        with CSVWriter(export, names=['Y']) as writer:
+            writer.write_history(model.solutions,
+                                 model.periods - len(model.solutions))
+        frame = pd.read_csv(export, index_col='period')
+        self.assertEquals(list(range(11 - len(model.solutions), 11)),
+                          list(frame.index))
+        with CSVWriter(export, names=['Y']) as writer:
+            model.simulate_batch(2, {'alpha1': [0.5, 0.6]}, iterations=100,
+                                 record=['Y'], writer=writer)
+        frame = pd.read_csv(export, index_col=['scenario', 'period'])
+        self.assertEquals([(0, 11), (1, 11), (0, 12), (1, 12)],
+                          list(frame.index))
+
+        # the names must match the columns of the writer
+        with self.assertRaises(ValueError):
+            model.simulate(1, record=['Y'], writer=CSVWriter(export, ['Hh']))
+        with self.assertRaises(ValueError):
+            create_writer(os.path.join(directory, 'sim.txt'))
+        with self.assertRaises(TypeError):
+            ResultWriter(export)
+
+        # export of the solutions of a model
+        export = os.path.join(directory, 'sim.npy')
+        with create_writer(export, chunk_size=4) as writer:
+            writer.write_history(expected.solutions)
+        array = numpy.load(export)
+        self.assertEquals(expected.solutions.names, writer.names)
+        self.assertTrue(numpy.array_equal(expected.solutions.array, array,
+                                          equal_nan=True))
+
+        # many scenarios, the rows are ordered by (period, scenario)
+        history = model.simulate_batch(5, {'alpha1': [0.5, 0.6, 0.7]},
+                                       iterations=100, record=['Y', 'Cd'])
+        export = os.path.join(directory, 'batch.npy')
+        with NpyWriter(export, chunk_size=4) as writer:
+            streamed = model.simulate_batch(5, {'alpha1': [0.5, 0.6, 0.7]},
+                                            iterations=100,
+                                            record=['Y', 'Cd'], writer=writer)
+        self.assertEquals(0, len(streamed))
+        self.assertFalse(streamed.failed.any())
+        array = numpy.load(export).reshape(5, 3, 2)
+        self.assertTrue(numpy.allclose(history.array.transpose(0, 2, 1),
+                                       array))
+
+        scenarios = [Scenario('base'), Scenario('low', values={'Gd': 10})]
+        with ThreadPoolExecutor(2) as executor:
+            frame = run_scenarios(lambda: Model.from_spec(path), scenarios,
+                                  4, executor=executor, record=['Y'],
+                                  iterations=100, threshold=1e-6)
+            export = os.path.join(directory, 'scenarios.csv')
+            with CSVWriter(export, names=['Y']) as writer:
+                run_scenarios(lambda: Model.from_spec(path), scenarios, 4,
+                              executor=executor, iterations=100,
+                              threshold=1e-6, writer=writer)
+        streamed = pd.read_csv(export, index_col=['scenario', 'period'],
+                               float_precision='round_trip')
+        self.assertEquals(frame['Y'].tolist(), streamed['Y'].tolist())
+
+    @unittest.skipIf(pyarrow is None, 'requires pyarrow')
+    def test_parquet_writer(self):
+        """ Test streaming the solutions to a Parquet file """
+        import pandas as pd
+        path = os.path.join(os.path.dirname(__file__), 'ch3_sim.spec')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        model = Model.from_spec(path)
+        export = os.path.join(directory, 'sim.parquet')
+        with ParquetWriter(export, names=['Y'], chunk_size=4) as writer:
+            model.simulate(10, iterations=100, threshold=1e-6, writer=writer)
+        frame = pd.read_parquet(export)
+        self.assertEquals(['period', 'Y'], list(frame.columns))
+        self.assertEquals(list(range(1, 11)), frame['period'].tolist())
+        self.assertTrue(abs(frame['Y'].iloc[-1] - 38.4) < 5)
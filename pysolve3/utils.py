@@ -5,6 +5,8 @@
 
 """
 
+import operator
+
 import numpy
 
 
@@ -62,6 +64,137 @@ def is_close(prev, curr, atol=1e-4, rtol=1e-4):
     return True
 
 
+# The norms of the scaled errors used by Convergence
+_NORMS = ('max', 'rms')
+
+
+class Convergence(object):
+    """ Tests the convergence of the variables of a solution.
+
+        Only the values at the positions of the variables are compared
+        (the parameters do not change while solving).  The scaled
+        error of a value is
+            abs(curr - prev) / (atol + rtol*abs(curr))
+        and the solution has converged when the norm of the scaled
+        errors is at most 1.  With the 'max' norm this is the same
+        test as is_aclose(), with 'rms' (root-mean-square) a few
+        values may be outside of their tolerances.
+
+        Arguments:
+            positions: The positions of the variables in the solution.
+            atol: The absolute tolerance, a single value or one
+                value per position.
+            rtol: The relative tolerance, a single value or one
+                value per position.
+            norm: 'max' or 'rms'
+
+        Attributes:
+            norms: The norms of the iterations since the last reset().
+
+        Raises:
+            ValueError: if the norm is not valid
+    """
+    def __init__(self, positions, atol=1e-4, rtol=1e-4, norm='max'):
+        if norm not in _NORMS:
+            raise ValueError('{0} is not a valid norm'.format(norm))
+        self.positions = numpy.array(positions, dtype=numpy.intp)
+        size = len(self.positions)
+        self.atol = numpy.array(numpy.broadcast_to(atol, (size,)), dtype=float)
+        self.rtol = numpy.array(numpy.broadcast_to(rtol, (size,)), dtype=float)
+        self.norm = norm
+        self.norms = []
+        self._getter = (operator.itemgetter(*self.positions.tolist())
+                        if size else None)
+        self._prev = numpy.empty(size)
+        self._curr = numpy.empty(size)
+        self._scale = numpy.empty(size)
+
+    def reset(self):
+        """ Clears the norms """
+        self.norms = []
+
+    def select(self, positions):
+        """ Returns the test for some of the positions (with their
+            tolerances), these must be part of this test.
+        """
+        index = {position: i for i, position in enumerate(self.positions)}
+        selected = [index[position] for position in positions]
+        return Convergence(positions, atol=self.atol[selected],
+                           rtol=self.rtol[selected], norm=self.norm)
+
+    def values(self, solution, out=None):
+        """ Returns the values of the solution at the positions, as an
+            array.
+        """
+        if out is None:
+            out = numpy.empty(len(self.positions))
+        if isinstance(solution, numpy.ndarray):
+            numpy.take(solution, self.positions, out=out)
+        elif self._getter is not None:
+            out[:] = self._getter(solution)
+        return out
+
+    def errors(self, prev, curr):
+        """ Returns the scaled errors, prev and curr are the values of
+            the positions (see values()), or (positions x scenarios)
+            arrays of the values of many scenarios.
+        """
+        error = numpy.subtract(curr, prev)
+        numpy.abs(error, out=error)
+        if error.ndim == 1:
+            scale = numpy.abs(curr, out=self._scale)
+            scale *= self.rtol
+            scale += self.atol
+        else:
+            scale = numpy.abs(curr) * self.rtol[:, None]
+            scale += self.atol[:, None]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            numpy.divide(error, scale, out=error, where=error != 0)
+        return error
+
+    def converged(self, prev, solution):
+        """ Returns True if the solution has converged, prev contains
+            the previous values of the positions (see values()).
+            The norm is added to norms.
+        """
+        error = self.errors(prev, self.values(solution, self._curr))
+        if not len(error):
+            norm = 0.
+        elif self.norm == 'max':
+            norm = float(error.max())
+        else:
+            norm = float(numpy.sqrt(numpy.mean(error * error)))
+        self.norms.append(norm)
+        return norm <= 1.
+
+    def converged_scenarios(self, prev, curr):
+        """ Returns a boolean array, True for the scenarios whose
+            values have converged, prev and curr are (positions x
+            scenarios) arrays of the values.  The norms are not
+            recorded.
+        """
+        error = self.errors(prev, curr)
+        if not len(error):
+            return numpy.ones(error.shape[1], dtype=bool)
+        if self.norm == 'max':
+            norm = error.max(axis=0)
+        else:
+            norm = numpy.sqrt(numpy.mean(error * error, axis=0))
+        return norm <= 1.
+
+    def __call__(self, prev, curr):
+        """ Returns True if the solution curr has converged from
+            the solution prev.
+        """
+        return self.converged(self.values(prev, self._prev), curr)
+
+    def failed(self, prev, curr):
+        """ Returns the positions whose values have not converged """
+        error = self.errors(self.values(prev, self._prev),
+                            self.values(curr, self._curr))
+        return self.positions[~(error <= 1.)].tolist()
+
+
 def generate_html_table(header, adata):
     """ Generates an html table for use within iPython """
 
@@ -85,16 +218,14 @@ def SFCTable(model):
     """
     Create a pandas DateFrame for the model.
     model = model class object already simulated
+    To export long simulations, stream them to a file instead
+    (see SolveSFC() and pysolve3.writers).
     """
-    import pandas as pd
-    time = len(model.solutions)
-    data_dict = {
-    i: model.solutions[i] for i in range(time)
-                }
-    df = pd.DataFrame(data_dict).transpose()
+    df = model.solutions.to_frame()
     return df
 
-def SolveSFC(model, time=500, iterations=100, threshold=1e-5, table=True):
+def SolveSFC(model, time=500, iterations=100, threshold=1e-5, table=True,
+             writer=None):
     """
     Solves the model
     model: a Model class object
@@ -102,12 +233,13 @@ def SolveSFC(model, time=500, iterations=100, threshold=1e-5, table=True):
     iterations: the number of iterations
     threshold: threshold
     table: if True, returns a DataFrame using SFCTable. If so, it must be assigned to a variable
+    writer: if set, the ResultWriter (see pysolve3.writers) the periods are
+        streamed to, rather than being kept in the model. No table is returned.
     """
 
-    for i in range(time):
-        model.solve(iterations=iterations, threshold=1e-5)
+    model.simulate(time, iterations=iterations, threshold=1e-5, writer=writer)
         
-    if table == True:
+    if table == True and writer is None:
         df = SFCTable(model)
         return df
     else:
@@ -126,12 +258,11 @@ def ShockModel(base_model, create_function, variable, increase, time=500, initia
     increase = float(increase)
     model = create_function
     
-    lagged = [key for key in base_model.solutions[-1].keys()]
-    lagged = [i for i in lagged if "__" in i]
-    for i in lagged:
-        del base_model.solutions[-1][i]
+    # the lagged values ("__" keys) are private to the base model
+    values = {key: value for key, value in base_model.solutions[-1].items()
+              if "__" not in key}
 
-    model.set_values(base_model.solutions[-1])
+    model.set_values(values)
     
     SolveSFC(model, time=initial_time, table=False)
 
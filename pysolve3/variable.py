@@ -5,11 +5,32 @@
 
 """
 
+import itertools
+
 from sympy import Symbol
 
 from pysolve3 import InvalidNameError
 
 
+# Each variable/parameter gets a token of its own, so that symbols
+# of the same name in different models are never equal.
+_TOKENS = itertools.count()
+
+
+def _new_symbol(cls, name):
+    """ Creates a symbol of the model (a variable or parameter).
+
+        The symbol is not taken from the sympy cache (as with Dummy),
+        and its token is part of its hashable content.  Thus the
+        expressions cached by sympy (and the series accessors) of one
+        model are not used for another model with the same names, and
+        models can be created and solved in several threads.
+    """
+    obj = Symbol.__xnew__(cls, name)
+    obj._token = next(_TOKENS)
+    return obj
+
+
 class ModVariable(Symbol):
     """ This class contains a 'variable'.  This is a value that
         is being solved here, thus it can change during solving.
@@ -32,6 +53,13 @@ class ModVariable(Symbol):
 
     ILLEGAL_NAMES = ['I', 'oo', 'nan', 'pi', 'E']
 
+    def __new__(cls, name, *args, **kwargs):
+        # pylint: disable=unused-argument
+        return _new_symbol(cls, name)
+
+    def _hashable_content(self):
+        return super(ModVariable, self)._hashable_content() + (self._token,)
+
     def __init__(self, name, desc=None, default=None):
         if name in ModVariable.ILLEGAL_NAMES:
             raise InvalidNameError(name, 'Name already used by sympy')
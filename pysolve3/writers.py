@@ -0,0 +1,297 @@
+""" Contains the writers used to stream the results of a simulation to
+    a file, see Model.simulate(), Model.simulate_batch() and
+    run_scenarios().
+
+    Copyright (c) 2014 Kenn Takara
+    See LICENSE for details
+
+"""
+
+import abc
+import os
+import struct
+
+import numpy
+
+
+class ResultWriter(abc.ABC):
+    """ The base class of the writers.
+
+        The rows are copied into a buffer of chunk_size rows, and the
+        buffer is written to the file when it is full, so the memory
+        used does not depend on the number of periods.  Each row has
+        the keys of its index (period, or scenario and period) and
+        the values of the names.
+
+        The file is created when the first rows are written (see
+        open()).  The writer can be used for many calls of
+        simulate(), the rows are appended, and must be closed when
+        done (it is a context manager).
+
+        Arguments:
+            path: The path of the file.
+            names: The names of the variables/parameters to write, by
+                default the names recorded by the simulation.
+            chunk_size: The number of rows written at once.
+
+        Attributes:
+            path: The path of the file.
+            names: The names of the columns.
+            index: The names of the keys of the rows.
+            rows: The number of rows written.
+    """
+    def __init__(self, path, names=None, chunk_size=1024):
+        self.path = path
+        self.names = list(names) if names is not None else None
+        self.index = None
+        self.rows = 0
+        self.chunk_size = chunk_size
+        self._keys = None
+        self._values = None
+        self._count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self, names, index):
+        """ Creates the file, this is called by the simulation before
+            the first rows are written.  The file is only created
+            once, later calls check that the columns are the same.
+
+            Arguments:
+                names: The names of the values.
+                index: The names of the keys.
+
+            Raises:
+                ValueError: if the names (or the index) differ from
+                    the columns of the writer
+        """
+        names = list(names)
+        index = tuple(index)
+        if self.names is not None and names != self.names:
+            raise ValueError('the names differ from the names of the writer')
+        if self.index is not None:
+            if index != self.index:
+                raise ValueError(
+                    'the index differs from the index of the writer')
+            return
+        self.names = names
+        self.index = index
+        # one row per column, so that each column of a chunk is
+        # contiguous
+        self._keys = numpy.empty((len(index), self.chunk_size),
+                                 dtype=numpy.int64)
+        self._values = numpy.empty((len(names), self.chunk_size))
+        self._start()
+
+    def write_row(self, values, keys):
+        """ Adds a row, given as a sequence of values of the names
+            and a sequence of keys
+        """
+        self._keys[:, self._count] = keys
+        self._values[:, self._count] = values
+        self._count += 1
+        self.rows += 1
+        if self._count == self.chunk_size:
+            self.flush()
+
+    def write(self, values, keys):
+        """ Adds the rows of a (rows x names) array of values, and of a
+            (rows x index) array of keys
+        """
+        start = 0
+        while start < len(values):
+            count = min(len(values) - start, self.chunk_size - self._count)
+            end = start + count
+            self._keys[:, self._count:self._count + count] = keys[start:end].T
+            self._values[:, self._count:self._count + count] = \
+                values[start:end].T
+            self._count += count
+            self.rows += count
+            start = end
+            if self._count == self.chunk_size:
+                self.flush()
+
+    def write_history(self, history, start=0):
+        """ Writes the periods of a SolutionHistory (such as the
+            model's solutions), the rows are indexed by the period.
+            Only the names of the writer are written, a chunk at a
+            time, rather than converting the history to a DataFrame.
+
+            Arguments:
+                history: The SolutionHistory.
+                start: The period of the first row of the history.
+                    For the solutions of a model that has not kept
+                    all of its periods (see Model.simulate()), this is
+                    model.periods - len(model.solutions).
+
+            Raises:
+                KeyError: if a name is not part of the history
+        """
+        names = self.names if self.names is not None else history.names
+        self.open(names, ('period',))
+        columns = [history.names.index(name) for name in names]
+        data = history.array
+        for first in range(0, len(data), self.chunk_size):
+            rows = data[first:first + self.chunk_size]
+            keys = numpy.arange(start + first,
+                                start + first + len(rows))[:, None]
+            self.write(rows[:, columns], keys)
+
+    def flush(self):
+        """ Writes the buffered rows to the file """
+        if self._count:
+            self._write_chunk(self._keys[:, :self._count],
+                              self._values[:, :self._count])
+            self._count = 0
+
+    def close(self):
+        """ Writes the buffered rows and closes the file """
+        if self.index is not None:
+            self.flush()
+            self._close()
+
+    @abc.abstractmethod
+    def _start(self):
+        """ Creates the file """
+
+    @abc.abstractmethod
+    def _write_chunk(self, keys, values):
+        """ Writes the (index x rows) keys and (names x rows) values """
+
+    @abc.abstractmethod
+    def _close(self):
+        """ Closes the file """
+
+
+class CSVWriter(ResultWriter):
+    """ Writes the rows to a CSV file, with a header of the names of
+        the keys and values.  The values are written with 17
+        significant digits (so they are read back unchanged).
+    """
+    def __init__(self, path, names=None, chunk_size=1024, delimiter=','):
+        super(CSVWriter, self).__init__(path, names, chunk_size)
+        self.delimiter = delimiter
+        self._file = None
+        self._format = None
+
+    def _start(self):
+        self._file = open(self.path, 'w')
+        self._file.write(self.delimiter.join(self.index + tuple(self.names)))
+        self._file.write('\n')
+        self._format = ['%d'] * len(self.index) + ['%.17g'] * len(self.names)
+
+    def _write_chunk(self, keys, values):
+        numpy.savetxt(self._file, numpy.vstack((keys, values)).T,
+                      fmt=self._format, delimiter=self.delimiter)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# The size of the header of a .npy file written by NpyWriter, this
+# is large enough for any shape (and a multiple of 64, as numpy does)
+_NPY_HEADER_SIZE = 128
+
+
+class NpyWriter(ResultWriter):
+    """ Writes the values to a .npy file, as a (rows x names) float64
+        array that can be read with numpy.load() (or memory mapped).
+
+        The keys are not written: the rows are in the order of the
+        periods, and for many scenarios in the order of (period,
+        scenario) for simulate_batch(), and (scenario, period) for
+        run_scenarios().  The shape in the header is updated when
+        the writer is closed.
+    """
+    def __init__(self, path, names=None, chunk_size=1024):
+        super(NpyWriter, self).__init__(path, names, chunk_size)
+        self._file = None
+
+    def _header(self):
+        """ Returns the header of the file, for the rows written """
+        header = "{{'descr': '<f8', 'fortran_order': False, " \
+                 "'shape': ({0}, {1}), }}".format(self.rows, len(self.names))
+        header = header.ljust(_NPY_HEADER_SIZE - 11) + '\n'
+        return (numpy.lib.format.magic(1, 0) +
+                struct.pack('<H', len(header)) + header.encode('latin1'))
+
+    def _start(self):
+        self._file = open(self.path, 'wb')
+        self._file.write(self._header())
+
+    def _write_chunk(self, keys, values):
+        self._file.write(values.T.astype('<f8').tobytes())
+
+    def _close(self):
+        if self._file is not None:
+            self._file.seek(0)
+            self._file.write(self._header())
+            self._file.close()
+            self._file = None
+
+
+class ParquetWriter(ResultWriter):
+    """ Writes the rows to a Parquet file, each chunk is a row group
+        (requires pyarrow).
+    """
+    def __init__(self, path, names=None, chunk_size=65536,
+                 compression='snappy'):
+        super(ParquetWriter, self).__init__(path, names, chunk_size)
+        self.compression = compression
+        self._writer = None
+        self._schema = None
+
+    def _start(self):
+        import pyarrow
+        import pyarrow.parquet
+        self._schema = pyarrow.schema(
+            [(name, pyarrow.int64()) for name in self.index] +
+            [(name, pyarrow.float64()) for name in self.names])
+        self._writer = pyarrow.parquet.ParquetWriter(
+            self.path, self._schema, compression=self.compression)
+
+    def _write_chunk(self, keys, values):
+        import pyarrow
+        columns = [pyarrow.array(column) for column in keys]
+        columns.extend(pyarrow.array(column) for column in values)
+        self._writer.write_table(
+            pyarrow.Table.from_arrays(columns, schema=self._schema))
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+WRITERS = {'csv': CSVWriter,
+           'npy': NpyWriter,
+           'parquet': ParquetWriter}
+
+
+def create_writer(path, names=None, kind=None, **options):
+    """ Creates the writer of a file
+
+        Arguments:
+            path: The path of the file.
+            names: The names of the variables/parameters to write, by
+                default the names recorded by the simulation.
+            kind: 'csv', 'npy' or 'parquet', by default this is the
+                extension of the path.
+            options: The arguments of the writer (such as chunk_size).
+
+        Returns: a ResultWriter
+
+        Raises:
+            ValueError: if kind is not a known writer
+    """
+    if kind is None:
+        kind = os.path.splitext(path)[1].lstrip('.').lower()
+    if kind not in WRITERS:
+        raise ValueError('{0} is not a valid writer type'.format(kind))
+    return WRITERS[kind](path, names=names, **options)
@@ -12,6 +12,7 @@ setup(
     version='0.1.5',
     packages=find_packages(),
     install_requires=['sympy>=1.4', 'numpy', 'pandas'],
+    extras_require={'sparse': ['scipy'], 'parquet': ['pyarrow']},
     license='MIT',
     author='Gabriel Petrini da Silveira',
     author_email='gpetrinidasilveira@gmail.com',